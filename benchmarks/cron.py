@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Measures :meth:`CronPattern.next_clearance` over a corpus of patterns, compared with the
+former implementation which stepped forward minute by minute, hour by hour or day by day,
+and the time to schedule a number of partners with random connection schedules.
+
+Run from the top-level directory::
+
+    $ python -m benchmarks.cron [PARTNERS]
+"""
+
+import sys, time, random
+
+from sduds.lib import scheduler
+
+from tests.lib.scheduler import patterns, stepping_next_clearance
+
+def measure(function, pattern, last_execution, repetitions):
+    start = time.time()
+    for i in xrange(repetitions):
+        function(pattern, last_execution)
+    return (time.time() - start)/repetitions
+
+def random_schedule(random):
+    """ Returns a connection schedule like the ones partners use, e.g. "17 */4 * * *". """
+
+    minute = str(random.randint(0, 59))
+    hour = random.choice(["*", "*/2", "*/4", str(random.randint(0, 23))])
+    dom = random.choice(["*", "*", "*", str(random.randint(1, 28))])
+    dow = random.choice(["*", "*", "*", str(random.randint(0, 6))])
+
+    return minute, hour, dom, "*", dow
+
+if __name__=="__main__":
+    if len(sys.argv)>1:
+        partners = int(sys.argv[1])
+    else:
+        partners = 1000
+
+    last_execution = int(time.time())
+
+    print "%-35s %12s %12s %8s" % ("pattern", "table (us)", "stepping (us)", "speedup")
+
+    for fields in patterns:
+        pattern = scheduler.CronPattern(*fields)
+
+        table = measure(scheduler.CronPattern.next_clearance, pattern, last_execution, 1000)
+        stepping = measure(stepping_next_clearance, pattern, last_execution, 10)
+
+        print "%-35s %12.1f %12.1f %8.0f" % (" ".join(fields), table*1e6, stepping*1e6, stepping/table)
+
+    # impossible pattern, searches MAX_YEARS
+    pattern = scheduler.CronPattern("15", "20", "31", "11", "*")
+    print
+
+    for name, function in (("table", scheduler.CronPattern.next_clearance), ("stepping", stepping_next_clearance)):
+        start = time.time()
+        try:
+            function(pattern, last_execution)
+        except scheduler.NoMatchingTimestamp:
+            pass
+        print "no matching timestamp (%s): %.1f ms" % (name, (time.time() - start)*1e3)
+
+    # what the application does at startup for each partner
+    r = random.Random(0)
+    schedules = [random_schedule(r) for i in xrange(partners)]
+
+    start = time.time()
+    for fields in schedules:
+        scheduler.CronPattern(*fields).next_clearance(last_execution)
+    print "schedule %d partners: %.1f ms" % (partners, (time.time() - start)*1e3)
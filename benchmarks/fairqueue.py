@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+Measures the operations of the validation queue with a large backlog of one partner,
+and how long self-made claims wait while the backlog drains.
+
+Run from the top-level directory::
+
+    $ python -m benchmarks.fairqueue [BACKLOG]
+"""
+
+import sys, time
+
+from sduds import context
+from sduds.lib.fairqueue import FairQueue
+from sduds.constants import *
+
+class Item:
+    """ Stands in for a claim; only the partner name is needed. """
+
+    def __init__(self, partner_name):
+        self.partner_name = partner_name
+
+if __name__=="__main__":
+    if len(sys.argv)>1:
+        backlog = int(sys.argv[1])
+    else:
+        backlog = 1000000
+
+    queue = FairQueue(context.claim_source, context.source_weight, VALIDATION_AGING)
+
+    partner_item = Item("partner")
+
+    start = time.time()
+    for i in xrange(backlog):
+        queue.put(partner_item)
+    duration = time.time() - start
+    print "put: %.2f us per item" % (duration/backlog*1e6)
+
+    # drain the backlog, submitting a self-made claim every 1000 items
+    waits = []
+    local_item = None
+    got = 0
+
+    start = time.time()
+    while not queue.empty():
+        if got%1000==0 and local_item is None:
+            local_item = Item(None)
+            queue.put(local_item)
+            submitted = got
+
+        item = queue.get_nowait()
+        got += 1
+
+        if item is local_item:
+            waits.append(got - submitted)
+            local_item = None
+    duration = time.time() - start
+
+    print "get: %.2f us per item" % (duration/got*1e6)
+    print "self-made claims: %d, waited for at most %d items (average %.2f)" % (len(waits), max(waits), float(sum(waits))/len(waits))
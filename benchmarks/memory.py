@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+Measures the memory used per queued claim with a large validation backlog, once for
+claims holding :class:`~sduds.states.StateRecord` instances, as queued by the workers,
+and once for claims holding mapped :class:`~sduds.states.State` instances.
+
+Each variant runs in a separate process, and the increase of its resident set size is
+divided by the number of claims. Run from the top-level directory::
+
+    $ python -m benchmarks.memory [NUMBER_OF_CLAIMS]
+"""
+
+import sys, os, time, gc, Queue, multiprocessing
+
+from sduds import states, context
+import sduds.statedatabase.sqlite # maps State
+
+def resident_size():
+    """ Returns the resident set size of this process in bytes (Linux only). """
+
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+
+    return pages*os.sysconf("SC_PAGE_SIZE")
+
+def fill_queue(state_class, number, result_queue):
+    now = int(time.time())
+    captcha_signature = "\0"*256
+
+    gc.collect()
+    before = resident_size()
+
+    validation_queue = Queue.PriorityQueue()
+    for i in xrange(number):
+        # distinct strings, as they would be if decoded from messages
+        address = "user%d@example.org" % i
+        profile = states.Profile(u"User %d" % i, u"Hometown %d" % i, "de", "diaspora,email",
+                                 captcha_signature[:-1]+chr(i%256), now-60)
+        state = state_class(address, now-30, profile)
+
+        validation_queue.put(context.Claim(state, "partner", now+i))
+
+    gc.collect()
+    after = resident_size()
+
+    result_queue.put(float(after-before)/number)
+
+def measure(state_class, number):
+    result_queue = multiprocessing.Queue()
+
+    process = multiprocessing.Process(target=fill_queue, args=(state_class, number, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+
+    return result
+
+if __name__=="__main__":
+    if len(sys.argv)>1:
+        number = int(sys.argv[1])
+    else:
+        number = 100000
+
+    print "%-30s %16s" % ("claims holding", "bytes per claim")
+
+    for state_class in (states.StateRecord, states.State):
+        print "%-30s %16.1f" % (state_class.__name__, measure(state_class, number))
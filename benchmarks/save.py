@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Measures the cost of State.hash with and without the cached value, and the throughput
+of StateDatabase.save, which reads the hash of each saved state several times, and of
+StateDatabase.bulk_load. The database benchmarks need the trie_manager executable.
+
+Run from the top-level directory::
+
+    $ python -m benchmarks.save [NUMBER_OF_STATES]
+"""
+
+import sys, os, time, tempfile, shutil
+
+from sduds import states
+from sduds.lib import signature
+
+from tests.states import private_key_block
+
+def generate_states(number, timestamp):
+    result = []
+
+    for i in xrange(number):
+        address = "user%d@example.org" % i
+        captcha_signature = signature.sign(private_key_block, address)
+
+        profile = states.Profile(u"User %d" % i, u"Hometown", "de", "diaspora", captcha_signature, timestamp-60)
+        result.append(states.StateRecord(address, timestamp-30, profile))
+
+    return result
+
+def hash_accesses(state_list, accesses, cached):
+    """ Reads the hash of each state as often as the save path does. """
+
+    start = time.time()
+
+    for state in state_list:
+        for i in xrange(accesses):
+            if not cached: state._hash_cache = None
+            state.hash
+
+    return time.time() - start
+
+def save_states(state_list, bulk=False):
+    from sduds.statedatabase.sqlite import StateDatabase
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        statedb = StateDatabase(os.path.join(directory, "PTree"), os.path.join(directory, "states.sqlite"))
+
+        start = time.time()
+        if bulk:
+            statedb.bulk_load(state_list)
+        else:
+            for state in state_list:
+                statedb.save(state)
+        duration = time.time() - start
+
+        statedb.close()
+    finally:
+        shutil.rmtree(directory)
+
+    return duration
+
+if __name__=="__main__":
+    if len(sys.argv)>1:
+        number = int(sys.argv[1])
+    else:
+        number = 2000
+
+    now = int(time.time())
+
+    print "Generating %d states..." % number
+    state_list = generate_states(number, now)
+
+    # trie add, before_insert, lookups and logging
+    accesses = 4
+
+    uncached = hash_accesses(state_list, accesses, cached=False)
+    cached = hash_accesses(state_list, accesses, cached=True)
+
+    print "%-30s %12s" % ("operation", "states/sec")
+    print "%-30s %12.1f" % ("%d hash reads, recalculated" % accesses, number/uncached)
+    print "%-30s %12.1f" % ("%d hash reads, cached" % accesses, number/cached)
+
+    # the save path with fresh instances, as they come from the assimilation queue
+    state_list = generate_states(number, now)
+    duration = save_states(state_list)
+    print "%-30s %12.1f" % ("StateDatabase.save", number/duration)
+
+    state_list = generate_states(number, now)
+    duration = save_states(state_list, bulk=True)
+    print "%-30s %12.1f" % ("StateDatabase.bulk_load", number/duration)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+Runs a synchronization between two nodes on the loopback interface and reports its wall
+time, the time until the received states are saved, the per-phase timings and bytes from
+the synchronization traces, and the peak RSS of the process. Needs the trie_manager
+executable.
+
+The nodes are seeded with ``SHARED`` states both of them have, ``UNIQUE`` states only
+each of them has, and ``GHOSTS`` states which the server node replaced by a newer
+state, so that the client node still offers the old state and gets a deletion request.
+
+Run from the top-level directory::
+
+    $ python -m benchmarks.sync [SHARED [UNIQUE [GHOSTS]]]
+"""
+
+import sys, os, time, tempfile, shutil, socket, resource, logging
+
+from sduds import states
+from sduds.context import Context
+from sduds.application import Application
+from sduds.partners import Partner
+from sduds.constants import MIN_RESUBMISSION_INTERVAL
+from sduds.lib import signature
+
+from tests.states import private_key_block
+
+PASSWORD = "benchmark"
+
+def free_port():
+    """ Returns a port on the loopback interface which is currently not in use. """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+def make_state(address, submission_timestamp, retrieval_timestamp, hometown=u"Hometown"):
+    captcha_signature = signature.sign(private_key_block, address)
+    profile = states.Profile(u"User", hometown, "de", "diaspora", captcha_signature, submission_timestamp)
+
+    return states.StateRecord(address, retrieval_timestamp, profile)
+
+def start_node(directory, name, web_port=None, synchronization_port=None):
+    context = Context(partnerdb_path=os.path.join(directory, "partners.sqlite"),
+                      statedb_path=os.path.join(directory, "states.sqlite"),
+                      hashtrie_path=os.path.join(directory, "PTree"),
+                      trace_path=os.path.join(directory, "synchronizations.jsonl"),
+                      log=name)
+
+    application = Application(context)
+    application.configure_workers()
+
+    if web_port:
+        application.configure_web_server("localhost", web_port)
+    if synchronization_port:
+        application.configure_synchronization_server("localhost", "localhost", synchronization_port)
+
+    # the databases are new, so there are no expired states to delete
+    application.ready_for_synchronization.set()
+
+    return application
+
+def seed(server, client, shared, unique, ghosts):
+    now = int(time.time())
+
+    for i in xrange(shared):
+        state = make_state("shared%d@example.org" % i, now-60, now-30)
+        server.context.statedb.save(state)
+        client.context.statedb.save(state)
+
+    for application, prefix in ((server, "server"), (client, "client")):
+        for i in xrange(unique):
+            application.context.statedb.save(make_state("%s%d@example.org" % (prefix, i), now-60, now-30))
+
+    # the server has replaced these states, its ghosts match the hashes offered by the client
+    for i in xrange(ghosts):
+        address = "ghost%d@example.org" % i
+        old_state = make_state(address, now-MIN_RESUBMISSION_INTERVAL-3600, now-120)
+        server.context.statedb.save(old_state)
+        client.context.statedb.save(old_state)
+
+        server.context.statedb.save(make_state(address, now-60, now-30, u"New hometown"))
+
+def wait_until_assimilated(application):
+    context = application.context
+
+    context.submission_queue.join()
+    context.validation_queue.join()
+    context.assimilation_queue.join()
+
+def print_phases(title, summary):
+    print
+    print title
+    print "%-20s %10s %10s %10s %12s %12s" % ("phase", "seconds", "sent", "received", "bytes sent", "bytes recv")
+
+    for name, values in sorted(summary["phases"].iteritems()):
+        print "%-20s %10.3f %10d %10d %12d %12d" % (name, values["duration"], values["sent"], values["received"],
+                                                   values.get("bytes_sent", 0), values.get("bytes_received", 0))
+
+if __name__=="__main__":
+    logging.basicConfig(level=logging.ERROR)
+
+    arguments = [int(argument) for argument in sys.argv[1:]]
+    shared, unique, ghosts = (arguments + [10000, 1000, 100][len(arguments):])[:3]
+
+    web_port = free_port()
+    synchronization_port = free_port()
+
+    server_directory = tempfile.mkdtemp()
+    client_directory = tempfile.mkdtemp()
+
+    try:
+        server = start_node(server_directory, "server", web_port, synchronization_port)
+        client = start_node(client_directory, "client")
+
+        server.context.partnerdb.save_partner(Partner("client", PASSWORD, "http://localhost:1/", 0.))
+        client.context.partnerdb.save_partner(Partner("server", PASSWORD, "http://localhost:%d/" % web_port, 0.,
+                                                      provide_username="client", provide_password=PASSWORD))
+
+        print "Seeding %d shared, %d unique and %d replaced states..." % (shared, unique, ghosts)
+        start = time.time()
+        seed(server, client, shared, unique, ghosts)
+        print "Seeded in %.1f seconds." % (time.time() - start)
+
+        server.start(jobs=False)
+        client.start(web_server=False, synchronization_server=False, jobs=False)
+
+        start = time.time()
+        client.synchronize_with_partner("server")
+        synchronization_time = time.time() - start
+
+        wait_until_assimilated(client)
+        wait_until_assimilated(server)
+        assimilation_time = time.time() - start
+
+        # the server writes its trace after the client returned
+        time.sleep(0.5)
+
+        client_summary = client.context.trace_log.summary().get("server")
+        server_summary = server.context.trace_log.summary().get("client")
+
+        print
+        print "%-30s %10.3f" % ("synchronization (s)", synchronization_time)
+        print "%-30s %10.3f" % ("until assimilated (s)", assimilation_time)
+
+        if client_summary:
+            print "%-30s %10d" % ("missing hashes (client)", client_summary["missing_hashes"])
+            print "%-30s %10d" % ("queue-full drops (client)", client_summary["drops"])
+            print_phases("client", client_summary)
+        else:
+            print "The synchronization failed, see the log."
+
+        if server_summary:
+            print_phases("server", server_summary)
+
+        print
+        print "%-30s %10s %10s" % ("node", "states", "ghosts")
+        print "%-30s %10d %10d" % (("server",) + server.context.statedb.count())
+        print "%-30s %10d %10d" % (("client",) + client.context.statedb.count())
+
+        # both nodes run in this process, so this is their sum
+        print
+        print "%-30s %10.1f" % ("peak RSS (MB)", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.)
+
+        client.terminate()
+        server.terminate()
+    finally:
+        shutil.rmtree(server_directory)
+        shutil.rmtree(client_directory)
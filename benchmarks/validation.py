@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Measures how many claims per second the validation workers can check, once with
+threads only and once with a process pool of increasing size.
+
+Run from the top-level directory::
+
+    $ python -m benchmarks.validation [NUMBER_OF_CLAIMS]
+"""
+
+import sys, time, threading, multiprocessing
+
+from sduds import states, context
+from sduds.lib import signature
+
+from tests.states import private_key_block
+
+def generate_claims(number):
+    """ Returns claims for distinct addresses, so that signature checks are not cached. """
+
+    now = int(time.time())
+    claims = []
+
+    for i in xrange(number):
+        address = "user%d@example.org" % i
+        captcha_signature = signature.sign(private_key_block, address)
+
+        profile = states.Profile("User %d" % i, "Hometown", "de", "diaspora", captcha_signature, now-60)
+        state = states.StateRecord(address, now-30, profile)
+
+        claims.append(context.Claim(state, timestamp=now))
+
+    return claims
+
+def check_with_threads(claims, threads):
+    chunks = [claims[i::threads] for i in xrange(threads)]
+
+    def work(chunk):
+        for claim in chunk:
+            assert context.check_state(claim.state, claim.timestamp) is None
+
+    workers = [threading.Thread(target=work, args=(chunk,)) for chunk in chunks]
+
+    start = time.time()
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+
+    return time.time() - start
+
+def check_with_pool(claims, processes, batch_size=context.VALIDATION_BATCH_SIZE):
+    pool = multiprocessing.Pool(processes, signature.disable_verification_cache)
+
+    try:
+        start = time.time()
+
+        for i in xrange(0, len(claims), batch_size):
+            batch = claims[i:i+batch_size]
+            arguments = [(context.state_data(claim.state), claim.timestamp, False) for claim in batch]
+            results = pool.map(context.check_state_data, arguments)
+            assert results==[None]*len(batch)
+
+        return time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__=="__main__":
+    if len(sys.argv)>1:
+        number = int(sys.argv[1])
+    else:
+        number = 2000
+
+    cores = multiprocessing.cpu_count()
+
+    print "Generating %d claims..." % number
+    claims = generate_claims(number)
+
+    # each result must be computed, not taken from the verification cache
+    signature.verification_cache.clear()
+
+    print "%-20s %12s" % ("mode", "claims/sec")
+
+    duration = check_with_threads(claims, 5)
+    print "%-20s %12.1f" % ("5 threads", number/duration)
+
+    for processes in xrange(1, cores+1):
+        signature.verification_cache.clear()
+        duration = check_with_pool(claims, processes)
+        print "%-20s %12.1f" % ("%d processes" % processes, number/duration)
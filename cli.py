@@ -10,18 +10,24 @@ if __name__=="__main__":
 
     import optparse, sys
     import socket, time
+    import multiprocessing
 
     from sduds.context import Context
     from sduds.application import *
+    from sduds.lib import instrumentedlock, signature
 
     parser = optparse.OptionParser(
-        usage = "%prog  [-p WEBSERVER_PORT] [-s SYNCHRONIZATION_PORT] [-f FQDN] [PARTNER]",
+        usage = "%prog  [-p WEBSERVER_PORT] [-s SYNCHRONIZATION_PORT] [-m MONITORING_PORT] [-f FQDN] [PARTNER]",
         description="run a sduds server or connect manually to another one"
     )
 
     parser.add_option( "-p", "--webserver-port", metavar="PORT", dest="webserver_port", help="the webserver port of the own server")
     parser.add_option( "-s", "--synchronization-port", metavar="PORT", dest="synchronization_port", help="the synchronization port of the own server")
     parser.add_option( "-f", "--fqdn", metavar="FQDN", dest="fqdn", help="the fully qualified domain name of the system")
+    parser.add_option( "-v", "--validation-processes", metavar="NUMBER", dest="validation_processes", help="the number of processes checking claims, 0 to check them in the worker threads")
+    parser.add_option( "-w", "--web-server", metavar="SERVER", dest="web_server", default="async", help="the implementation of the web server, async (default) or threading")
+    parser.add_option( "-m", "--monitoring-port", metavar="PORT", dest="monitoring_port", help="serve /metrics and /synchronizations on this port of localhost, disabled by default")
+    parser.add_option( "-l", "--instrument-locks", action="store_true", dest="instrument_locks", default=False, help="measure the contention of the database locks (toggled by SIGUSR1)")
 
     (options, args) = parser.parse_args()
 
@@ -41,13 +47,46 @@ if __name__=="__main__":
         print >>sys.stderr, "Invalid synchronization port."
         sys.exit(1)
 
+    try:
+        validation_processes = int(options.validation_processes)
+    except TypeError:
+        validation_processes = 0
+    except ValueError:
+        print >>sys.stderr, "Invalid number of validation processes."
+        sys.exit(1)
+
+    try:
+        monitoring_port = int(options.monitoring_port)
+    except TypeError:
+        monitoring_port = None
+    except ValueError:
+        print >>sys.stderr, "Invalid monitoring port."
+        sys.exit(1)
+
+    if not options.web_server in ("async", "threading"):
+        print >>sys.stderr, "Invalid web server."
+        sys.exit(1)
+
+    if options.instrument_locks:
+        instrumentedlock.enable()
+
     interface = "localhost"
 
-    context = Context(partnerdb_path="partners.sqlite", statedb_path="states.sqlite", hashtrie_path="PTree")
+    # the processes of the pool must be forked before the hash trie manager is started and
+    # the databases are opened, so that they do not inherit their pipes and connections
+    if validation_processes>0:
+        validation_pool = multiprocessing.Pool(validation_processes, signature.disable_verification_cache)
+    else:
+        validation_pool = None
+
+    context = Context(partnerdb_path="partners.sqlite", statedb_path="states.sqlite", hashtrie_path="PTree", queue_path="queues.sqlite", trace_path="synchronizations.jsonl")
     sduds = Application(context)
 
-    sduds.configure_workers()
-    sduds.configure_web_server(interface, webserver_port)
+    sduds.configure_workers(validation_pool=validation_pool)
+    sduds.configure_web_server(interface, webserver_port, options.web_server)
+
+    if monitoring_port is not None:
+        sduds.configure_monitoring_server("localhost", monitoring_port, options.web_server)
 
     if len(args)>0:
         ### initiate connection if a partner is passed
@@ -101,5 +140,23 @@ if __name__=="__main__":
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGHUP, signal_handler)
 
+        # toggle the lock instrumentation at runtime
+        def toggle_handler(sig, frame):
+            if instrumentedlock.enabled:
+                instrumentedlock.disable()
+            else:
+                instrumentedlock.enable()
+
+            print >>sys.stderr, "Lock instrumentation %s." % ("enabled" if instrumentedlock.enabled else "disabled")
+
+        signal.signal(signal.SIGUSR1, toggle_handler)
+
+        # load the partners again after they were changed with manage_partners.py
+        def reload_handler(sig, frame):
+            context.partnerdb.reload_partners()
+            print >>sys.stderr, "Partners reloaded."
+
+        signal.signal(signal.SIGUSR2, reload_handler)
+
         # wait until program is interrupted
         while True: time.sleep(100)
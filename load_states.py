@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+if __name__=="__main__":
+    import optparse, sys, time
+
+    from sduds.statedatabase import dump
+
+    parser = optparse.OptionParser(
+        usage = "%prog [-s PATH] [-t PATH] [-f FORMAT] DUMP_FILE\nOr: %prog -g NUMBER -k KEY_FILE [-f FORMAT] [DUMP_FILE]\nOr: %prog [-s PATH] [-t PATH] -e SNAPSHOT_FILE",
+        description="load states or a snapshot into the state database, export a snapshot, or generate a dump of synthetic states"
+    )
+
+    parser.add_option( "-s", "--statedb-path", metavar="PATH", dest="statedb_path", default="states.sqlite", help="the state database path")
+    parser.add_option( "-t", "--hashtrie-path", metavar="PATH", dest="hashtrie_path", default="PTree", help="the hash trie path")
+    parser.add_option( "-f", "--format", metavar="FORMAT", dest="format", help="ndjson, csv or snapshot, by default guessed from the file name")
+    parser.add_option( "-e", "--export", action="store_true", dest="export", help="write a snapshot of the state database to SNAPSHOT_FILE")
+    parser.add_option( "-g", "--generate", metavar="NUMBER", dest="generate", help="write NUMBER synthetic states to DUMP_FILE, or load them if no file is given")
+    parser.add_option( "-k", "--key", metavar="KEY_FILE", dest="key", help="the private key of the CAPTCHA provider to sign the synthetic states, needed with --generate")
+    parser.add_option( "-c", "--check", action="store_true", dest="check", default=False, help="verify the CAPTCHA signatures of the loaded states, which are trusted otherwise")
+    parser.add_option( "-b", "--batch-size", metavar="NUMBER", dest="batch_size", help="the number of states inserted per transaction")
+
+    (options, args) = parser.parse_args()
+
+    try:
+        batch_size = int(options.batch_size or 0)
+    except ValueError:
+        print >>sys.stderr, "ERROR: Invalid batch size."
+        sys.exit(1)
+
+    # the opened dump file, closed after loading
+    dump_file = None
+
+    if len(args)>1:
+        print >>sys.stderr, "ERROR: Too many arguments."
+        sys.exit(1)
+
+    path = args[0] if args else None
+
+    file_format = options.format
+    if file_format is None and path:
+        if path.endswith(".csv"):
+            file_format = "csv"
+        elif path.endswith(".snapshot"):
+            file_format = "snapshot"
+        else:
+            file_format = "ndjson"
+
+    if not file_format in ("ndjson", "csv", "snapshot", None):
+        print >>sys.stderr, "ERROR: Invalid format."
+        sys.exit(1)
+
+    if options.export:
+        if not path:
+            print >>sys.stderr, "ERROR: Need snapshot file."
+            sys.exit(1)
+
+        from sduds.statedatabase.sqlite import StateDatabase
+
+        statedb = StateDatabase(options.hashtrie_path, options.statedb_path)
+
+        try:
+            number_of_states, number_of_ghosts = statedb.export_snapshot(path)
+        finally:
+            statedb.close()
+
+        print "Wrote %d states and %d ghosts to %s." % (number_of_states, number_of_ghosts, path)
+        sys.exit(0)
+
+    if options.generate:
+        if file_format=="snapshot":
+            print >>sys.stderr, "ERROR: Synthetic states cannot be written as snapshot."
+            sys.exit(1)
+
+        try:
+            number = int(options.generate)
+        except ValueError:
+            print >>sys.stderr, "ERROR: Invalid number of states."
+            sys.exit(1)
+
+        if not options.key:
+            print >>sys.stderr, "ERROR: Need key file."
+            sys.exit(1)
+
+        with open(options.key) as f:
+            private_key_block = f.read()
+
+        states = dump.generate_states(number, private_key_block)
+
+        if path:
+            with open(path, "w") as f:
+                if file_format=="csv":
+                    written = dump.write_csv(states, f)
+                else:
+                    written = dump.write_ndjson(states, f)
+
+            print "Wrote %d states to %s." % (written, path)
+            sys.exit(0)
+
+    elif path and file_format=="snapshot":
+        states = None
+
+    elif path:
+        dump_file = open(path)
+
+        if file_format=="csv":
+            states = dump.read_csv(dump_file)
+        else:
+            states = dump.read_ndjson(dump_file)
+
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    from sduds.statedatabase.sqlite import StateDatabase
+    from sduds.constants import BULK_LOAD_BATCH_SIZE
+
+    if batch_size<=0:
+        batch_size = BULK_LOAD_BATCH_SIZE
+
+    try:
+        statedb = StateDatabase(options.hashtrie_path, options.statedb_path)
+
+        start = time.time()
+
+        try:
+            if states is None:
+                loaded, skipped, ghosts = statedb.import_snapshot(path, batch_size, options.check)
+                print "Loaded %d ghosts." % ghosts
+            else:
+                loaded, skipped = statedb.bulk_load(states, batch_size, options.check)
+        except ValueError, e:
+            print >>sys.stderr, "ERROR: %s" % str(e)
+            sys.exit(1)
+        finally:
+            statedb.close()
+    finally:
+        if dump_file: dump_file.close()
+
+    duration = time.time() - start
+
+    print "Loaded %d states in %.1f seconds (%.0f states/sec), skipped %d." % (loaded, duration, loaded/max(duration, 0.001), skipped)
@@ -2,7 +2,7 @@
 
 if __name__=="__main__":
     import optparse, sys, random
-    import getpass
+    import getpass, atexit
 
     from sduds.partners import *
     from sduds.lib import scheduler
@@ -40,6 +40,9 @@ if __name__=="__main__":
 
     database = PartnerDatabase(database_path)
 
+    # write the pending control samples and stop the flusher thread, also after sys.exit()
+    atexit.register(database.close)
+
     if options.cleanup:
         database.cleanup()
 
@@ -2,18 +2,25 @@
 
 import threading
 import socket
+import multiprocessing
 
 from constants import *
 
-from lib import scheduler, authentication
+from lib import scheduler, authentication, signature
 from lib.threadingserver import ThreadingServer
+from lib.metrics import registry
 
 from webserver import WebServer
 from context import Context
+from synchronization import CATCH_UP_EXTENSION
+
+running_workers = registry.gauge("workers", "Number of running workers.", ["worker"])
 
 class SynchronizationRequestHandler(authentication.AuthenticatingRequestHandler):
     """ Authenticates partners and calls synchronize_as_server if successful. """
 
+    extensions = (CATCH_UP_EXTENSION,)
+
     def get_password(self, partner_name):
         context = self.server.context
         partner = context.partnerdb.get_partner(partner_name)
@@ -31,7 +38,7 @@ class SynchronizationRequestHandler(authentication.AuthenticatingRequestHandler)
         context = self.server.context
         partnersocket = self.request
 
-        context.synchronize_as_server(partnersocket, partner_name)
+        context.synchronize_as_server(partnersocket, partner_name, CATCH_UP_EXTENSION in self.agreed_extensions)
 
 class SynchronizationServer(threading.Thread):
     """ Waits for partners to synchronize. """
@@ -77,14 +84,17 @@ class Application:
     ready_for_synchronization = None
 
     web_server = None
+    monitoring_server = None
     synchronization_server = None
 
+    scheduler = None
     synchronization_jobs = None
     statedb_cleanup_job = None
     partnerdb_cleanup_job = None
 
     submission_workers = None
     validation_workers = None
+    validation_pool = None
     assimilation_worker = None
 
     def __init__(self, context):
@@ -98,22 +108,45 @@ class Application:
         self.submission_workers = []
         self.validation_workers = []
 
-    def configure_web_server(self, interface="", port=20000):
-        self.web_server = WebServer(self.context, interface, port)
+    def configure_web_server(self, interface="", port=20000, server="async"):
+        self.web_server = WebServer(self.context, interface, port, server)
+
+    def configure_monitoring_server(self, interface="localhost", port=20002, server="async"):
+        """ The monitoring server serves /metrics and /synchronizations, which are not
+            served by the public web server. It is only started if it was configured. """
+
+        self.monitoring_server = WebServer(self.context, interface, port, server, monitoring=True)
 
     def configure_synchronization_server(self, fqdn, interface="", port=20001):
         self.synchronization_server = SynchronizationServer(self.context, fqdn, interface, port)
 
-    def configure_workers(self, submission_workers=5, validation_workers=5):
+    def configure_workers(self, submission_workers=5, validation_workers=5, validation_processes=0, validation_batch_size=VALIDATION_BATCH_SIZE, validation_pool=None):
+        """ If validation_pool is given, or validation_processes is positive, the
+            validation workers send the checks of the claims to a pool of processes,
+            which is closed by terminate_workers. The pool should be created before
+            the context, so that its processes do not inherit the pipes of the hash
+            trie manager and the database connections; a pool of validation_processes
+            processes is created here otherwise. """
+
         # submission workers
         for i in xrange(submission_workers):
             worker = threading.Thread(target=self.context.submission_worker)
             self.submission_workers.append(worker)
 
         # validation workers
-        for i in xrange(validation_workers):
-            worker = threading.Thread(target=self.context.validation_worker)
-            self.validation_workers.append(worker)
+        if validation_pool is None and validation_processes>0:
+            validation_pool = multiprocessing.Pool(validation_processes, signature.disable_verification_cache)
+
+        if validation_pool:
+            self.validation_pool = validation_pool
+
+            for i in xrange(validation_workers):
+                worker = threading.Thread(target=self.context.validation_batch_worker, args=(self.validation_pool, validation_batch_size))
+                self.validation_workers.append(worker)
+        else:
+            for i in xrange(validation_workers):
+                worker = threading.Thread(target=self.context.validation_worker)
+                self.validation_workers.append(worker)
 
         # assimilation worker
         self.assimilation_worker = threading.Thread(target=self.context.assimilation_worker)
@@ -140,7 +173,8 @@ class Application:
                 self.ready_for_synchronization.set()
                 return timestamp
 
-            self.statedb_cleanup_job = scheduler.Job(pattern, callback, (self,), last_cleanup)
+            # the synchronization jobs wait for the cleanup, so it must not queue up behind them
+            self.statedb_cleanup_job = scheduler.Job(pattern, callback, (self,), last_cleanup, priority=-1)
 
         # add partner database cleanup job
         if partnerdb_cleanup:
@@ -161,6 +195,19 @@ class Application:
         self.web_server.terminate()
         self.web_server = None
 
+    def start_monitoring_server(self, *args, **kwargs):
+        # use arguments to configure monitoring server
+        if args or kwargs:
+            self.configure_monitoring_server(*args, **kwargs)
+
+        self.monitoring_server.start()
+
+    def terminate_monitoring_server(self):
+        if not self.monitoring_server: return
+
+        self.monitoring_server.terminate()
+        self.monitoring_server = None
+
     def start_synchronization_server(self, *args, **kwargs):
         # use arguments to configure synchronization server
         if args or kwargs:
@@ -190,7 +237,18 @@ class Application:
         # start assimilation worker
         self.assimilation_worker.start()
 
+        # the submission workers retrieve the control samples of the validation workers
+        if self.submission_workers:
+            self.context.defer_control_samples(True)
+
+        running_workers.set(len(self.submission_workers), "submission")
+        running_workers.set(len(self.validation_workers), "validation")
+        running_workers.set(1, "assimilation")
+
     def terminate_workers(self):
+        # validation workers must not queue control samples behind the terminators
+        self.context.defer_control_samples(False)
+
         # terminate submission workers
         for worker in self.submission_workers:
             self.context.submission_queue.put(None)
@@ -209,24 +267,36 @@ class Application:
 
         self.validation_workers = []
 
+        if self.validation_pool:
+            self.validation_pool.close()
+            self.validation_pool.join()
+            self.validation_pool = None
+
         # terminate assimilation worker
         if self.assimilation_worker:
             self.context.assimilation_queue.put(None)
             self.assimilation_worker.join()
             self.assimilation_worker = None
 
-    def start_jobs(self):
-        # go through servers, add jobs
-        for job in self.synchronization_jobs:
-            job.start()
+        running_workers.replace({})
+
+    def start_jobs(self, scheduler_workers=SCHEDULER_WORKERS):
+        # all jobs share the threads of one scheduler
+        self.scheduler = scheduler.Scheduler(scheduler_workers)
 
         job = self.statedb_cleanup_job
         if job:
             if not job.overdue(): self.ready_for_synchronization.set()
-            job.start()
+            job.start(self.scheduler)
+
+        # go through servers, add jobs
+        for job in self.synchronization_jobs:
+            job.start(self.scheduler)
 
         job = self.partnerdb_cleanup_job
-        if job: job.start()
+        if job: job.start(self.scheduler)
+
+        self.scheduler.start()
 
     def terminate_jobs(self):
         for job in self.synchronization_jobs:
@@ -242,12 +312,21 @@ class Application:
             self.partnerdb_cleanup_job.terminate()
         self.partnerdb_cleanup_job = None
 
+        if self.scheduler:
+            self.scheduler.terminate()
+        self.scheduler = None
+
     def start(self, web_server=True, synchronization_server=True, jobs=True, workers=True):
         if web_server:
             self.context.logger.info("Starting web server...")
             self.start_web_server()
             self.context.logger.info("Web server started.")
 
+        if web_server and self.monitoring_server:
+            self.context.logger.info("Starting monitoring server...")
+            self.start_monitoring_server()
+            self.context.logger.info("Monitoring server started.")
+
         if jobs:
             self.context.logger.info("Starting jobs...")
             self.start_jobs()
@@ -269,6 +348,8 @@ class Application:
     def terminate(self, erase=False):
         self.context.logger.info("Terminating web server...")
         self.terminate_web_server()
+        self.context.logger.info("Terminating monitoring server...")
+        self.terminate_monitoring_server()
         self.context.logger.info("Terminating synchronization server...")
         self.terminate_synchronization_server()
         self.context.logger.info("Terminating jobs...")
@@ -314,7 +395,7 @@ class Application:
 
         # authentication
         try:
-            success = authentication.authenticate_socket(partnersocket, partner.provide_username, partner.provide_password)
+            success, extensions = authentication.authenticate_socket_with_extensions(partnersocket, partner.provide_username, partner.provide_password, (CATCH_UP_EXTENSION,))
         except Exception, e:
             self.context.logger.warning("Unable to authenticate to partner %s for synchronization: %s" % (partner_name, str(e)))
             return timestamp
@@ -325,7 +406,7 @@ class Application:
 
         # conduct synchronization
         try:
-            self.context.synchronize_as_client(partnersocket, partner_name)
+            self.context.synchronize_as_client(partnersocket, partner_name, CATCH_UP_EXTENSION in extensions)
         except Exception, e:
             self.context.logger.warning("Unable to synchronize with partner %s: %s" % (partner_name, str(e)))
 
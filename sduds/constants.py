@@ -14,6 +14,7 @@ PROFILE_LIFETIME = 3600*24*365
 
 SAMPLE_SUMMARY_INTERVAL = 3600*24
 CONTROL_SAMPLE_WINDOW = 14
+CONTROL_SAMPLE_FLUSH_INTERVAL = 60 # seconds after which new control samples are written to the database
 
 MAX_FAILED_PERCENTAGE = 20
 SIGNIFICANCE_THRESHOLD = 30
@@ -32,4 +33,29 @@ MAX_COUNTRY_CODE_LENGTH = 2
 MAX_SERVICES_LENGTH = 1024
 MAX_SERVICE_LENGTH = 16
 
+HTTP_MAX_IDLE_PER_HOST = 4 # persistent connections kept per pod for profile retrieval
+HTTP_MAX_IDLE = 64
+HTTP_IDLE_TIMEOUT = 30
+HOST_META_CACHE_SIZE = 10000 # number of pods for which the LRDD template is cached
+DOCUMENT_CACHE_SIZE = 10000 # number of sduds documents kept for conditional requests, each with its full body
+SEARCH_CACHE_SIZE = 1000 # number of search results kept by the state database, each with up to 50 states
+FILE_SIZE_METRICS_INTERVAL = 60 # minimal number of seconds between measurements of the database sizes for /metrics
+
+RETRIEVAL_RATE = 2.0 # profile retrievals per second and pod
+RETRIEVAL_BURST = 20 # retrievals from one pod that may be made at once
+DUPLICATE_SUBMISSION_WINDOW = 3600 # an address is retrieved at most once in this time
+VALIDATION_BATCH_SIZE = 100 # claims sent to the validation processes at once
+VALIDATION_LOCAL_WEIGHT = 10 # share of self-made claims in validation, compared to...
+VALIDATION_PARTNER_WEIGHT = 1 # ...the share of each partner
+VALIDATION_AGING = 0.1 # gain of a waiting source in the validation queue per second
+BULK_LOAD_BATCH_SIZE = 10000 # states inserted per transaction by StateDatabase.bulk_load
+CATCH_UP_MIN_DIFFERENCE = 100000 # synchronize in catch-up mode if the numbers of states differ by this...
+CATCH_UP_MAX_RATIO = 0.5 # ...and the smaller number is at most this fraction of the larger one
+WEB_SERVER_WORKERS = 8 # threads answering web requests
+WEB_SERVER_MAX_PENDING = 100 # web requests waiting for a worker, further ones get "503 Service Unavailable"
+WEB_SERVER_MAX_CONNECTIONS = 500 # open web connections, further ones wait until others are closed
+WEB_SERVER_REQUEST_TIMEOUT = 30 # seconds within which a web request must be received completely
+WEB_SERVER_KEEPALIVE_TIMEOUT = 15 # seconds after which an idle web connection is closed
+SCHEDULER_WORKERS = 8 # synchronizations and cleanups executed at once by the jobs
+
 CAPTCHA_PUBLIC_KEY = "AAAAB3NzaC1yc2EAAAABIwAAAQEAyxhRjXXXmTxI3c8IqAsbw+idaXfwWkkiVE0/9jn1oVFdYsIQqm+7rkdcjVPa8zJnoYPYupCbMX0TB7hIrLOfQcQzb9PRLZ9KSCbY6Q7tShSylOO9aaNtG2Q+iHvpckNFp/dThdUDK7YqcYcPtQQFVsDPToehrbbCvHZm2wHRB614u8jZVXe+jnxmxFxdTIg2TxICbqHc3OAb2w8FS62U5yI5x/dZS1zVNW0exdci7BZYOZv/5xw5dd2zsQxiXA5n/Hs+F6Xn7LUKBh6cqEkwuvvQhoO9ieDt5V6nzJPJMHKZtW7TFYZKt3C/3wtoHOPSsZMUVvIcSKjRHd5xOddJvQ==" #TODO: only for testing
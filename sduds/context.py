@@ -1,21 +1,48 @@
 #!/usr/bin/env python
 
-import logging, time, Queue
+import logging, time, Queue, threading, collections, os
 
-from states import State
+from constants import *
+from states import StateRecord
 from statedatabase.sqlite import StateDatabase
 from partners import PartnerDatabase
-from synchronization import Synchronization
+from synchronization import Synchronization, catch_up
+from lib.domainqueue import DomainQueue, RateLimiter
+from lib.diskqueue import DiskQueue, Journal
+from lib.fairqueue import FairQueue
+from lib.metrics import registry
+from lib.synctrace import TraceLog, Session, CountingFile
+from lib import communication, signature
 
 import states # for the exceptions
 
-class Claim:
+claims_rejected = registry.counter("claims_rejected_total", "Number of rejected claims by reason.", ["reason"])
+worker_busy = registry.counter("worker_busy_seconds_total", "Time the workers spent processing items.", ["worker"])
+worker_items = registry.counter("worker_items_total", "Number of items processed by the workers.", ["worker"])
+addresses_coalesced = registry.counter("coalesced_total", "Number of submissions and claims coalesced with a pending one for the same address.", ["queue"])
+synchronization_duration = registry.histogram("synchronization_duration_seconds", "Duration of the phases of synchronizations.", ["partner", "phase"])
+
+queue_depth = registry.gauge("queue_depth", "Number of items in the queues.", ["queue"])
+validation_queue_depth = registry.gauge("validation_queue_depth", "Number of claims in the validation queue by source.", ["source"])
+statedb_records = registry.gauge("statedb_records", "Number of records in the state database.", ["table"])
+file_size = registry.gauge("file_size_bytes", "Size of the databases on disk.", ["database"])
+search_cache_entries = registry.gauge("search_cache_entries", "Number of search results cached by the state database.")
+
+#: Returned by :meth:`Claim.prepare` and :meth:`Claim.validate` if the control sample of
+#: the claim is retrieved through the submission queue; the claim is validated again
+#: when it returns with the retrieved state.
+CONTROL_SAMPLE_DEFERRED = "control sample deferred"
+
+def get_domain(webfinger_address):
+    """ Returns the domain of a webfinger address, used to limit the retrieval rate per pod. """
+
+    return webfinger_address.rsplit("@", 1)[-1].lower()
+
+class Claim(object):
     """ partner_name==None means that the claim is not by another server but
-        'self-made'. """
+        'self-made'. Uses __slots__ because large numbers of claims may be queued. """
 
-    timestamp = None
-    state = None
-    partner_name = None
+    __slots__ = ("timestamp", "state", "partner_name", "retrieved_state")
 
     def __init__(self, state, partner_name=None, timestamp=None):
         if timestamp is None:
@@ -26,87 +53,308 @@ class Claim:
         self.state = state
         self.partner_name = partner_name
 
+        # the state retrieved for the control sample, if it was deferred
+        self.retrieved_state = None
+
     def __cmp__(self, other):
-        """ Provides ordering of claims in the validation queue by their
-            priority. """
+        """ Orders claims by their priority, claims with higher priority first:
+            self-made claims before claims of partners, and earlier claims before
+            later ones. """
 
-        # Note: __cmp__() should return whether self>other. PriorityQueue takes
-        #       the lowest value first, so the return value is negated.
+        if other is None: return 1
 
         # entries retrieved by ourselves have higher priority
-        if self.partner_name is None: return not True
-        if other.partner_name is None: return not False
+        self_made = self.partner_name is None
+        other_self_made = other.partner_name is None
+        if self_made!=other_self_made:
+            return -1 if self_made else 1
 
         # earlier claims have higher priority
-        return not self.timestamp<other.timestamp
+        return cmp(self.timestamp, other.timestamp)
+
+    def prepare(self, partnerdb, logger, defer_sample=None):
+        """ First part of the validation: decides which state is to be trusted, taking
+            a control sample if necessary. Returns a (trusted_state, partner_name) tuple,
+            where partner_name is None if the partner is not responsible for the trusted
+            state, or None if the claim must be rejected.
+            If defer_sample is given, it is called with the claim before the control sample
+            is retrieved; if it returns True, the claim must be validated again after
+            retrieved_state was set, and CONTROL_SAMPLE_DEFERRED is returned. """
 
-    def validate(self, partnerdb, logger):
         if self.partner_name is None:
-            trusted_state = self.state
-        else:
-            partner = partnerdb.get_partner(self.partner_name)
-            logger = logger.getChild(partner_name)
+            return self.state, None
 
-            if partner.kicked: return None
+        partner_name = self.partner_name
+        partner = partnerdb.get_partner(partner_name)
+        logger = logger.getChild(partner_name)
 
-            if not partner.control_sample():
-                trusted_state = self.state
-            else:
-                retrieved_state = State.retrieve(self.state.address)
+        if partner is None or partner.kicked:
+            claims_rejected.inc("partner_kicked")
+            return None
 
-                reference_timestamp = int(time.time())
+        if self.retrieved_state:
+            retrieved_state = self.retrieved_state
+        elif not partner.control_sample():
+            return self.state, partner_name
+        elif defer_sample and defer_sample(self):
+            return CONTROL_SAMPLE_DEFERRED
+        else:
+            retrieved_state = StateRecord.retrieve(self.state.address)
 
-                if self.state==retrieved_state:
-                    failed_address = None
-                else:
-                    failed_address = self.state.address
+        reference_timestamp = int(time.time())
 
-                    log_message = "Claimed state:\n"+\
-                                  "==============\n"+\
-                                  str(self.state)+"%s\n"+\
-                                  "\n"+\
-                                  "Retrieved state:\n"+\
-                                  "================\n"+\
-                                  str(retrieved_state)
-                    logger.warning(log_message)
+        if self.state==retrieved_state:
+            failed_address = None
+            trusted_state = self.state
+        else:
+            failed_address = self.state.address
 
-                    trusted_state = retrieved_state
-                    partner_name = None
+            log_message = "Claimed state:\n"+\
+                          "==============\n"+\
+                          str(self.state)+"\n"+\
+                          "\n"+\
+                          "Retrieved state:\n"+\
+                          "================\n"+\
+                          str(retrieved_state)
+            logger.warning(log_message)
 
-                partnerdb.register_control_sample(partner_name, reference_timestamp, failed_address)
+            trusted_state = retrieved_state
 
-        try:
-            trusted_state.check(self.timestamp)
-        except states.CheckFailed, e:
-            if partner_name:
-                partnerdb.register_malformed_state(partner_name)
-                logger.warning(str(e))
-            return None
-        except states.RecentlyExpiredStateException, e:
-            logger.warning(str(e))
-            return None
+        partnerdb.register_control_sample(partner_name, reference_timestamp, failed_address)
+
+        if failed_address:
+            # we retrieved the state ourselves, so the partner is not responsible
+            return trusted_state, None
         else:
+            return trusted_state, partner_name
+
+    def conclude(self, trusted_state, partner_name, check_result, partnerdb, logger):
+        """ Last part of the validation: handles the result of :func:`check_state`.
+            Returns the trusted state, or None if the claim is rejected. """
+
+        if check_result is None:
             return trusted_state
 
-class Submission:
-    webfinger_address = None
+        failure, message = check_result
+        claims_rejected.inc(failure)
+
+        if self.partner_name:
+            logger = logger.getChild(self.partner_name)
+
+        if failure=="malformed" and partner_name:
+            partnerdb.register_malformed_state(partner_name)
+
+        logger.warning(message)
+        return None
+
+    def validate(self, partnerdb, logger, defer_sample=None):
+        prepared = self.prepare(partnerdb, logger, defer_sample)
+        if prepared is None or prepared is CONTROL_SAMPLE_DEFERRED: return prepared
+
+        trusted_state, partner_name = prepared
+        check_result = check_state(trusted_state, self.timestamp)
+
+        return self.conclude(trusted_state, partner_name, check_result, partnerdb, logger)
+
+def check_state(state, reference_timestamp, signature_checked=False):
+    """ Runs State.check and returns None if the state is okay, otherwise a
+        (failure, message) tuple with failure being "malformed" or "expired". """
+
+    try:
+        state.check(reference_timestamp, signature_checked)
+    except states.CheckFailed, e:
+        return "malformed", str(e)
+    except states.RecentlyExpiredProfileException, e:
+        return "expired", str(e)
+    else:
+        return None
+
+def state_data(state):
+    """ Converts a state to a tuple of built-in types, so that it can be sent to
+        another process cheaply. """
+
+    if state.profile is None:
+        return state.address, state.retrieval_timestamp, None
+    else:
+        return state.address, state.retrieval_timestamp, state.profile.__composite_values__()
+
+def check_state_data(arguments):
+    """ Counterpart of state_data, executed in the processes of the validation
+        pool: reconstructs the state and calls check_state. """
+
+    (address, retrieval_timestamp, profile_values), reference_timestamp, signature_checked = arguments
+
+    if profile_values is None:
+        profile = None
+    else:
+        profile = states.Profile(*profile_values)
+
+    state = StateRecord(address, retrieval_timestamp, profile)
+
+    return check_state(state, reference_timestamp, signature_checked)
+
+def signature_cached(state):
+    """ Whether the CAPTCHA signature of a state is known to be valid from the
+        verification cache of this process. """
+
+    if state.profile is None: return False
+
+    return signature.cached_verification(CAPTCHA_PUBLIC_KEY, state.profile.captcha_signature, state.address) is True
+
+def cache_signature(state, check_result):
+    """ Caches the CAPTCHA signature of a state checked in another process as valid,
+        if the check got past the signature: it succeeded or only found the profile
+        expired. """
+
+    if state.profile is None: return
 
-    def __init__(self, webfinger_address):
+    if check_result is None or check_result[0]=="expired":
+        signature.cache_verification(CAPTCHA_PUBLIC_KEY, state.profile.captcha_signature, state.address, True)
+
+def claim_source(claim):
+    """ The source of a claim in the validation queue: the partner name, or None for
+        self-made claims. """
+
+    return claim.partner_name
+
+def source_weight(partner_name):
+    """ The weight of a source in the validation queue. """
+
+    if partner_name is None:
+        return VALIDATION_LOCAL_WEIGHT
+    else:
+        return VALIDATION_PARTNER_WEIGHT
+
+class Submission(object):
+    """ An address to be retrieved. If claim is given, the retrieved state is the
+        control sample of the claim. """
+
+    __slots__ = ("webfinger_address", "claim")
+
+    def __init__(self, webfinger_address, claim=None):
         self.webfinger_address = webfinger_address
+        self.claim = claim
+
+class PendingAddresses:
+    """ Keeps track of the addresses which are queued for processing, to coalesce
+        duplicate submissions or claims. After processing, an address is kept for
+        a further window of time, during which it is still regarded as pending. """
+
+    lock = None
+    queued = None
+    newest = None
+    finished = None
+    window = None
+    name = None
+
+    coalesced = None
+
+    def __init__(self, window=0, name=""):
+        self.lock = threading.Lock()
+        self.window = window
+
+        # label of the coalesced_total metric
+        self.name = name
+
+        # maps addresses to the number of times they are queued
+        self.queued = {}
+
+        # maps queued addresses to the newest timestamp they were queued with
+        self.newest = {}
+
+        # maps processed addresses to the time of processing, oldest first
+        self.finished = collections.OrderedDict()
+
+        # number of rejected duplicates
+        self.coalesced = 0
+
+    def _expire(self, now):
+        while self.finished:
+            address, timestamp = next(self.finished.iteritems())
+            if timestamp + self.window > now: break
+
+            del self.finished[address]
+
+    def add(self, address, force=False, now=None, timestamp=None):
+        """ Marks an address as queued. Returns False if the address is pending
+            already, unless force is set or timestamp, e.g. the retrieval timestamp
+            of a claimed state, is newer than all timestamps it is queued with. """
+
+        if now is None: now = time.time()
+
+        with self.lock:
+            self._expire(now)
+
+            if not force and (address in self.queued or address in self.finished):
+                if timestamp is None or timestamp<=self.newest.get(address, timestamp):
+                    self.coalesced += 1
+                    addresses_coalesced.inc(self.name)
+                    return False
+
+            self.queued[address] = self.queued.get(address, 0) + 1
+
+            if timestamp is not None:
+                self.newest[address] = max(timestamp, self.newest.get(address, timestamp))
+
+            return True
+
+    def finish(self, address, now=None):
+        """ Called after an address was processed. """
+
+        if now is None: now = time.time()
+
+        with self.lock:
+            self._discard(address)
+
+            if self.window>0:
+                self.finished.pop(address, None)
+                self.finished[address] = now
+
+    def _discard(self, address):
+        count = self.queued.get(address, 0) - 1
+        if count>0:
+            self.queued[address] = count
+        else:
+            self.queued.pop(address, None)
+            self.newest.pop(address, None)
+
+    def discard(self, address):
+        """ Called if an address could not be queued after all. """
+
+        with self.lock:
+            self._discard(address)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queued) + len(self.finished)
 
 class Context:
     statedb = None
     partnerdb = None
 
+    retrieval_limiter = None
+
+    deferral_lock = None
+    deferring_control_samples = None
+
     submission_queue = None
     validation_queue = None
     assimilation_queue = None
 
+    pending_submissions = None
+    pending_claims = None
+
     synchronization_address = None
 
+    #: The :class:`~sduds.lib.synctrace.TraceLog` the synchronizations are recorded in, or ``None``.
+    trace_log = None
+
+    # when the sizes of the databases were last measured for the metrics
+    file_sizes_timestamp = None
+
     logger = None
 
-    def __init__(self, statedb=None, partnerdb=None, submission_queue_size=500, validation_queue_size=500, assimilation_queue_size=500, **kwargs):
+    def __init__(self, statedb=None, partnerdb=None, submission_queue_size=500, validation_queue_size=500, assimilation_queue_size=500, retrieval_rate=RETRIEVAL_RATE, retrieval_burst=RETRIEVAL_BURST, **kwargs):
         if statedb:
             self.statedb = statedb
         else:
@@ -122,102 +370,265 @@ class Context:
         else:
             self.partnerdb = PartnerDatabase(kwargs["partnerdb_path"])
 
-        self.submission_queue = Queue.Queue(submission_queue_size)
-        self.validation_queue = Queue.PriorityQueue(validation_queue_size)
-        self.assimilation_queue = Queue.Queue(assimilation_queue_size)
+        # submissions are handed out to the workers round-robin by domain, with the
+        # retrieval rate per domain limited; control samples are retrieved through the
+        # submission queue as well, so that no validation worker waits for a token
+        self.retrieval_limiter = RateLimiter(retrieval_rate, retrieval_burst)
+
+        self.deferral_lock = threading.Lock()
+        self.deferring_control_samples = False
+        submission_domain = lambda submission: get_domain(submission.webfinger_address)
+
+        if kwargs.get("queue_path"):
+            # the queues are kept on disk, so they are never full and survive restarts;
+            # the queue sizes are the numbers of items kept in memory
+            queue_path = kwargs["queue_path"]
+            self.submission_queue = DomainQueue(submission_domain, self.retrieval_limiter, journal=Journal(queue_path, "submissions"), memory_size=submission_queue_size)
+            self.validation_queue = FairQueue(claim_source, source_weight, VALIDATION_AGING, journal=Journal(queue_path, "claims"), memory_size=validation_queue_size)
+            self.assimilation_queue = DiskQueue(Journal(queue_path, "states"), assimilation_queue_size)
+        else:
+            self.submission_queue = DomainQueue(submission_domain, self.retrieval_limiter, submission_queue_size)
+            self.validation_queue = FairQueue(claim_source, source_weight, VALIDATION_AGING, validation_queue_size)
+            self.assimilation_queue = Queue.Queue(assimilation_queue_size)
+
+        # coalesce duplicate submissions and claims for the same address
+        self.pending_submissions = PendingAddresses(DUPLICATE_SUBMISSION_WINDOW, "submission")
+        self.pending_claims = PendingAddresses(name="claim")
+
+        if kwargs.get("trace_path"):
+            self.trace_log = TraceLog(kwargs["trace_path"])
+
+        registry.add_collector(self.collect_metrics)
 
         logger_name = "context"
         if "log" in kwargs:
             logger_name += ".%s" % kwargs["log"]
         self.logger = logging.getLogger(logger_name)
 
+    def collect_metrics(self):
+        """ Updates the gauges of the queue depths and database sizes before the metrics
+            are rendered. The sizes of the database files are measured at most every
+            FILE_SIZE_METRICS_INTERVAL seconds. """
+
+        queue_depth.set(self.submission_queue.qsize(), "submission")
+        queue_depth.set(self.validation_queue.qsize(), "validation")
+        queue_depth.set(self.assimilation_queue.qsize(), "assimilation")
+
+        depths = self.validation_queue.depths()
+        validation_queue_depth.replace(dict(((source or "local",), depth) for source, depth in depths.iteritems()))
+
+        states_count, ghosts_count = self.statedb.count()
+        statedb_records.set(states_count, "states")
+        statedb_records.set(ghosts_count, "ghosts")
+
+        search_cache_entries.set(len(self.statedb.search_cache))
+
+        now = time.time()
+        if self.file_sizes_timestamp is not None and now - self.file_sizes_timestamp < FILE_SIZE_METRICS_INTERVAL:
+            return
+
+        self.file_sizes_timestamp = now
+
+        if os.path.exists(self.statedb.database_path):
+            file_size.set(os.path.getsize(self.statedb.database_path), "statedb")
+
+        hashtrie_size = 0
+        for directory, subdirectories, filenames in os.walk(self.statedb.hashtrie_path):
+            hashtrie_size += sum(os.path.getsize(os.path.join(directory, filename)) for filename in filenames)
+        file_size.set(hashtrie_size, "hashtrie")
+
     def close(self, erase=False):
-        self.submission_queue.join()
-        self.validation_queue.join()
-        self.assimilation_queue.join()
+        registry.remove_collector(self.collect_metrics)
+
+        if isinstance(self.assimilation_queue, DiskQueue):
+            # queued items are kept for the next start
+            self.submission_queue.close()
+            self.validation_queue.close()
+            self.assimilation_queue.close()
+        else:
+            self.submission_queue.join()
+            self.validation_queue.join()
+            self.assimilation_queue.join()
 
         self.statedb.close(erase=erase)
         self.partnerdb.close()
 
+        if self.trace_log:
+            self.trace_log.close()
+
     def submit_address(self, webfinger_address):
+        if not self.pending_submissions.add(webfinger_address):
+            self.logger.debug("Address %s is already pending." % webfinger_address)
+            return True
+
         try:
             submission = Submission(webfinger_address)
             self.submission_queue.put(submission)
             return True
         except Queue.Full:
+            self.pending_submissions.discard(webfinger_address)
             self.logger.warning("Submission queue full, rejected %s!" % webfinger_address)
             return False
 
     def process_state(self, state, partner_name, reference_timestamp):
+        """ Puts a state received from a partner into the validation or submission queue.
+            Returns ``False`` if it was dropped because the queue is full. """
+
         if state.retrieval_timestamp:
-            # if partner does take over responsibility, submit claim to validation queue
+            # if partner does take over responsibility, submit claim to validation queue,
+            # unless a claim for the address with the same or a newer state is pending
+            if not self.pending_claims.add(state.address, timestamp=state.retrieval_timestamp):
+                self.logger.debug("Claim for %s by %s coalesced with pending claim." % (state.address, partner_name))
+                return True
+
             claim = Claim(state, partner_name, reference_timestamp)
 
             try:
                 self.validation_queue.put(claim)
                 self.logger.debug("State received from %s was put in validation queue" % partner_name)
             except Queue.Full:
+                self.pending_claims.discard(state.address)
                 self.logger.warning("Validation queue full while synchronizing with %s!" % partner_name)
+                return False
         else:
             # if partner does not take over responsibility, simply submit the address for retrieval
+            if not self.pending_submissions.add(state.address):
+                self.logger.debug("Address %s by %s is already pending." % (state.address, partner_name))
+                return True
+
             submission = Submission(state.address)
             try:
                 self.submission_queue.put(submission)
                 self.logger.debug("Address by %s was put in submission queue." % partner_name)
             except Queue.Full:
+                self.pending_submissions.discard(state.address)
                 self.logger.warning("Submission queue full while synchronizing with %s!" % partner_name)
+                return False
 
-    def synchronize_as_server(self, partnersocket, partner_name):
-        missing_hashes = self.statedb.hashtrie.get_missing_hashes_as_server(partnersocket)
+        return True
 
-        synchronization = Synchronization(missing_hashes)
+    def _start_session(self, partnersocket, partner_name, role):
+        """ Returns a :class:`~sduds.lib.synctrace.Session` recording a synchronization. """
 
-        f = partnersocket.makefile()
+        f = CountingFile(partnersocket.makefile())
 
-        self.logger.debug("receive deletion requests")
-        synchronization.receive_deletion_requests(f, self.statedb)
-        self.logger.debug("send deletion requests")
-        synchronization.send_deletion_requests(f, self.statedb)
+        def observe_phase(phase):
+            synchronization_duration.observe(phase.duration, partner_name, phase.name)
 
-        self.logger.debug("receive state requests")
-        synchronization.receive_state_requests(f)
-        self.logger.debug("send states")
-        synchronization.send_states(f, self.statedb)
+        return Session(partner_name, role, f, [observe_phase])
 
-        self.logger.debug("send state requests")
-        reference_timestamp = time.time()
-        synchronization.send_state_requests(f)
-        self.logger.debug("receive states")
-        for state in synchronization.receive_states(f):
-            self.process_state(state, partner_name, reference_timestamp)
+    def _finish_session(self, session):
+        session.f.close()
 
-        f.close()
+        if self.trace_log:
+            self.trace_log.write(session)
 
-    def synchronize_as_client(self, partnersocket, partner_name):
-        missing_hashes = self.statedb.hashtrie.get_missing_hashes_as_client(partnersocket)
+    def _receive_states(self, session, synchronization):
+        with session.phase("receive_states") as phase:
+            self.logger.debug("send state requests")
+            reference_timestamp = time.time()
+            phase.sent += synchronization.send_state_requests(session.f)
+            self.logger.debug("receive states")
+            for state in synchronization.receive_states(session.f):
+                phase.received += 1
+                if not self.process_state(state, session.partner_name, reference_timestamp):
+                    session.drops += 1
 
-        synchronization = Synchronization(missing_hashes)
+    def _send_states(self, session, synchronization):
+        with session.phase("send_states") as phase:
+            self.logger.debug("receive state requests")
+            phase.received += synchronization.receive_state_requests(session.f)
+            self.logger.debug("send states")
+            phase.sent += synchronization.send_states(session.f, self.statedb)
 
-        f = partnersocket.makefile()
+    def _catch_up(self, session, synchronization, own_size, partner_size):
+        """ Transfers all states from the partner with more states to the other one.
+            The regular synchronization follows, which transfers the deletions and
+            the states of the other partner as well as everything that changed
+            while the states were sent, but does not request the received states
+            again. """
 
-        self.logger.debug("send deletion requests")
-        synchronization.send_deletion_requests(f, self.statedb)
-        self.logger.debug("receive deletion requests")
-        synchronization.receive_deletion_requests(f, self.statedb)
+        session.mode = "catch_up"
 
-        self.logger.debug("send state requests")
-        reference_timestamp = time.time()
-        synchronization.send_state_requests(f)
-        self.logger.debug("receive states")
-        for state in synchronization.receive_states(f):
-            self.process_state(state, partner_name, reference_timestamp)
+        if own_size>partner_size:
+            with session.phase("catch_up_send") as phase:
+                self.logger.debug("send all states")
+                phase.sent += synchronization.send_all_states(session.f, self.statedb)
+        else:
+            with session.phase("catch_up_receive") as phase:
+                self.logger.debug("receive all states")
+                reference_timestamp = time.time()
+                for state in synchronization.receive_all_states(session.f, self.statedb):
+                    if not self.process_state(state, session.partner_name, reference_timestamp):
+                        session.drops += 1
+                phase.received += synchronization.received
 
-        self.logger.debug("receive state requests")
-        synchronization.receive_state_requests(f)
-        self.logger.debug("send states")
-        synchronization.send_states(f, self.statedb)
+    def synchronize_as_server(self, partnersocket, partner_name, catch_up_agreed=False):
+        """ Synchronizes with a partner that connected to us. If both partners
+            agreed on :data:`~sduds.synchronization.CATCH_UP_EXTENSION` during
+            authentication, they exchange their numbers of states and may use
+            the catch-up mode first. """
 
-        f.close()
+        session = self._start_session(partnersocket, partner_name, "server")
+        synchronization = Synchronization()
+
+        if catch_up_agreed:
+            # exchange the numbers of states to detect a large divergence
+            own_size, ghosts = self.statedb.count()
+            partner_size = communication.recv_integer(partnersocket)
+            communication.send_integer(partnersocket, own_size)
+
+            if catch_up(own_size, partner_size):
+                self._catch_up(session, synchronization, own_size, partner_size)
+
+        with session.phase("reconciliation"):
+            missing_hashes = self.statedb.hashtrie.get_missing_hashes_as_server(partnersocket)
+
+        session.missing_hashes = len(missing_hashes)
+        synchronization.missing_hashes = missing_hashes
+
+        with session.phase("deletion_requests") as phase:
+            self.logger.debug("receive deletion requests")
+            phase.received += synchronization.receive_deletion_requests(session.f, self.statedb)
+            self.logger.debug("send deletion requests")
+            phase.sent += synchronization.send_deletion_requests(session.f, self.statedb)
+
+        self._send_states(session, synchronization)
+        self._receive_states(session, synchronization)
+
+        self._finish_session(session)
+
+    def synchronize_as_client(self, partnersocket, partner_name, catch_up_agreed=False):
+        """ The counterpart of :meth:`synchronize_as_server`. """
+
+        session = self._start_session(partnersocket, partner_name, "client")
+        synchronization = Synchronization()
+
+        if catch_up_agreed:
+            # exchange the numbers of states to detect a large divergence
+            own_size, ghosts = self.statedb.count()
+            communication.send_integer(partnersocket, own_size)
+            partner_size = communication.recv_integer(partnersocket)
+
+            if catch_up(own_size, partner_size):
+                self._catch_up(session, synchronization, own_size, partner_size)
+
+        with session.phase("reconciliation"):
+            missing_hashes = self.statedb.hashtrie.get_missing_hashes_as_client(partnersocket)
+
+        session.missing_hashes = len(missing_hashes)
+        synchronization.missing_hashes = missing_hashes
+
+        with session.phase("deletion_requests") as phase:
+            self.logger.debug("send deletion requests")
+            phase.sent += synchronization.send_deletion_requests(session.f, self.statedb)
+            self.logger.debug("receive deletion requests")
+            phase.received += synchronization.receive_deletion_requests(session.f, self.statedb)
+
+        self._receive_states(session, synchronization)
+        self._send_states(session, synchronization)
+
+        self._finish_session(session)
 
     def submission_worker(self):
         while True:
@@ -228,19 +639,38 @@ class Context:
                 return
 
             self.logger.debug("Got address %s from submission queue." % submission.webfinger_address)
+            start = time.time()
 
             try:
-                state = State.retrieve(submission.webfinger_address)
+                state = StateRecord.retrieve(submission.webfinger_address)
             except Exception, e:
                 self.logger.warning("Retrieval of address %s failed: %s" % (submission.webfinger_address, str(e)))
+
+                if submission.claim:
+                    claims_rejected.inc("control_sample_failed")
+                    self._assimilate_validated(submission.claim, None)
+                else:
+                    self.pending_submissions.finish(submission.webfinger_address)
+
+                self._count_work("submission", start)
                 self.submission_queue.task_done()
                 continue
 
             self.logger.debug("Address %s successfully retrieved." % submission.webfinger_address)
 
-            claim = Claim(state)
+            if submission.claim:
+                # the control sample of a partner claim, which is validated again
+                claim = submission.claim
+                claim.retrieved_state = state
+            else:
+                self.pending_submissions.finish(submission.webfinger_address)
+
+                # self-made claims are always queued, but keep pending partner claims out
+                self.pending_claims.add(state.address, force=True)
+                claim = Claim(state)
 
             self.validation_queue.put(claim, True)
+            self._count_work("submission", start)
             self.submission_queue.task_done()
 
             self.logger.debug("Claim for %s submitted to validation queue." % submission.webfinger_address)
@@ -254,15 +684,146 @@ class Context:
                 return
 
             self.logger.debug("Got claim(%s, %s) from validation queue." % (claim.state.address, claim.partner_name))
+            start = time.time()
 
-            validated_state = claim.validate(self.partnerdb, self.logger)
-            if validated_state:
-                self.assimilation_queue.put(validated_state, True)
-                self.logger.debug("Validated claim(%s, %s) and submitted state to assimilation queue." % (claim.state.address, claim.partner_name))
-            else:
-                self.logger.warning("Validation of claim(%s, %s) failed." % (claim.state.address, claim.partner_name))
+            try:
+                try:
+                    validated_state = claim.validate(self.partnerdb, self.logger, self._defer_control_sample)
+                except Exception:
+                    self.logger.exception("Validation of claim(%s, %s) raised an exception." % (claim.state.address, claim.partner_name))
+                    validated_state = None
+
+                if not validated_state is CONTROL_SAMPLE_DEFERRED:
+                    self._assimilate_validated(claim, validated_state)
+            finally:
+                self._count_work("validation", start)
+                self.validation_queue.task_done()
+
+    def validation_batch_worker(self, pool, batch_size=VALIDATION_BATCH_SIZE):
+        """ Like validation_worker, but takes up to batch_size claims at once and
+            sends the CPU-bound checks to a multiprocessing pool, where they are
+            not serialized by the global interpreter lock. Taking control samples
+            and everything touching the databases is still done in this thread. """
+
+        while True:
+            claims = [self.validation_queue.get()]
+
+            # fill the batch with the claims that are available right now,
+            # but take at most one None
+            while claims[-1] is not None and len(claims)<batch_size:
+                try:
+                    claims.append(self.validation_queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            terminate = claims[-1] is None
+            if terminate: claims.pop()
+
+            start = time.time()
+
+            try:
+                self._validate_batch(pool, claims)
+            finally:
+                if claims:
+                    self._count_work("validation", start, len(claims))
+
+                for claim in claims:
+                    self.validation_queue.task_done()
+
+            if terminate:
+                self.validation_queue.task_done()
+                self.logger.debug("Reached end of validation queue.")
+                return
+
+    def _validate_batch(self, pool, claims):
+        """ Validates a batch of claims for validation_batch_worker. A claim whose
+            validation raises an exception is rejected; if the pool fails, the states
+            are checked in this thread. """
+
+        prepared_claims = []
+        for claim in claims:
+            self.logger.debug("Got claim(%s, %s) from validation queue." % (claim.state.address, claim.partner_name))
 
-            self.validation_queue.task_done()
+            try:
+                prepared = claim.prepare(self.partnerdb, self.logger, self._defer_control_sample)
+            except Exception:
+                self.logger.exception("Validation of claim(%s, %s) raised an exception." % (claim.state.address, claim.partner_name))
+                prepared = None
+
+            if prepared is None:
+                self._assimilate_validated(claim, None)
+            elif not prepared is CONTROL_SAMPLE_DEFERRED:
+                prepared_claims.append((claim, prepared))
+
+        # the processes of the pool do not cache verification results, see sduds.lib.signature
+        arguments = []
+        for claim, (trusted_state, partner_name) in prepared_claims:
+            arguments.append((state_data(trusted_state), claim.timestamp, signature_cached(trusted_state)))
+
+        try:
+            check_results = pool.map(check_state_data, arguments)
+        except Exception:
+            self.logger.exception("Checking a batch of claims in the validation pool failed, checking them one by one.")
+
+            check_results = []
+            for argument in arguments:
+                try:
+                    check_results.append(check_state_data(argument))
+                except Exception, e:
+                    check_results.append(("error", "Check of state raised an exception: %s" % str(e)))
+
+        for (claim, (trusted_state, partner_name)), argument, check_result in zip(prepared_claims, arguments, check_results):
+            state_argument, reference_timestamp, signature_checked = argument
+            if not signature_checked:
+                cache_signature(trusted_state, check_result)
+
+            try:
+                validated_state = claim.conclude(trusted_state, partner_name, check_result, self.partnerdb, self.logger)
+            except Exception:
+                self.logger.exception("Validation of claim(%s, %s) raised an exception." % (claim.state.address, claim.partner_name))
+                validated_state = None
+
+            self._assimilate_validated(claim, validated_state)
+
+    def defer_control_samples(self, enabled):
+        """ Enables or disables retrieving the control samples through the submission queue.
+            Must only be enabled while submission workers are running, and be disabled
+            before they are terminated. """
+
+        with self.deferral_lock:
+            self.deferring_control_samples = enabled
+
+    def _defer_control_sample(self, claim):
+        """ Puts the address of a claim into the submission queue to retrieve its control
+            sample, so that the rate limit of its domain does not block a validation worker.
+            The claim is rejected if the submission queue is full. Returns False if the
+            validation worker must retrieve the control sample itself. """
+
+        with self.deferral_lock:
+            if not self.deferring_control_samples: return False
+
+            try:
+                self.submission_queue.put(Submission(claim.state.address, claim), False)
+                self.logger.debug("Control sample of claim(%s, %s) put in submission queue." % (claim.state.address, claim.partner_name))
+            except Queue.Full:
+                claims_rejected.inc("control_sample_failed")
+                self.logger.warning("Submission queue full, rejected claim(%s, %s)!" % (claim.state.address, claim.partner_name))
+                self._assimilate_validated(claim, None)
+
+        return True
+
+    def _count_work(self, worker, start, items=1):
+        worker_busy.add(time.time() - start, worker)
+        worker_items.add(items, worker)
+
+    def _assimilate_validated(self, claim, validated_state):
+        self.pending_claims.finish(claim.state.address)
+
+        if validated_state:
+            self.assimilation_queue.put(validated_state, True)
+            self.logger.debug("Validated claim(%s, %s) and submitted state to assimilation queue." % (claim.state.address, claim.partner_name))
+        else:
+            self.logger.warning("Validation of claim(%s, %s) failed." % (claim.state.address, claim.partner_name))
 
     def assimilation_worker(self):
         while True:
@@ -273,6 +834,8 @@ class Context:
                 return
 
             address = state.address # only for logging [ORM expires state object during save()]
+            start = time.time()
             self.statedb.save(state)
+            self._count_work("assimilation", start)
             self.assimilation_queue.task_done()
             self.logger.debug("Saved state of %s to database." % address)
@@ -23,6 +23,7 @@ import select, socket, struct
 from exceptions import IOError
 
 from sduds.lib import communication
+from sduds.lib.instrumentedlock import InstrumentedLock
 
 def _forward_packets(sock, cin, cout):
     """ Forwards packets from a socket to a Popened process. cin and cout are stdin and stdout for the process.
@@ -115,7 +116,7 @@ class HashTrie:
         # run manager process
         self.manager_process = subprocess.Popen([manager_executable, database_path, logfile], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
-        self.lock = threading.Lock()
+        self.lock = InstrumentedLock("hashtrie")
 
     def _synchronize_common(self, partnersocket, command):
         """ Both SYNCHRONIZATION commands obey the same protocol, so to avoid
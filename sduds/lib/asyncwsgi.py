@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+
+"""
+This module implements a WSGI server which handles all connections in a single thread with
+non-blocking sockets, and runs the WSGI application in a bounded pool of worker threads.
+
+In contrast to :mod:`wsgiref.simple_server` with :class:`SocketServer.ThreadingMixIn`, no
+thread is started per request, and connections are kept alive between requests (HTTP/1.1
+keep-alive), so that clients sending many requests do not need a new connection for each.
+
+The event loop reads the requests, and when a request is complete, it is queued for the
+workers. The queue is bounded: if it is full, the request is answered at once with
+``503 Service Unavailable``, so that the server does not accumulate requests it cannot
+answer in time. The number of connections is bounded as well; when the limit is reached,
+no further connections are accepted until others are closed. A connection is closed if a
+request is not received completely within the request timeout, or if it is idle for
+longer than the keep-alive timeout.
+
+The worker collects the whole response of the application, which is then sent by the
+event loop. Request bodies must have a ``Content-Length``, chunked request bodies are
+answered with ``411 Length Required``.
+
+Example usage::
+
+    def application(environment, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["Hello world!"]
+
+    server = AsyncWSGIServer(("", 8000), application)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    # ... serve requests ...
+
+    server.shutdown()
+    server.server_close()
+"""
+
+import socket, select, errno, os, sys, time, threading, Queue, logging
+import urllib, urlparse, collections, email.utils
+from cStringIO import StringIO
+
+from metrics import registry
+
+requests_total = registry.counter("http_requests_total", "Number of HTTP requests answered by status code.", ["status"])
+request_duration = registry.histogram("http_request_duration_seconds", "Time from receiving an HTTP request to queuing its response.")
+rejected_total = registry.counter("http_rejected_total", "Number of HTTP requests or connections rejected by reason.", ["reason"])
+open_connections = registry.gauge("http_connections", "Number of open HTTP connections.")
+
+#: The reason phrases of the status codes sent by the server itself.
+REASONS = {
+    400: "Bad Request",
+    408: "Request Timeout",
+    411: "Length Required",
+    413: "Request Entity Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+class BadRequest(Exception):
+    """ Raised while parsing a request that must be answered with an error status. """
+
+    def __init__(self, code):
+        Exception.__init__(self, REASONS[code])
+        self.code = code
+
+class Connection:
+    """ The state of one client connection, used by the event loop of :class:`AsyncWSGIServer`. """
+
+    socket = None
+    address = None
+
+    #: Received bytes which are not yet part of a complete request.
+    input = None
+
+    #: Bytes waiting to be sent.
+    output = None
+
+    #: Whether a request of the connection is being handled by a worker.
+    busy = None
+
+    #: Whether the connection is kept open after the response was sent.
+    keep_alive = None
+
+    #: The time of the last activity, to find idle connections.
+    last_activity = None
+
+    #: The time the first byte of the current request was received, or ``None``.
+    request_start = None
+
+    #: Whether ``100 Continue`` was sent for the current request.
+    continue_sent = None
+
+    #: Whether the connection was closed.
+    closed = None
+
+    fd = None
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.input = ""
+        self.output = ""
+        self.busy = False
+        self.keep_alive = True
+        self.last_activity = time.time()
+        self.request_start = None
+        self.continue_sent = False
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+class AsyncWSGIServer:
+    """ A WSGI server with one event loop thread and a bounded pool of worker threads.
+        It has the methods :meth:`serve_forever`, :meth:`shutdown` and :meth:`server_close`
+        of :class:`SocketServer.TCPServer`, so that it can be used in place of
+        :class:`wsgiref.simple_server.WSGIServer`.
+    """
+
+    application = None
+
+    #: The listening socket.
+    socket = None
+
+    server_name = None
+    server_port = None
+
+    max_connections = None
+    request_timeout = None
+    keepalive_timeout = None
+    max_header_size = None
+    max_body_size = None
+
+    connections = None
+    requests = None
+    responses = None
+    responses_lock = None
+    wakeup_read = None
+    wakeup_write = None
+
+    workers = None
+    finished = None
+    stopped = None
+
+    def __init__(self, address, application, workers=8, max_pending=100, max_connections=500,
+                 request_timeout=30, keepalive_timeout=15, max_header_size=65536, max_body_size=1048576):
+        """ :param address: the ``(interface, port)`` tuple to listen on
+            :type address: tuple
+            :param application: the WSGI application
+            :type application: function
+            :param workers: the number of worker threads calling the application (optional)
+            :type workers: integer
+            :param max_pending: the number of requests which may wait for a worker, further
+                                requests are answered with ``503 Service Unavailable`` (optional)
+            :type max_pending: integer
+            :param max_connections: the number of connections kept open at once (optional)
+            :type max_connections: integer
+            :param request_timeout: the seconds within which a request must be received completely (optional)
+            :type request_timeout: float
+            :param keepalive_timeout: the seconds after which an idle connection is closed (optional)
+            :type keepalive_timeout: float
+            :param max_header_size: the maximal size of the request line and headers in bytes (optional)
+            :type max_header_size: integer
+            :param max_body_size: the maximal size of a request body in bytes (optional)
+            :type max_body_size: integer
+        """
+
+        self.application = application
+
+        self.max_connections = max_connections
+        self.request_timeout = request_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+
+        host, self.server_port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+
+        self.connections = {}
+
+        # requests waiting for a worker, and responses waiting for the event loop
+        self.requests = Queue.Queue(max_pending)
+        self.responses = collections.deque()
+        self.responses_lock = threading.Lock()
+
+        # wakes up the event loop when a response is ready or the server shuts down
+        self.wakeup_read, self.wakeup_write = os.pipe()
+
+        self.finished = False
+        self.stopped = threading.Event()
+        self.stopped.set()
+
+        self.workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._run_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def serve_forever(self):
+        """ Runs the event loop until :meth:`shutdown` is called. """
+
+        self.stopped.clear()
+
+        try:
+            while not self.finished:
+                self._poll(1.)
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        """ Stops the event loop; blocks until it is stopped. """
+
+        self.finished = True
+        self._wakeup()
+        self.stopped.wait()
+
+    def server_close(self):
+        """ Closes the listening socket and all connections, and stops the workers. """
+
+        self.socket.close()
+
+        for connection in self.connections.values():
+            self._close(connection)
+
+        for worker in self.workers:
+            self.requests.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_write, "x")
+        except OSError:
+            pass
+
+    # event loop
+
+    def _poll(self, timeout):
+        readers = [self.wakeup_read]
+        if len(self.connections)<self.max_connections:
+            readers.append(self.socket)
+
+        writers = []
+
+        for connection in self.connections.itervalues():
+            if connection.output:
+                writers.append(connection)
+            elif not connection.busy:
+                readers.append(connection)
+
+        try:
+            readable, writable, exceptional = select.select(readers, writers, [], timeout)
+        except select.error, e:
+            if e.args[0]==errno.EINTR: return
+            raise
+
+        if self.wakeup_read in readable:
+            os.read(self.wakeup_read, 4096)
+
+        self._take_responses()
+
+        for connection in writable:
+            self._write(connection)
+
+        for connection in readable:
+            if connection is self.wakeup_read:
+                continue
+            elif connection is self.socket:
+                self._accept()
+            elif not connection.closed:
+                self._read(connection)
+
+        self._check_timeouts()
+
+    def _accept(self):
+        try:
+            sock, address = self.socket.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED): return
+            raise
+
+        sock.setblocking(False)
+
+        connection = Connection(sock, address)
+        self.connections[connection.fd] = connection
+        open_connections.set(len(self.connections))
+
+    def _close(self, connection):
+        if connection.closed: return
+
+        connection.closed = True
+        del self.connections[connection.fd]
+
+        open_connections.set(len(self.connections))
+
+        try:
+            connection.socket.close()
+        except socket.error:
+            pass
+
+    def _read(self, connection):
+        try:
+            data = connection.socket.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+            self._close(connection)
+            return
+
+        if not data:
+            self._close(connection)
+            return
+
+        connection.last_activity = time.time()
+        if connection.request_start is None:
+            connection.request_start = connection.last_activity
+
+        connection.input += data
+        self._handle_input(connection)
+
+    def _write(self, connection):
+        try:
+            sent = connection.socket.send(connection.output)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+            self._close(connection)
+            return
+
+        connection.output = connection.output[sent:]
+        connection.last_activity = time.time()
+
+        if connection.output or connection.busy: return
+
+        if not connection.keep_alive:
+            self._close(connection)
+        elif connection.input:
+            # a pipelined request
+            self._handle_input(connection)
+
+    def _check_timeouts(self):
+        now = time.time()
+
+        for connection in self.connections.values():
+            if connection.busy or connection.output: continue
+
+            if connection.request_start is not None:
+                if now - connection.request_start > self.request_timeout:
+                    rejected_total.inc("timeout")
+                    self._send_error(connection, 408)
+            elif now - connection.last_activity > self.keepalive_timeout:
+                self._close(connection)
+
+    def _handle_input(self, connection):
+        try:
+            request = self._parse_request(connection)
+        except BadRequest, e:
+            rejected_total.inc("bad_request")
+            self._send_error(connection, e.code)
+            return
+
+        if request is None: return
+
+        environment, keep_alive = request
+        connection.keep_alive = keep_alive
+        connection.request_start = time.time() if connection.input else None
+
+        try:
+            self.requests.put_nowait((connection, environment, time.time()))
+        except Queue.Full:
+            rejected_total.inc("busy")
+            self._send_error(connection, 503)
+            return
+
+        connection.busy = True
+
+    def _send_error(self, connection, code):
+        body = "%d %s\n" % (code, REASONS[code])
+
+        headers = [("Content-Type", "text/plain"), ("Content-Length", str(len(body))), ("Connection", "close")]
+        if code==503: headers.append(("Retry-After", "1"))
+
+        requests_total.inc(str(code))
+
+        connection.input = ""
+        connection.request_start = None
+        connection.keep_alive = False
+        connection.output += self._format_response("%d %s" % (code, REASONS[code]), headers, body)
+
+    def _take_responses(self):
+        with self.responses_lock:
+            responses = list(self.responses)
+            self.responses.clear()
+
+        for connection, data in responses:
+            connection.busy = False
+            if connection.closed: continue
+
+            connection.output += data
+            connection.last_activity = time.time()
+
+    # parsing
+
+    def _parse_request(self, connection):
+        """ Returns a ``(environment, keep_alive)`` tuple and removes the request from the
+            input of the connection, or returns ``None`` if the request is not complete. """
+
+        data = connection.input
+
+        header_end = data.find("\r\n\r\n")
+        if header_end<0:
+            if len(data)>self.max_header_size: raise BadRequest(431)
+            return None
+        if header_end>self.max_header_size: raise BadRequest(431)
+
+        lines = data[:header_end].split("\r\n")
+
+        # ignore empty lines before the request line
+        while lines and not lines[0]: lines.pop(0)
+        if not lines: raise BadRequest(400)
+
+        try:
+            method, target, protocol = lines[0].split()
+        except ValueError:
+            raise BadRequest(400)
+
+        if not protocol.startswith("HTTP/1."): raise BadRequest(400)
+
+        headers = {}
+        for line in lines[1:]:
+            name, colon, value = line.partition(":")
+            if not colon: raise BadRequest(400)
+
+            name = name.strip().lower()
+            value = value.strip()
+
+            if name in headers:
+                headers[name] += "," + value
+            else:
+                headers[name] = value
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise BadRequest(411)
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise BadRequest(400)
+
+        if length<0: raise BadRequest(400)
+        if length>self.max_body_size: raise BadRequest(413)
+
+        body_start = header_end + 4
+        if len(data)<body_start+length:
+            if headers.get("expect", "").lower()=="100-continue" and not connection.continue_sent:
+                connection.output += "HTTP/1.1 100 Continue\r\n\r\n"
+                connection.continue_sent = True
+            return None
+
+        body = data[body_start:body_start+length]
+        connection.input = data[body_start+length:]
+        connection.continue_sent = False
+
+        # keep-alive is the default for HTTP/1.1 only
+        options = [option.strip() for option in headers.get("connection", "").lower().split(",")]
+        if protocol=="HTTP/1.0":
+            keep_alive = "keep-alive" in options
+        else:
+            keep_alive = "close" not in options
+
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(target)
+
+        environment = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.unquote(path),
+            "QUERY_STRING": query,
+            "CONTENT_TYPE": headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(length) if "content-length" in headers else "",
+            "SERVER_NAME": self.server_name,
+            "SERVER_PORT": str(self.server_port),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": connection.address[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": StringIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+
+        for name, value in headers.iteritems():
+            if name in ("content-type", "content-length"): continue
+            environment["HTTP_" + name.upper().replace("-", "_")] = value
+
+        return environment, keep_alive
+
+    # workers
+
+    def _run_worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None: return
+
+            connection, environment, received = item
+
+            data = self._call_application(environment, connection.keep_alive)
+            request_duration.observe(time.time() - received)
+
+            with self.responses_lock:
+                self.responses.append((connection, data))
+
+            self._wakeup()
+
+    def _call_application(self, environment, keep_alive):
+        response = []
+        body = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if response: raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            elif response:
+                raise AssertionError("start_response called twice")
+
+            response[:] = [status, headers]
+            return body.append
+
+        try:
+            result = self.application(environment, start_response)
+            try:
+                for chunk in result:
+                    if chunk: body.append(chunk)
+            finally:
+                if hasattr(result, "close"): result.close()
+
+            if not response: raise AssertionError("start_response was not called")
+        except Exception:
+            logging.getLogger(__name__).exception("WSGI application failed for %s." % environment["PATH_INFO"])
+
+            body = ["500 %s\n" % REASONS[500]]
+            response = ["500 %s" % REASONS[500], [("Content-Type", "text/plain")]]
+
+        status, headers = response
+        body = "".join(body)
+
+        requests_total.inc(status.split(" ", 1)[0])
+
+        names = set(name.lower() for name, value in headers)
+        headers = list(headers)
+
+        if not "content-length" in names:
+            headers.append(("Content-Length", str(len(body))))
+        if not "date" in names:
+            headers.append(("Date", email.utils.formatdate(usegmt=True)))
+
+        headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+
+        if environment["REQUEST_METHOD"]=="HEAD":
+            body = ""
+
+        return self._format_response(status, headers, body)
+
+    def _format_response(self, status, headers, body):
+        lines = ["HTTP/1.1 %s" % status]
+        lines.extend("%s: %s" % (name, value) for name, value in headers)
+        lines.append("")
+        lines.append("")
+
+        return "\r\n".join(lines) + body
@@ -38,6 +38,9 @@ import SocketServer, uuid, hmac, hashlib
 
 from sduds.lib import communication
 
+#: The length of the random part of a challenge (integer). The rest of it lists the extensions offered by the server.
+CHALLENGE_LENGTH = 16
+
 def authenticate_socket(sock, username, password):
     """ Authenticates a socket using the HMAC-SHA512 algorithm. This is the
         counterpart of :class:`AuthenticatingRequestHandler`. Returns whether
@@ -52,22 +55,43 @@ def authenticate_socket(sock, username, password):
         :rtype: boolean
     """
 
+    success, agreed_extensions = authenticate_socket_with_extensions(sock, username, password, ())
+
+    return success
+
+def authenticate_socket_with_extensions(sock, username, password, extensions):
+    """ Like :func:`authenticate_socket`, but additionally agrees on protocol
+        extensions with the server. The server offers its extensions by appending
+        their names to the challenge, which older clients simply include in the
+        HMAC. The client accepts those it knows by appending their names to its
+        response, which it only does if the server offered them, so that older
+        servers are never confused. Returns a tuple of whether authentication was
+        successful and the :class:`frozenset` of extensions both sides use.
+
+        :param extensions: the names of the extensions the client supports; must not contain whitespace
+        :type extensions: iterable of strings
+        :rtype: tuple of boolean and :class:`frozenset` of strings
+    """
+
     # make sure method is HMAC with SHA512
     method = communication.recv_short_str(sock)
     if not method=="HMAC-SHA512":
         # TODO: logging
         sock.close()
-        return False
+        return False, frozenset()
 
     # send username
     assert len(username)<256
     communication.send_short_str(sock, username)
 
-    # receive challenge
+    # receive challenge and the offered extensions
     challenge = communication.recv_short_str(sock)
+    offered_extensions = challenge[CHALLENGE_LENGTH:].split()
+    agreed_extensions = frozenset(extension for extension in extensions if extension in offered_extensions)
 
-    # send response
+    # send response, followed by the accepted extensions
     response = hmac.new(password, challenge, hashlib.sha512).digest()
+    response += "".join(" "+extension for extension in sorted(agreed_extensions))
     assert len(response)<256
     communication.send_short_str(sock, response)
 
@@ -75,10 +99,10 @@ def authenticate_socket(sock, username, password):
     answer = communication.recv_short_str(sock)
 
     if answer=="ACCEPTED":
-        return True
+        return True, agreed_extensions
     else:
         sock.close()
-        return False
+        return False, frozenset()
 
 class AuthenticatingRequestHandler(SocketServer.BaseRequestHandler):
     """ Abstract base class for a `RequestHandler` which requires authentication with
@@ -90,8 +114,17 @@ class AuthenticatingRequestHandler(SocketServer.BaseRequestHandler):
         :meth:`handle_user` method is called, which also has to be overridden in
         subclasses. This class is the counterpart of the :func:`authenticate_socket`
         function.
+
+        To offer protocol extensions, set :attr:`extensions` in subclasses. The
+        extensions the client accepted are available as :attr:`agreed_extensions`
+        in :meth:`handle_user`.
     """
 
+    #: The names of the protocol extensions offered to clients (tuple of strings without whitespace).
+    extensions = ()
+    #: The names of the offered extensions the client accepted (:class:`frozenset` of strings).
+    agreed_extensions = None
+
     def handle(self):
         # send expected authentication method
         method = "HMAC-SHA512"
@@ -100,8 +133,11 @@ class AuthenticatingRequestHandler(SocketServer.BaseRequestHandler):
         # receive username
         username = communication.recv_short_str(self.request)
 
-        # send challenge
+        # send challenge, followed by the offered extensions
         challenge = uuid.uuid4().bytes
+        assert len(challenge)==CHALLENGE_LENGTH
+        challenge += "".join(" "+extension for extension in self.extensions)
+        assert len(challenge)<256
         communication.send_short_str(self.request, challenge)
 
         # receive response
@@ -115,11 +151,14 @@ class AuthenticatingRequestHandler(SocketServer.BaseRequestHandler):
 
         computed_response = hmac.new(password, challenge, hashlib.sha512).digest()
 
-        # check response
-        if not response==computed_response:
+        # check response; the client may append the extensions it accepts
+        if not response[:len(computed_response)]==computed_response:
             communication.send_short_str(self.request, "INVALID PASSWORD")
             return
 
+        accepted_extensions = response[len(computed_response):].split()
+        self.agreed_extensions = frozenset(extension for extension in self.extensions if extension in accepted_extensions)
+
         communication.send_short_str(self.request, "ACCEPTED")
 
         self.handle_user(username)
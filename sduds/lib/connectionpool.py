@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+This module implements a pool of persistent HTTP connections. Profiles are clustered on a few
+large pods, so reusing a connection for several requests to the same host saves a TCP (and TLS)
+handshake for each retrieval.
+
+Idle connections are kept per ``(scheme, host, port)`` and closed when they were not used for
+a certain time. The number of idle connections is bounded both per host and in total; the
+number of connections in use is only bounded by the number of threads using the pool.
+
+Example usage::
+
+    pool = ConnectionPool()
+
+    response = pool.request("http://example.org/document")
+    print response.status, response.body
+
+    # ... further requests to example.org reuse the connection ...
+
+    pool.close()
+"""
+
+import httplib, urlparse, socket
+import threading, time
+
+class HTTPError(IOError):
+    """ Raised by :meth:`ConnectionPool.request` if the server answers with a status code
+        of 400 or above. Like :class:`urllib2.HTTPError`, this is a subclass of :class:`IOError`.
+    """
+
+    #: The status code of the response (integer).
+    status = None
+
+    def __init__(self, url, status, reason):
+        IOError.__init__(self, "HTTP error %d (%s) for %s" % (status, reason, url))
+        self.status = status
+
+class Response:
+    """ A completely read HTTP response. """
+
+    #: The URL of the requested document, after following redirects (string).
+    url = None
+
+    #: The status code (integer).
+    status = None
+
+    #: The reason phrase (string).
+    reason = None
+
+    #: The response headers (dictionary with lower-case header names as keys).
+    headers = None
+
+    #: The response body (string).
+    body = None
+
+    def __init__(self, url, status, reason, headers, body):
+        """ For a description of the arguments see the documentation of the attributes of this class. """
+
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+REDIRECT_CODES = set([301, 302, 303, 307])
+
+class ConnectionPool:
+    """ Keeps persistent :class:`httplib.HTTPConnection` objects and reuses them for requests
+        to the same host. Can be shared by several threads.
+    """
+
+    lock = None
+    idle_connections = None
+    idle_count = None
+
+    max_idle_per_host = None
+    max_idle = None
+    idle_timeout = None
+    max_redirects = None
+
+    def __init__(self, max_idle_per_host=4, max_idle=64, idle_timeout=30, max_redirects=5):
+        """ :param max_idle_per_host: the maximal number of idle connections kept for one host (optional)
+            :type max_idle_per_host: integer
+            :param max_idle: the maximal number of idle connections kept in total (optional)
+            :type max_idle: integer
+            :param idle_timeout: seconds after which an unused connection is closed (optional)
+            :type idle_timeout: float
+            :param max_redirects: the maximal number of redirects followed by :meth:`request` (optional)
+            :type max_redirects: integer
+        """
+
+        self.lock = threading.Lock()
+
+        # maps (scheme, host, port) to a list of (connection, last_used) tuples,
+        # the most recently used connection at the end
+        self.idle_connections = {}
+        self.idle_count = 0
+
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.max_redirects = max_redirects
+
+    def _expire_idle_connections(self, now):
+        """ Closes all connections that were idle for more than ``idle_timeout`` seconds.
+            Must be called with the lock held.
+        """
+
+        expired = []
+
+        for key, connections in self.idle_connections.items():
+            fresh = [(c, last_used) for c, last_used in connections if now - last_used <= self.idle_timeout]
+            expired += [c for c, last_used in connections if now - last_used > self.idle_timeout]
+
+            if fresh:
+                self.idle_connections[key] = fresh
+            else:
+                del self.idle_connections[key]
+
+        self.idle_count -= len(expired)
+
+        return expired
+
+    def _acquire(self, key, timeout):
+        """ Returns an idle connection for ``key`` or a new one, together with a flag telling
+            whether the connection was reused.
+        """
+
+        now = time.time()
+
+        with self.lock:
+            expired = self._expire_idle_connections(now)
+
+            connections = self.idle_connections.get(key)
+            if connections:
+                connection, last_used = connections.pop()
+                self.idle_count -= 1
+
+                if not connections:
+                    del self.idle_connections[key]
+            else:
+                connection = None
+
+        for c in expired:
+            c.close()
+
+        if connection is None:
+            scheme, host, port = key
+
+            if scheme=="https":
+                connection = httplib.HTTPSConnection(host, port, timeout=timeout)
+            else:
+                connection = httplib.HTTPConnection(host, port, timeout=timeout)
+
+            return connection, False
+
+        # the timeout might differ from the one of the previous request
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+        return connection, True
+
+    def _release(self, key, connection):
+        """ Puts a connection back into the pool, or closes it if the pool is full. """
+
+        with self.lock:
+            connections = self.idle_connections.setdefault(key, [])
+
+            if len(connections)<self.max_idle_per_host and self.idle_count<self.max_idle:
+                connections.append((connection, time.time()))
+                self.idle_count += 1
+                return
+
+            if not connections:
+                del self.idle_connections[key]
+
+        connection.close()
+
+    def _request_once(self, key, path, headers, timeout):
+        connection, reused = self._acquire(key, timeout)
+
+        try:
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.BadStatusLine, socket.error), e:
+                # the server may have closed an idle connection in the meantime,
+                # so retry once with a new connection
+                if not reused or isinstance(e, socket.timeout): raise
+
+                connection.close()
+                connection, reused = self._acquire(key, timeout)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+
+            body = response.read()
+        except httplib.HTTPException, e:
+            connection.close()
+            raise IOError("HTTP protocol error: %s" % repr(e))
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+
+        headers = dict(response.getheaders())
+
+        return response.status, response.reason, headers, body
+
+    def request(self, url, headers=None, timeout=None):
+        """ Sends a GET request and reads the whole response. Redirects are followed.
+
+            Raises :class:`IOError` if there are connection problems, and :class:`HTTPError`,
+            a subclass of :class:`IOError`, if the status code of the response is 400 or above.
+
+            :param url: the URL of the document (``http`` or ``https`` scheme)
+            :type url: string
+            :param headers: additional request headers (optional)
+            :type headers: dict
+            :param timeout: timeout in seconds for the socket operations (optional)
+            :type timeout: float
+            :rtype: :class:`Response`
+        """
+
+        if headers is None: headers = {}
+
+        for i in xrange(self.max_redirects+1):
+            parsed = urlparse.urlsplit(url)
+
+            if not parsed.scheme in ("http", "https"):
+                raise IOError("Unsupported URL scheme: %s" % url)
+
+            if parsed.port is None:
+                port = httplib.HTTPS_PORT if parsed.scheme=="https" else httplib.HTTP_PORT
+            else:
+                port = parsed.port
+
+            key = (parsed.scheme, parsed.hostname, port)
+
+            path = parsed.path or "/"
+            if parsed.query: path += "?" + parsed.query
+
+            status, reason, response_headers, body = self._request_once(key, path, headers, timeout)
+
+            if status in REDIRECT_CODES and "location" in response_headers:
+                url = urlparse.urljoin(url, response_headers["location"])
+                continue
+
+            if status>=400:
+                raise HTTPError(url, status, reason)
+
+            return Response(url, status, reason, response_headers, body)
+
+        raise IOError("Too many redirects: %s" % url)
+
+    def close(self):
+        """ Closes all idle connections. The pool may still be used afterwards. """
+
+        with self.lock:
+            idle_connections = self.idle_connections
+            self.idle_connections = {}
+            self.idle_count = 0
+
+        for connections in idle_connections.itervalues():
+            for connection, last_used in connections:
+                connection.close()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+
+"""
+This module implements work queues whose items are kept in an SQLite database, so that
+the queues are not bounded by memory and their contents survive a restart.
+
+A :class:`Journal` is a table of pickled items. An item is appended when it is put into
+the queue and removed when :meth:`~Journal.finish` is called for it, i.e. when the worker
+calls ``task_done()``. Items which were handed out but not finished, e.g. because the
+application crashed, are handed out again after a restart.
+
+The :class:`DiskQueue` has the interface of :class:`Queue.Queue`. It keeps a window of at
+most ``memory_size`` items in memory and reads the next items from the journal when the
+window is empty. Items are handed out in the order of a priority calculated by a
+function, and in the order they were put for equal priorities. :meth:`~DiskQueue.put`
+never blocks and never raises :class:`Queue.Full`.
+
+Example usage::
+
+    journal = Journal("queues.sqlite", "claims")
+    queue = DiskQueue(journal, memory_size=500)
+
+    queue.put(claim)
+
+    # in worker threads
+    claim = queue.get()
+    # ... process the claim ...
+    queue.task_done()
+
+``None`` items are used to terminate workers. They are not written to the journal and are
+handed out before all other items, which remain in the journal for the next start.
+"""
+
+import threading, time, collections, heapq
+import Queue
+import sqlite3, cPickle
+
+class Journal:
+    """ A table of pickled items in an SQLite database. Several journals may use the same
+        database file. Can be shared by several threads.
+    """
+
+    lock = None
+    connection = None
+    table = None
+    local = None
+
+    def __init__(self, path, table):
+        """ :param path: the path of the database file
+            :type path: string
+            :param table: the name of the table (must be a valid SQL identifier)
+            :type table: string
+        """
+
+        self.lock = threading.Lock()
+        self.table = table
+
+        # autocommit mode, each statement is a transaction
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY AUTOINCREMENT, priority REAL NOT NULL, source TEXT, data BLOB NOT NULL)" % table)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS %s_order ON %s (priority, id)" % (table, table))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS %s_source ON %s (source, id)" % (table, table))
+
+        # the ids of the items handed out to each thread, oldest first
+        self.local = threading.local()
+
+    def append(self, item, priority=0., source=None):
+        """ Writes an item to the journal and returns its id.
+
+            :param item: the item, must be picklable
+            :param priority: the priority, lower values are handed out first (optional)
+            :type priority: float
+            :param source: the source of the item, see :meth:`load_source` (optional)
+            :type source: string
+            :rtype: integer
+        """
+
+        data = sqlite3.Binary(cPickle.dumps(item, cPickle.HIGHEST_PROTOCOL))
+
+        with self.lock:
+            cursor = self.connection.execute("INSERT INTO %s (priority, source, data) VALUES (?, ?, ?)" % self.table, (priority, source, data))
+            return cursor.lastrowid
+
+    def remove(self, item_id):
+        """ Removes an item from the journal.
+
+            :param item_id: the id returned by :meth:`append`
+            :type item_id: integer
+        """
+
+        with self.lock:
+            self.connection.execute("DELETE FROM %s WHERE id=?" % self.table, (item_id,))
+
+    def count(self):
+        """ Returns the number of items in the journal.
+
+            :rtype: integer
+        """
+
+        with self.lock:
+            number, = self.connection.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()
+            return number
+
+    def count_sources(self):
+        """ Returns the number of items in the journal for each source.
+
+            :rtype: dict mapping sources to integers
+        """
+
+        with self.lock:
+            rows = self.connection.execute("SELECT source, COUNT(*) FROM %s GROUP BY source" % self.table).fetchall()
+
+        return dict(rows)
+
+    def load_source(self, source, after=None, limit=None):
+        """ Reads the items of one source in the order they were appended.
+
+            :param source: the source
+            :type source: string
+            :param after: only read items with a larger id (optional)
+            :type after: integer
+            :param limit: the maximal number of items (optional)
+            :type limit: integer
+            :rtype: list of ``(id, item)`` tuples
+        """
+
+        query = "SELECT id, data FROM %s WHERE source IS ?" % self.table
+        parameters = (source,)
+
+        if after is not None:
+            query += " AND id>?"
+            parameters += (after,)
+
+        query += " ORDER BY id"
+
+        if limit is not None:
+            query += " LIMIT %d" % limit
+
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        return [(item_id, cPickle.loads(str(data))) for item_id, data in rows]
+
+    def load(self, after=None, limit=None):
+        """ Reads items ordered by priority and id.
+
+            :param after: only read items whose ``(priority, id)`` tuple is larger (optional)
+            :type after: tuple
+            :param limit: the maximal number of items (optional)
+            :type limit: integer
+            :rtype: list of ``(priority, id, item)`` tuples
+        """
+
+        query = "SELECT priority, id, data FROM %s" % self.table
+        parameters = ()
+
+        if after is not None:
+            priority, item_id = after
+            query += " WHERE priority>? OR (priority=? AND id>?)"
+            parameters = (priority, priority, item_id)
+
+        query += " ORDER BY priority, id"
+
+        if limit is not None:
+            query += " LIMIT %d" % limit
+
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        return [(priority, item_id, cPickle.loads(str(data))) for priority, item_id, data in rows]
+
+    def checkout(self, item_id):
+        """ Notes that an item was handed out to the current thread. ``None`` is used for
+            items which are not in the journal.
+
+            :param item_id: the id of the item or ``None``
+            :type item_id: integer
+        """
+
+        try:
+            handed_out = self.local.handed_out
+        except AttributeError:
+            handed_out = self.local.handed_out = collections.deque()
+
+        handed_out.append(item_id)
+
+    def finish(self):
+        """ Removes the item which was handed out to the current thread first and is not
+            finished yet, like :meth:`Queue.Queue.task_done` does for the unfinished tasks.
+            Returns the id of the item, or ``None`` for items which are not in the journal.
+        """
+
+        item_id = self.local.handed_out.popleft()
+
+        if item_id is not None:
+            self.remove(item_id)
+
+        return item_id
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class DiskQueue:
+    """ A :class:`Queue.Queue` replacement which stores its items in a :class:`Journal`. """
+
+    condition = None
+    all_tasks_done = None
+    unfinished_tasks = None
+
+    journal = None
+    memory_size = None
+    priority_function = None
+
+    window = None
+    boundary = None
+    unloaded = None
+    handed_out = None
+    terminators = None
+
+    def __init__(self, journal, memory_size=500, priority_function=None):
+        """ Items already in the journal, e.g. from before a restart, are handed out again.
+
+            :param journal: the journal
+            :type journal: :class:`Journal`
+            :param memory_size: the number of items kept in memory (optional)
+            :type memory_size: integer
+            :param priority_function: returns the priority of an item, lower values are handed
+                                      out first (optional) -- by default, the queue is FIFO
+            :type priority_function: function
+        """
+
+        self.condition = threading.Condition()
+        self.all_tasks_done = threading.Condition(self.condition)
+
+        self.journal = journal
+        self.memory_size = memory_size
+        self.priority_function = priority_function
+
+        # heap of (priority, id, item) tuples; all items in the journal which are neither
+        # in the window nor handed out have a larger (priority, id) than the boundary
+        self.window = []
+        self.boundary = None
+        self.unloaded = journal.count()
+
+        # the ids of the items handed out and not finished yet, which are still in the
+        # journal and may lie beyond the boundary after it was lowered by put()
+        self.handed_out = set()
+
+        self.unfinished_tasks = self.unloaded
+
+        # number of queued None items
+        self.terminators = 0
+
+    def put(self, item, block=True, timeout=None):
+        """ Puts an item into the queue. The arguments ``block`` and ``timeout`` are only
+            accepted for compatibility with :meth:`Queue.Queue.put`; this method never blocks.
+        """
+
+        if item is None:
+            with self.condition:
+                self.terminators += 1
+                self.unfinished_tasks += 1
+                self.condition.notify()
+            return
+
+        if self.priority_function:
+            priority = float(self.priority_function(item))
+        else:
+            priority = 0.
+
+        with self.condition:
+            item_id = self.journal.append(item, priority)
+            key = (priority, item_id)
+
+            if self.boundary is not None and key<self.boundary:
+                # the item must be handed out before the items in the journal
+                heapq.heappush(self.window, (priority, item_id, item))
+
+                if len(self.window)>self.memory_size:
+                    # spill the last item of the window, which is in the journal already
+                    last = max(self.window)
+                    self.window.remove(last)
+                    heapq.heapify(self.window)
+                    self.unloaded += 1
+
+                    last_priority, last_id, last_item = max(self.window)
+                    self.boundary = (last_priority, last_id)
+            elif self.unloaded==0 and len(self.window)<self.memory_size:
+                heapq.heappush(self.window, (priority, item_id, item))
+                self.boundary = key
+            else:
+                # spill to disk
+                self.unloaded += 1
+
+            self.unfinished_tasks += 1
+            self.condition.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def _load(self):
+        """ Reads the next items from the journal into the window, skipping the items which
+            are handed out. Must be called with the lock held. """
+
+        rows = self.journal.load(self.boundary, self.memory_size + len(self.handed_out))
+
+        loaded = 0
+        for row in rows:
+            priority, item_id, item = row
+            if item_id in self.handed_out: continue
+
+            heapq.heappush(self.window, row)
+            loaded += 1
+
+        if loaded:
+            priority, item_id, item = rows[-1]
+            self.boundary = (priority, item_id)
+            self.unloaded -= loaded
+        else:
+            self.unloaded = 0
+
+    def get(self, block=True, timeout=None):
+        """ Removes and returns an item from the queue. Same semantics as :meth:`Queue.Queue.get`. """
+
+        with self.condition:
+            if timeout is not None:
+                end = time.time() + timeout
+
+            while True:
+                if self.terminators>0:
+                    self.terminators -= 1
+                    self.journal.checkout(None)
+                    return None
+
+                if not self.window and self.unloaded>0:
+                    self._load()
+
+                if self.window:
+                    priority, item_id, item = heapq.heappop(self.window)
+                    self.journal.checkout(item_id)
+                    self.handed_out.add(item_id)
+                    return item
+
+                if not block:
+                    raise Queue.Empty
+
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining<=0: raise Queue.Empty
+                    self.condition.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        """ Removes the item from the journal which the current thread got first and for
+            which ``task_done()`` was not called yet. Otherwise, same semantics as
+            :meth:`Queue.Queue.task_done`.
+        """
+
+        with self.condition:
+            unfinished = self.unfinished_tasks - 1
+
+            if unfinished<0:
+                raise ValueError("task_done() called too many times")
+
+            self.handed_out.discard(self.journal.finish())
+
+            if unfinished==0:
+                self.all_tasks_done.notify_all()
+
+            self.unfinished_tasks = unfinished
+
+    def join(self):
+        """ Blocks until :meth:`task_done` was called for every item. """
+
+        with self.condition:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def qsize(self):
+        with self.condition:
+            return len(self.window) + self.unloaded + self.terminators
+
+    def empty(self):
+        return self.qsize()==0
+
+    def full(self):
+        return False
+
+    def close(self):
+        """ Closes the journal. Items which are still queued are handed out again
+            by a new queue using the same database.
+        """
+
+        with self.condition:
+            self.journal.close()
@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+
+"""
+This module implements a work queue which limits the rate at which items for the same
+domain are handed out, so that retrieving many profiles does not hammer a single pod.
+
+Each domain has a token bucket in a :class:`RateLimiter`: it is refilled at a fixed rate up
+to a maximal burst size, and taking an item for a domain consumes one token. The
+:class:`DomainQueue` keeps a separate FIFO queue for each domain and serves the domains in
+round-robin order, skipping domains that have no token left. Items for other domains are
+therefore not held up by a domain with a large backlog.
+
+Example usage::
+
+    limiter = RateLimiter(rate=1.0, burst=10)
+    queue = DomainQueue(lambda address: address.rsplit("@", 1)[-1], limiter)
+
+    queue.put("johndoe@example.org")
+
+    # in worker threads
+    address = queue.get()
+    # ... retrieve the profile ...
+    queue.task_done()
+
+The :class:`DomainQueue` has the interface of :class:`Queue.Queue`. ``None`` items are used
+to terminate workers; they are not rate-limited and only handed out when no other items are
+left.
+
+Optionally, the items are also written to a :class:`~sduds.lib.diskqueue.Journal`, so that
+they survive a restart. In this case, at most ``memory_size`` items are kept in memory; the
+others are only counted per domain and read from the journal when their domain is served.
+``None`` items are handed out first, because the remaining items are kept in the journal
+anyway.
+"""
+
+import threading, time, collections
+import Queue
+
+class RateLimiter:
+    """ Keeps a token bucket for each domain. Can be shared by several threads and
+        several :class:`DomainQueue` instances.
+    """
+
+    lock = None
+    buckets = None
+    prune_threshold = None
+
+    #: The number of tokens added to a bucket per second (float).
+    rate = None
+
+    #: The maximal number of tokens in a bucket (float).
+    burst = None
+
+    def __init__(self, rate, burst):
+        """ For a description of the arguments see the documentation of the attributes of this class. """
+
+        self.lock = threading.Lock()
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        # maps domains to (tokens, last_update) tuples; domains with full
+        # buckets are omitted to keep memory bounded
+        self.buckets = {}
+        self.prune_threshold = 1000
+
+    def _tokens(self, domain, now):
+        """ Returns the number of tokens of a domain. Must be called with the lock held. """
+
+        if not domain in self.buckets:
+            return self.burst
+
+        tokens, last_update = self.buckets[domain]
+        tokens = min(self.burst, tokens + (now - last_update)*self.rate)
+
+        return tokens
+
+    def delay(self, domain, now=None):
+        """ Returns the number of seconds until a token for a domain is available, or ``0``
+            if one is available now.
+
+            :param domain: the domain
+            :type domain: string
+            :param now: the current timestamp (optional)
+            :type now: float
+            :rtype: float
+        """
+
+        if now is None: now = time.time()
+
+        with self.lock:
+            tokens = self._tokens(domain, now)
+
+        if tokens>=1: return 0.
+
+        return (1 - tokens)/self.rate
+
+    def try_acquire(self, domain, now=None):
+        """ Consumes a token for a domain if one is available. Returns whether this was the case.
+
+            :param domain: the domain
+            :type domain: string
+            :param now: the current timestamp (optional)
+            :type now: float
+            :rtype: boolean
+        """
+
+        if now is None: now = time.time()
+
+        with self.lock:
+            tokens = self._tokens(domain, now)
+            if tokens<1: return False
+
+            self.buckets[domain] = (tokens - 1, now)
+
+            # forget buckets that are full again
+            if len(self.buckets)>self.prune_threshold:
+                for d in self.buckets.keys():
+                    if self._tokens(d, now)>=self.burst:
+                        del self.buckets[d]
+
+                self.prune_threshold = max(1000, 2*len(self.buckets))
+
+            return True
+
+    def acquire(self, domain):
+        """ Consumes a token for a domain, blocking until one is available.
+
+            :param domain: the domain
+            :type domain: string
+        """
+
+        while not self.try_acquire(domain):
+            time.sleep(self.delay(domain))
+
+class DomainQueue:
+    """ A :class:`Queue.Queue` replacement which hands out items of different domains in
+        round-robin order and respects the rate limits of a :class:`RateLimiter`.
+    """
+
+    condition = None
+    all_tasks_done = None
+    unfinished_tasks = None
+
+    domain_function = None
+    limiter = None
+    maxsize = None
+    journal = None
+    memory_size = None
+
+    queues = None
+    unloaded = None
+    last_ids = None
+    domains = None
+    size = None
+    in_memory = None
+    terminators = None
+
+    def __init__(self, domain_function, limiter, maxsize=0, journal=None, memory_size=500):
+        """ :param domain_function: returns the domain of an item, must be a string
+            :type domain_function: function
+            :param limiter: the rate limiter
+            :type limiter: :class:`RateLimiter`
+            :param maxsize: the maximal number of queued items, ``0`` for no limit (optional)
+                            -- ignored if a journal is used
+            :type maxsize: integer
+            :param journal: a journal the items are written to; items already in it are
+                            queued again (optional)
+            :type journal: :class:`~sduds.lib.diskqueue.Journal`
+            :param memory_size: the number of items kept in memory if a journal is used (optional)
+            :type memory_size: integer
+        """
+
+        self.condition = threading.Condition()
+        self.all_tasks_done = threading.Condition(self.condition)
+        self.unfinished_tasks = 0
+
+        self.domain_function = domain_function
+        self.limiter = limiter
+        self.journal = journal
+        self.memory_size = memory_size
+
+        if journal:
+            self.maxsize = 0
+        else:
+            self.maxsize = maxsize
+
+        # one FIFO queue of (id, item) tuples in memory per domain, the number of items of
+        # each domain that are only in the journal, and the id of the last item read from
+        # the journal for each domain
+        self.queues = {}
+        self.unloaded = {}
+        self.last_ids = {}
+
+        # the domains with queued items in round-robin order
+        self.domains = collections.deque()
+
+        # number of queued items, and of those kept in memory
+        self.size = 0
+        self.in_memory = 0
+
+        # number of queued None items
+        self.terminators = 0
+
+        if journal:
+            for domain, number in journal.count_sources().iteritems():
+                self._add_domain(domain)
+                self.unloaded[domain] = number
+                self.size += number
+                self.unfinished_tasks += number
+
+    def _add_domain(self, domain):
+        """ Adds a domain to the round-robin order if it has no queued items yet. Must be
+            called with the lock held or from the constructor. """
+
+        if not domain in self.queues:
+            self.queues[domain] = collections.deque()
+            self.unloaded[domain] = 0
+            self.domains.append(domain)
+
+    def _remove_last_domain(self, domain):
+        """ Removes a domain without queued items, which was just rotated to the end of the
+            round-robin order. Must be called with the lock held. """
+
+        del self.queues[domain]
+        del self.unloaded[domain]
+        self.last_ids.pop(domain, None)
+        self.domains.pop()
+
+    def _append(self, item_id, item):
+        """ Appends an item to the queue of its domain, or only counts it if it is kept in
+            the journal. Must be called with the lock held. """
+
+        domain = self.domain_function(item)
+        self._add_domain(domain)
+
+        if not self.journal or (self.unloaded[domain]==0 and self.in_memory<self.memory_size):
+            self.queues[domain].append((item_id, item))
+            self.in_memory += 1
+        else:
+            # spill to disk; the earlier items of the domain are in memory or handed
+            # out, so the domain is read from the journal starting with this item
+            if self.unloaded[domain]==0:
+                self.last_ids[domain] = item_id - 1
+
+            self.unloaded[domain] += 1
+
+        self.size += 1
+
+    def _load(self, domain):
+        """ Reads the next items of a domain from the journal, as many as fit into memory
+            but at least one. Must be called with the lock held. """
+
+        limit = max(1, self.memory_size - self.in_memory)
+        rows = self.journal.load_source(domain, self.last_ids.get(domain), limit)
+
+        self.queues[domain].extend(rows)
+        self.in_memory += len(rows)
+
+        if rows:
+            self.unloaded[domain] -= len(rows)
+            self.last_ids[domain] = rows[-1][0]
+        else:
+            self.size -= self.unloaded[domain]
+            self.unloaded[domain] = 0
+
+    def put(self, item, block=True, timeout=None):
+        """ Puts an item into the queue. Same semantics as :meth:`Queue.Queue.put`. """
+
+        with self.condition:
+            if item is None:
+                self.terminators += 1
+            else:
+                if self.maxsize>0 and self.size>=self.maxsize:
+                    if not block:
+                        raise Queue.Full
+
+                    if timeout is None:
+                        while self.size>=self.maxsize:
+                            self.condition.wait()
+                    else:
+                        end = time.time() + timeout
+                        while self.size>=self.maxsize:
+                            remaining = end - time.time()
+                            if remaining<=0: raise Queue.Full
+                            self.condition.wait(remaining)
+
+                if self.journal:
+                    item_id = self.journal.append(item, source=self.domain_function(item))
+                else:
+                    item_id = None
+
+                self._append(item_id, item)
+
+            self.unfinished_tasks += 1
+            self.condition.notify_all()
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def _get_item(self):
+        """ Takes the next item of the first domain in round-robin order that has a token
+            left. Returns a tuple of a flag whether an item was found and the item or the
+            time to wait until a token will be available. Must be called with the lock held.
+        """
+
+        if self.journal and self.terminators>0:
+            self.terminators -= 1
+            self.journal.checkout(None)
+            return True, None
+
+        now = time.time()
+        min_delay = None
+
+        for i in xrange(len(self.domains)):
+            domain = self.domains[0]
+            self.domains.rotate(-1)
+
+            delay = self.limiter.delay(domain, now)
+            if delay==0:
+                # the queue is loaded before a token is taken, so that no token is
+                # used up for a domain whose items are missing in the journal
+                queue = self.queues[domain]
+                if not queue:
+                    self._load(domain)
+
+                if queue and self.limiter.try_acquire(domain, now):
+                    item_id, item = queue.popleft()
+                    self.size -= 1
+                    self.in_memory -= 1
+
+                    if self.journal:
+                        self.journal.checkout(item_id)
+
+                    if not queue and self.unloaded[domain]==0:
+                        self._remove_last_domain(domain)
+
+                    return True, item
+
+                if not queue:
+                    # the items of the domain were missing in the journal
+                    self._remove_last_domain(domain)
+
+                    if not self.domains: break
+                    continue
+
+                # the token was taken by another user of the limiter meanwhile
+                delay = self.limiter.delay(domain, now)
+
+            if min_delay is None or delay<min_delay: min_delay = delay
+
+        if not self.domains and self.terminators>0:
+            self.terminators -= 1
+            return True, None
+
+        return False, min_delay
+
+    def get(self, block=True, timeout=None):
+        """ Removes and returns an item from the queue. Same semantics as :meth:`Queue.Queue.get`. """
+
+        with self.condition:
+            if timeout is not None:
+                end = time.time() + timeout
+
+            while True:
+                found, result = self._get_item()
+                if found:
+                    self.condition.notify_all()
+                    return result
+
+                if not block:
+                    raise Queue.Empty
+
+                wait = result
+                if timeout is not None:
+                    remaining = end - time.time()
+                    if remaining<=0: raise Queue.Empty
+                    if wait is None or remaining<wait: wait = remaining
+
+                self.condition.wait(wait)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        """ Same semantics as :meth:`Queue.Queue.task_done`. """
+
+        with self.condition:
+            unfinished = self.unfinished_tasks - 1
+
+            if unfinished<0:
+                raise ValueError("task_done() called too many times")
+
+            if self.journal:
+                self.journal.finish()
+
+            if unfinished==0:
+                self.all_tasks_done.notify_all()
+
+            self.unfinished_tasks = unfinished
+
+    def join(self):
+        """ Blocks until :meth:`task_done` was called for every item. """
+
+        with self.condition:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def qsize(self):
+        with self.condition:
+            return self.size + self.terminators
+
+    def empty(self):
+        return self.qsize()==0
+
+    def full(self):
+        with self.condition:
+            return self.maxsize>0 and self.size>=self.maxsize
+
+    def backlog(self):
+        """ Returns the number of queued items for each domain.
+
+            :rtype: dict mapping domains to integers
+        """
+
+        with self.condition:
+            return dict((domain, len(queue) + self.unloaded[domain]) for domain, queue in self.queues.iteritems())
+
+    def close(self):
+        """ Closes the journal, if any. Items which are still queued are queued again
+            by a new queue using the same journal database.
+        """
+
+        with self.condition:
+            if self.journal:
+                self.journal.close()
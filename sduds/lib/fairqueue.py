@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+
+"""
+This module implements a work queue which shares the workers fairly between the sources
+of the items, so that a large backlog of one source does not hold up the items of the
+others.
+
+Each source has its own FIFO sub-queue and a weight. The sources are served by stride
+scheduling, a deterministic form of weighted round-robin: each source has a pass value
+which is increased by ``1/weight`` whenever one of its items is handed out, and the
+source with the lowest pass value is served next. A source that becomes active again
+starts at the pass value of the last served source, so it cannot save up turns while
+it is idle.
+
+Additionally, sources age: the key by which the sources are ordered is their pass value
+plus ``aging`` times the time when they were last served. A source which was not served
+for ``t`` seconds therefore gains ``aging*t`` on all sources which were served just now.
+Since the current time adds the same amount to the key of every source, the order of the
+keys does not change with time, and the active sources can be kept in a heap. Putting
+and getting items takes ``O(log n)`` time for ``n`` active sources.
+
+Example usage::
+
+    queue = FairQueue(lambda claim: claim.partner_name, lambda source: 10 if source is None else 1)
+
+    queue.put(claim)
+
+    # in worker threads
+    claim = queue.get()
+    # ... validate the claim ...
+    queue.task_done()
+
+The :class:`FairQueue` has the interface of :class:`Queue.Queue`. ``None`` items are used to
+terminate workers; they are only handed out when no other items are left. Optionally, the
+items are written to a :class:`~sduds.lib.diskqueue.Journal`; then at most ``memory_size``
+items of all sub-queues together are kept in memory, the items survive a restart, and ``None``
+items are handed out first, because the remaining items are kept in the journal anyway.
+"""
+
+import threading, time, collections, heapq
+import Queue
+
+class Source:
+    """ The sub-queue of a source and its scheduling state. """
+
+    name = None
+    weight = None
+
+    items = None
+    unloaded = None
+    last_id = None
+
+    pass_value = None
+    last_served = None
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = float(weight)
+
+        # (id, item) tuples in memory, and the number of items that are only in the journal
+        self.items = collections.deque()
+        self.unloaded = 0
+        self.last_id = None
+
+        self.pass_value = 0.
+        self.last_served = 0.
+
+    def __len__(self):
+        return len(self.items) + self.unloaded
+
+class FairQueue:
+    """ A :class:`Queue.Queue` replacement which hands out the items of different sources
+        by weighted round-robin with aging.
+    """
+
+    condition = None
+    all_tasks_done = None
+    unfinished_tasks = None
+
+    source_function = None
+    weight_function = None
+    aging = None
+    maxsize = None
+    journal = None
+    memory_size = None
+
+    sources = None
+    heap = None
+    virtual_pass = None
+    size = None
+    in_memory = None
+    terminators = None
+
+    #: The number of handed out items for each source (dict).
+    served = None
+
+    def __init__(self, source_function, weight_function, aging=0., maxsize=0, journal=None, memory_size=500):
+        """ :param source_function: returns the source of an item, must be a string or ``None``
+                                    if a journal is used
+            :type source_function: function
+            :param weight_function: returns the weight of a source, a positive number
+            :type weight_function: function
+            :param aging: the gain of the key of a waiting source per second, see above (optional)
+            :type aging: float
+            :param maxsize: the maximal number of queued items, ``0`` for no limit (optional)
+                            -- ignored if a journal is used
+            :type maxsize: integer
+            :param journal: a journal the items are written to; items already in it are
+                            queued again (optional)
+            :type journal: :class:`~sduds.lib.diskqueue.Journal`
+            :param memory_size: the number of items of all sources together kept in memory
+                                if a journal is used (optional)
+            :type memory_size: integer
+        """
+
+        self.condition = threading.Condition()
+        self.all_tasks_done = threading.Condition(self.condition)
+        self.unfinished_tasks = 0
+
+        self.source_function = source_function
+        self.weight_function = weight_function
+        self.aging = aging
+        self.journal = journal
+        self.memory_size = memory_size
+
+        if journal:
+            self.maxsize = 0
+        else:
+            self.maxsize = maxsize
+
+        # maps source names to Source instances, and heap of (key, name) tuples
+        # of the sources with queued items
+        self.sources = {}
+        self.heap = []
+
+        # the pass value of the last served source
+        self.virtual_pass = 0.
+
+        # number of queued items, and of those kept in memory
+        self.size = 0
+        self.in_memory = 0
+
+        self.terminators = 0
+        self.served = {}
+
+        if journal:
+            now = time.time()
+
+            for name, number in journal.count_sources().iteritems():
+                source = self._get_source(name)
+                source.unloaded = number
+                self.size += number
+                self.unfinished_tasks += number
+
+                self._activate(source, now)
+
+    def _get_source(self, name):
+        try:
+            return self.sources[name]
+        except KeyError:
+            source = Source(name, self.weight_function(name))
+            self.sources[name] = source
+            return source
+
+    def _push(self, source):
+        key = source.pass_value + self.aging*source.last_served
+        heapq.heappush(self.heap, (key, source.name))
+
+    def _activate(self, source, now):
+        """ Adds a source which has just got items to the heap. """
+
+        source.pass_value = max(source.pass_value, self.virtual_pass)
+        source.last_served = now
+        self._push(source)
+
+    def put(self, item, block=True, timeout=None):
+        """ Puts an item into the queue. Same semantics as :meth:`Queue.Queue.put`, but
+            never blocks if a journal is used.
+        """
+
+        with self.condition:
+            if item is None:
+                self.terminators += 1
+            else:
+                if self.maxsize>0 and self.size>=self.maxsize:
+                    if not block:
+                        raise Queue.Full
+
+                    if timeout is None:
+                        while self.size>=self.maxsize:
+                            self.condition.wait()
+                    else:
+                        end = time.time() + timeout
+                        while self.size>=self.maxsize:
+                            remaining = end - time.time()
+                            if remaining<=0: raise Queue.Full
+                            self.condition.wait(remaining)
+
+                name = self.source_function(item)
+                source = self._get_source(name)
+
+                if self.journal:
+                    item_id = self.journal.append(item, source=name)
+                else:
+                    item_id = None
+
+                was_empty = len(source)==0
+
+                if source.unloaded==0 and (not self.journal or self.in_memory<self.memory_size):
+                    source.items.append((item_id, item))
+                    self.in_memory += 1
+                else:
+                    # spill to disk
+                    source.unloaded += 1
+
+                self.size += 1
+
+                if was_empty:
+                    self._activate(source, time.time())
+
+            self.unfinished_tasks += 1
+            self.condition.notify_all()
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def _load(self, source):
+        """ Reads the next items of a source from the journal, as many as fit into memory
+            but at least one. Must be called with the lock held. """
+
+        limit = max(1, self.memory_size - self.in_memory)
+        rows = self.journal.load_source(source.name, source.last_id, limit)
+
+        source.items.extend(rows)
+        self.in_memory += len(rows)
+
+        if rows:
+            source.unloaded -= len(rows)
+        else:
+            self.size -= source.unloaded
+            source.unloaded = 0
+
+    def _get_item(self):
+        """ Takes the next item of the source with the lowest key. Returns a tuple of a
+            flag whether an item was found and the item. Must be called with the lock held.
+        """
+
+        if self.journal and self.terminators>0:
+            self.terminators -= 1
+            self.journal.checkout(None)
+            return True, None
+
+        while self.heap:
+            key, name = heapq.heappop(self.heap)
+            source = self.sources[name]
+
+            if not source.items and source.unloaded>0:
+                self._load(source)
+
+            if not source.items:
+                # the items of the source were missing in the journal
+                del self.sources[name]
+                continue
+
+            item_id, item = source.items.popleft()
+            if item_id is not None:
+                source.last_id = item_id
+
+            self.size -= 1
+            self.in_memory -= 1
+            self.served[name] = self.served.get(name, 0) + 1
+
+            if self.journal:
+                self.journal.checkout(item_id)
+
+            # advance the source by its stride
+            self.virtual_pass = source.pass_value
+            source.pass_value += 1/source.weight
+            source.last_served = time.time()
+
+            if len(source)>0:
+                self._push(source)
+            else:
+                # forget idle sources, but keep their pass value while they are active
+                del self.sources[name]
+
+            return True, item
+
+        if self.terminators>0:
+            self.terminators -= 1
+            return True, None
+
+        return False, None
+
+    def get(self, block=True, timeout=None):
+        """ Removes and returns an item from the queue. Same semantics as :meth:`Queue.Queue.get`. """
+
+        with self.condition:
+            if timeout is not None:
+                end = time.time() + timeout
+
+            while True:
+                found, item = self._get_item()
+                if found:
+                    self.condition.notify_all()
+                    return item
+
+                if not block:
+                    raise Queue.Empty
+
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining<=0: raise Queue.Empty
+                    self.condition.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        """ Same semantics as :meth:`Queue.Queue.task_done`. If a journal is used, the item
+            which the current thread got first and for which ``task_done()`` was not called
+            yet is removed from it.
+        """
+
+        with self.condition:
+            unfinished = self.unfinished_tasks - 1
+
+            if unfinished<0:
+                raise ValueError("task_done() called too many times")
+
+            if self.journal:
+                self.journal.finish()
+
+            if unfinished==0:
+                self.all_tasks_done.notify_all()
+
+            self.unfinished_tasks = unfinished
+
+    def join(self):
+        """ Blocks until :meth:`task_done` was called for every item. """
+
+        with self.condition:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def qsize(self):
+        with self.condition:
+            return self.size + self.terminators
+
+    def empty(self):
+        return self.qsize()==0
+
+    def full(self):
+        with self.condition:
+            return self.maxsize>0 and self.size>=self.maxsize
+
+    def depths(self):
+        """ Returns the number of queued items for each source.
+
+            :rtype: dict mapping sources to integers
+        """
+
+        with self.condition:
+            return dict((name, len(source)) for name, source in self.sources.iteritems())
+
+    def close(self):
+        """ Closes the journal, if any. Items which are still queued are queued again
+            by a new queue using the same journal database.
+        """
+
+        with self.condition:
+            if self.journal:
+                self.journal.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+This module implements a replacement for :func:`threading.Lock` which records how long
+threads wait for the lock and how long they hold it, to find out where the threads of
+the application stall.
+
+While the instrumentation is enabled, each acquisition is measured: The waiting time and
+the holding time are observed by histograms of the metrics :data:`~sduds.lib.metrics.registry`,
+labeled with the name of the lock. Additionally, the holding time is added up per call site,
+i.e. the file, line and function which acquired the lock, so that the callers holding the
+lock longest can be listed with :meth:`InstrumentedLock.top_holders`.
+
+The instrumentation is switched on and off for all locks at once with :func:`enable` and
+:func:`disable`, also while the application is running. When it is disabled, acquiring and
+releasing a lock only costs a check of a global flag in addition.
+
+Example usage::
+
+    lock = InstrumentedLock("statedb")
+
+    enable()
+
+    with lock:
+        # ... access the database ...
+
+    for site, count, seconds in lock.top_holders(5):
+        print "%s:%d (%s)" % site, count, seconds
+"""
+
+import threading, time, sys, weakref
+
+from metrics import registry
+
+wait_duration = registry.histogram("lock_wait_seconds", "Time spent waiting for a lock.", ["lock"],
+    buckets=(0.0001, 0.001, 0.01, 0.1, 1., 10., 60.))
+hold_duration = registry.histogram("lock_hold_seconds", "Time a lock was held.", ["lock"],
+    buckets=(0.0001, 0.001, 0.01, 0.1, 1., 10., 60.))
+
+holder_duration = registry.gauge("lock_holder_seconds", "Total time the top call sites held a lock.", ["lock", "site"])
+
+#: Whether the locks are instrumented (boolean), switched by :func:`enable` and :func:`disable`.
+enabled = False
+
+# all instrumented locks, for the metrics collector
+_locks = weakref.WeakSet()
+
+def enable():
+    """ Switches the instrumentation of all locks on. """
+
+    global enabled
+    enabled = True
+
+def disable():
+    """ Switches the instrumentation of all locks off. The recorded data is kept. """
+
+    global enabled
+    enabled = False
+
+def collect_metrics(number=10):
+    """ Sets the :data:`holder_duration` gauge to the holding times of the top call sites of each lock. """
+
+    values = {}
+
+    for lock in list(_locks):
+        for (filename, line, function), count, seconds in lock.top_holders(number):
+            site = "%s:%d (%s)" % (filename, line, function)
+            values[(lock.name, site)] = values.get((lock.name, site), 0) + seconds
+
+    holder_duration.replace(values)
+
+registry.add_collector(collect_metrics)
+
+class InstrumentedLock(object):
+    """ A non-reentrant lock which can be used like :func:`threading.Lock`. """
+
+    lock = None
+    sites_lock = None
+
+    #: The name of the lock, used as label of the metrics (string).
+    name = None
+
+    acquired_at = None
+    acquired_by = None
+
+    #: Maps call sites, i.e. ``(filename, line, function)`` tuples, to lists
+    #: ``[acquisitions, holding time]``.
+    holders = None
+
+    def __init__(self, name):
+        """ For a description of the arguments see the documentation of the attributes of this class. """
+
+        self.lock = threading.Lock()
+        self.sites_lock = threading.Lock()
+        self.name = name
+        self.holders = {}
+
+        _locks.add(self)
+
+    def _acquire(self, blocking, depth):
+        if not enabled:
+            acquired = self.lock.acquire(blocking)
+            if acquired: self.acquired_at = None
+            return acquired
+
+        start = time.time()
+        acquired = self.lock.acquire(blocking)
+        if not acquired: return False
+
+        self.acquired_at = now = time.time()
+
+        frame = sys._getframe(depth)
+        self.acquired_by = (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+        wait_duration.observe(now - start, self.name)
+        return True
+
+    def acquire(self, blocking=True):
+        """ Same semantics as the ``acquire()`` method of :func:`threading.Lock`. """
+
+        return self._acquire(blocking, 2)
+
+    def release(self):
+        """ Same semantics as the ``release()`` method of :func:`threading.Lock`. """
+
+        acquired_at = self.acquired_at
+        acquired_by = self.acquired_by
+        self.acquired_at = None
+
+        self.lock.release()
+
+        # only measure if the instrumentation was enabled when the lock was acquired
+        if acquired_at is None: return
+
+        duration = time.time() - acquired_at
+        hold_duration.observe(duration, self.name)
+
+        with self.sites_lock:
+            try:
+                entry = self.holders[acquired_by]
+            except KeyError:
+                entry = self.holders[acquired_by] = [0, 0.]
+
+            entry[0] += 1
+            entry[1] += duration
+
+    def __enter__(self):
+        self._acquire(True, 2)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def top_holders(self, number=10):
+        """ Returns the call sites which held the lock longest in total.
+
+            :param number: the maximal number of call sites (optional)
+            :type number: integer
+            :rtype: list of ``(site, acquisitions, holding time)`` tuples, where ``site`` is a
+                    ``(filename, line, function)`` tuple
+        """
+
+        with self.sites_lock:
+            entries = [(site, count, seconds) for site, (count, seconds) in self.holders.iteritems()]
+
+        entries.sort(key=lambda entry: entry[2], reverse=True)
+
+        return entries[:number]
+
+    def reset(self):
+        """ Forgets the recorded call sites. """
+
+        with self.sites_lock:
+            self.holders = {}
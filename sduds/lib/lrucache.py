@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+This module implements a thread-safe cache with a bounded number of entries. If the cache is
+full, the least recently used entry is evicted. Entries may additionally be given an expiry
+timestamp, after which they are treated as absent.
+
+Example usage::
+
+    cache = LRUCache(1000)
+
+    cache.set("example.org", "http://example.org/describe?uri={uri}", time.time()+3600)
+
+    template = cache.get("example.org")
+    if template is None:
+        # ... not cached or expired ...
+"""
+
+import threading, time
+import collections
+
+class LRUCache:
+    """ A mapping with a bounded number of entries and optional expiry times. """
+
+    lock = None
+    entries = None
+    max_size = None
+
+    #: The number of successful lookups (integer).
+    hits = None
+
+    #: The number of lookups for absent or expired entries (integer).
+    misses = None
+
+    def __init__(self, max_size):
+        """ :param max_size: the maximal number of entries
+            :type max_size: integer
+        """
+
+        self.lock = threading.Lock()
+        self.max_size = max_size
+
+        # maps keys to (value, expires) tuples, least recently used first
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None, reference_timestamp=None):
+        """ Returns the value for a key, or ``default`` if the key is absent or the
+            entry has expired.
+
+            :param key: the key
+            :param default: the value returned for absent keys (optional)
+            :param reference_timestamp: the timestamp to compare expiry times against (optional)
+                                        -- defaults to the current time
+            :type reference_timestamp: float
+        """
+
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None:
+                if reference_timestamp is None:
+                    reference_timestamp = time.time()
+
+                if expires<=reference_timestamp:
+                    self.misses += 1
+                    return default
+
+            # reinsert to mark the entry as most recently used
+            self.entries[key] = (value, expires)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value, expires=None):
+        """ Stores a value, evicting the least recently used entry if the cache is full.
+
+            :param key: the key
+            :param value: the value
+            :param expires: the timestamp after which the entry is invalid (optional)
+                            -- by default, entries do not expire
+            :type expires: float
+        """
+
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            elif len(self.entries)>=self.max_size:
+                self.entries.popitem(last=False)
+
+            self.entries[key] = (value, expires)
+
+    def keys(self):
+        """ Returns the keys of all entries, including expired ones, least recently used
+            first. Lookups do not change the order of the returned list.
+
+            :rtype: list
+        """
+
+        with self.lock:
+            return self.entries.keys()
+
+    def delete(self, key):
+        """ Removes an entry. Does nothing if the key is absent.
+
+            :param key: the key
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """ Removes all entries. """
+
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
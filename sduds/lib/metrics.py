@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+This module implements in-process metrics which can be exported in the text format of the
+Prometheus monitoring system.
+
+There are three kinds of metrics: A :class:`Counter` only goes up, e.g. the number of saved
+states. A :class:`Gauge` is set to the current value of something, e.g. the depth of a queue.
+A :class:`Histogram` counts observations, e.g. durations, in buckets. Each metric may have
+labels; the values of the labels are passed as positional arguments when the metric is
+updated. Updating a metric only takes a lock and a dictionary update.
+
+Metrics are created by a :class:`Registry`. Values which are expensive to keep up to date,
+like the size of a database, can be set by collector functions, which the registry calls
+right before rendering.
+
+Example usage::
+
+    saved = registry.counter("states_saved_total", "Number of saved states.")
+    latency = registry.histogram("retrieval_seconds", "Retrieval latency.", ["outcome"])
+
+    saved.inc()
+
+    with latency.time("success"):
+        # ... retrieve a profile ...
+
+    print registry.render()
+
+The metrics used by sduds are created in the module-level :data:`registry`.
+"""
+
+import threading, time, math
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 300.)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def _format_value(value):
+    if value==float("inf"):
+        return "+Inf"
+    elif value==float("-inf"):
+        return "-Inf"
+    elif math.isnan(value):
+        return "NaN"
+    elif value==int(value):
+        return str(int(value))
+    else:
+        return repr(float(value))
+
+def _format_sample(name, labelnames, labelvalues, value):
+    if labelnames:
+        labels = ",".join('%s="%s"' % (n, _escape(v)) for n, v in zip(labelnames, labelvalues))
+        return "%s{%s} %s" % (name, labels, _format_value(value))
+    else:
+        return "%s %s" % (name, _format_value(value))
+
+class Metric:
+    """ Base class of the metrics. """
+
+    metric_type = None
+
+    lock = None
+
+    #: The name of the metric (string).
+    name = None
+
+    #: The help text (string).
+    documentation = None
+
+    #: The names of the labels (tuple of strings).
+    labelnames = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """ For a description of the arguments see the documentation of the attributes of this class. """
+
+        self.lock = threading.Lock()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _check_labels(self, labelvalues):
+        if len(labelvalues)!=len(self.labelnames):
+            raise ValueError("%s expects the labels %s" % (self.name, ", ".join(self.labelnames)))
+
+    def samples(self):
+        """ Returns the samples of the metric as ``(name, labelnames, labelvalues, value)`` tuples. """
+
+        raise NotImplementedError
+
+    def render(self):
+        """ Returns the metric in the Prometheus text format.
+
+            :rtype: string
+        """
+
+        lines = ["# HELP %s %s" % (self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n")),
+                 "# TYPE %s %s" % (self.name, self.metric_type)]
+
+        for sample in self.samples():
+            lines.append(_format_sample(*sample))
+
+        return "\n".join(lines) + "\n"
+
+class Counter(Metric):
+    """ A value which only increases. """
+
+    metric_type = "counter"
+
+    values = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, *labelvalues):
+        """ Increases the counter by one. """
+
+        self.add(1, *labelvalues)
+
+    def add(self, amount, *labelvalues):
+        """ Increases the counter.
+
+            :param amount: a non-negative number
+            :type amount: float
+        """
+
+        self._check_labels(labelvalues)
+
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues):
+        """ Returns the current value. """
+
+        with self.lock:
+            return self.values.get(labelvalues, 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+
+        return [(self.name, self.labelnames, labelvalues, value) for labelvalues, value in values]
+
+class Gauge(Counter):
+    """ A value which may go up and down. """
+
+    metric_type = "gauge"
+
+    def set(self, value, *labelvalues):
+        """ Sets the value. """
+
+        self._check_labels(labelvalues)
+
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def replace(self, values):
+        """ Replaces all values, so that label values which are not given any more are removed.
+
+            :param values: maps tuples of label values to values
+            :type values: dict
+        """
+
+        for labelvalues in values:
+            self._check_labels(labelvalues)
+
+        with self.lock:
+            self.values = dict(values)
+
+class Timer:
+    """ Context manager returned by :meth:`Histogram.time`. """
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, *self.labelvalues)
+
+class Histogram(Metric):
+    """ Counts observed values in buckets. """
+
+    metric_type = "histogram"
+
+    #: The upper bounds of the buckets, without ``+Inf`` (tuple of floats).
+    buckets = None
+
+    values = None
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        # maps label values to lists [bucket counts..., sum, count]
+        self.values = {}
+
+    def observe(self, value, *labelvalues):
+        """ Counts a value. """
+
+        self._check_labels(labelvalues)
+
+        with self.lock:
+            try:
+                counts = self.values[labelvalues]
+            except KeyError:
+                counts = self.values[labelvalues] = [0]*(len(self.buckets)+2)
+
+            for i, bound in enumerate(self.buckets):
+                if value<=bound:
+                    counts[i] += 1
+                    break
+
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, *labelvalues):
+        """ Returns a context manager which observes the time spent in its block. """
+
+        self._check_labels(labelvalues)
+        return Timer(self, labelvalues)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labelvalues, list(counts)) for labelvalues, counts in self.values.iteritems())
+
+        samples = []
+        bucket_labelnames = self.labelnames + ("le",)
+
+        for labelvalues, counts in values:
+            # buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name+"_bucket", bucket_labelnames, labelvalues+(_format_value(bound),), cumulative))
+            samples.append((self.name+"_bucket", bucket_labelnames, labelvalues+("+Inf",), counts[-1]))
+
+            samples.append((self.name+"_sum", self.labelnames, labelvalues, counts[-2]))
+            samples.append((self.name+"_count", self.labelnames, labelvalues, counts[-1]))
+
+        return samples
+
+class Registry:
+    """ Creates metrics and renders all of them. """
+
+    lock = None
+    metrics = None
+    collectors = None
+
+    #: Prefix of the names of all metrics created by this registry (string).
+    prefix = None
+
+    def __init__(self, prefix=""):
+        """ For a description of the arguments see the documentation of the attributes of this class. """
+
+        self.lock = threading.Lock()
+        self.prefix = prefix
+
+        # maps names to metrics
+        self.metrics = {}
+
+        self.collectors = []
+
+    def _get_metric(self, cls, name, *args):
+        """ Returns the metric of the given name, creating it if necessary. """
+
+        name = self.prefix + name
+
+        with self.lock:
+            metric = self.metrics.get(name)
+
+            if metric is None:
+                metric = cls(name, *args)
+                self.metrics[name] = metric
+            elif not metric.__class__==cls:
+                raise ValueError("Metric %s exists already with a different type." % name)
+
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """ Returns the :class:`Counter` with the given name, creating it if necessary. """
+
+        return self._get_metric(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """ Returns the :class:`Gauge` with the given name, creating it if necessary. """
+
+        return self._get_metric(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """ Returns the :class:`Histogram` with the given name, creating it if necessary. """
+
+        return self._get_metric(Histogram, name, documentation, labelnames, buckets)
+
+    def add_collector(self, collector):
+        """ Adds a function which is called without arguments before the metrics are rendered,
+            to update gauges.
+        """
+
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            self.collectors.remove(collector)
+
+    def render(self):
+        """ Calls the collectors and returns all metrics in the Prometheus text format.
+
+            :rtype: string
+        """
+
+        with self.lock:
+            collectors = list(self.collectors)
+
+        for collector in collectors:
+            collector()
+
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+
+        return "".join(metric.render() for name, metric in metrics)
+
+#: The registry of the metrics of sduds, rendered by the ``/metrics`` page of the monitoring server.
+registry = Registry("sduds_")
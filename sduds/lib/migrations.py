@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+This module keeps track of the schema version of a database and upgrades older databases
+by an ordered list of migrations, so that changes of the schema, e.g. new indexes, also
+reach databases which were created by an earlier version of the program.
+
+A migration is a function which is called with a sqlalchemy connection and changes the
+schema from one version to the next. The version of a database is the number of
+migrations applied to it and is stored in the ``schema_version`` table.
+
+New databases are created with the current schema by :func:`upgrade` and get the latest
+version at once, without applying any migration. A database which has some of the
+tables, but no ``schema_version`` table, was created before the versioning was
+introduced and gets all migrations applied. Missing tables are only created after the
+pending migrations were applied, so a migration always finds the database as the
+previous migration, or an interrupted attempt of itself, left it.
+
+Because SQLite commits the running transaction before most schema changes, a migration
+is not applied atomically. Migrations should therefore be written so that they can be
+applied again after they were interrupted, e.g. by using ``CREATE INDEX IF NOT EXISTS``.
+A migration which replaces a table by a copy must resume from the copy if the original
+table was already dropped, and a migration must skip tables which do not exist yet.
+
+Example usage::
+
+    def add_timestamp_index(connection):
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_states_timestamp ON states (timestamp)")
+
+    migrations = [add_timestamp_index]
+
+    engine = sqlalchemy.create_engine("sqlite:///states.sqlite")
+    upgrade(engine, [metadata], migrations)
+"""
+
+import sqlalchemy
+
+version_metadata = sqlalchemy.MetaData()
+
+version_table = sqlalchemy.Table("schema_version", version_metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer, nullable=False)
+)
+
+def get_version(connection):
+    """ Returns the schema version of a database, or ``None`` if it is not versioned.
+
+        :param connection: a connection to the database
+        :type connection: :class:`sqlalchemy.engine.base.Connection`
+        :rtype: integer or NoneType
+    """
+
+    if not connection.dialect.has_table(connection, version_table.name):
+        return None
+
+    return connection.execute(sqlalchemy.select([version_table.c.version])).scalar()
+
+def set_version(connection, version):
+    """ Stores the schema version of a database.
+
+        :param connection: a connection to the database
+        :type connection: :class:`sqlalchemy.engine.base.Connection`
+        :param version: the number of migrations applied
+        :type version: integer
+    """
+
+    version_table.create(connection, checkfirst=True)
+
+    if connection.execute(version_table.update().values(version=version)).rowcount==0:
+        connection.execute(version_table.insert().values(version=version))
+
+def upgrade(engine, metadatas, migrations):
+    """ Applies the migrations which were not yet applied to a database and creates its
+        missing tables afterwards. Returns the number of migrations applied.
+
+        :param engine: the engine of the database
+        :type engine: :class:`sqlalchemy.engine.base.Engine`
+        :param metadatas: the metadata of all tables of the database in the current schema
+        :type metadatas: list of :class:`sqlalchemy.MetaData`
+        :param migrations: the migrations in the order they must be applied
+        :type migrations: list of functions
+        :rtype: integer
+    """
+
+    connection = engine.connect()
+
+    try:
+        version = get_version(connection)
+
+        if version is None:
+            tables = [table.name for metadata in metadatas for table in metadata.sorted_tables]
+            existing = any(connection.dialect.has_table(connection, name) for name in tables)
+
+            # a new database gets the current schema, an older one all migrations
+            if existing:
+                version = 0
+            else:
+                version = len(migrations)
+
+        applied = 0
+
+        while version<len(migrations):
+            migrations[version](connection)
+
+            version += 1
+            applied += 1
+
+            set_version(connection, version)
+
+        for metadata in metadatas:
+            metadata.create_all(connection)
+
+        if get_version(connection) is None:
+            set_version(connection, version)
+
+        return applied
+    finally:
+        connection.close()
@@ -5,23 +5,30 @@ This is an implementation of a simple job scheduler. It accepts either a cron-li
 
 Example usage::
 
+    scheduler = Scheduler()
+    scheduler.start()
+
     def callback(*args):
         # ... do work ...
         return time.time()
 
     pattern = CronPattern("0-30/5", "4,5", "3", "*", "*")
     job = Job(pattern, callback, arguments)
-    job.start()
+    job.start(scheduler)
 
     # ... callback(arguments) will be executed regularly ...
 
     job.terminate()
+    scheduler.terminate()
+
+All jobs of a :class:`Scheduler` share one timer thread, which waits for the next due job,
+and a fixed number of worker threads, which execute the callbacks.
 
 .. note:: All times are UTC.
 
 """
 
-import time, calendar, threading
+import time, calendar, bisect, threading, heapq, logging, Queue
 
 class TimePattern:
     """ Abstract base class for time patterns that specify at which times to execute a callback. """
@@ -101,7 +108,7 @@ def parse_field(field, first, last):
     return fieldset
 
 def normalize(year, month, dom, hour, minute):
-    """ Normalizes as datetime, used by :class:`CronPattern`.
+    """ Normalizes as datetime.
         Normalizing means: If one of the arguments is too large by one,
         the excess it carried to the unit of measurement next in size.
         The function has the limitations that it can only handle an excess
@@ -185,6 +192,12 @@ class CronPattern(TimePattern):
         self.month = parse_field(month, 1, 12)
         self.dow = parse_field(dow, 0, 6)
 
+        # sorted tables of the valid values, to jump to the next valid value with bisect
+        self.minutes = sorted(self.minute)
+        self.hours = sorted(self.hour)
+        self.doms = sorted(self.dom)
+        self.months = sorted(self.month)
+
     def next_clearance(self, last_clearance):
         """ throws a :class:`NoMatchingTimestamp` exception if no timestamp within a range of MAX_YEARS matches. """
         year,month,dom,hour,minute,second,dow,doy,isdst = time.gmtime(last_clearance)
@@ -192,52 +205,90 @@ class CronPattern(TimePattern):
         # to avoid an infinite loop if no time matches the pattern
         stop_year = year + MAX_YEARS
 
-        # start with the beginning of the next minute
+        # start with the beginning of the next minute; values which are too large by one
+        # are carried over, because no valid value is found for them
         minute += 1
-        second = 0
-        year, month, dom, hour, minute, dow = normalize(year, month, dom, hour, minute)
 
-        while True:
-            if year>stop_year:
-                raise NoMatchingTimestamp
-
-            if month not in self.month:
+        while year<=stop_year:
+            i = bisect.bisect_left(self.months, month)
+            if i==len(self.months):
+                # go to beginning of next year
+                year += 1
+                month,dom,hour,minute = 1,1,0,0
+                continue
+            elif self.months[i]!=month:
+                month,dom,hour,minute = self.months[i],1,0,0
+
+            valid_dom = self._next_dom(year, month, dom)
+            if valid_dom is None:
                 # go to beginning of next month
                 month += 1
+                dom,hour,minute = 1,0,0
+                continue
+            elif valid_dom!=dom:
+                dom,hour,minute = valid_dom,0,0
 
-                dom=1
-                hour=0
-                minute=0
-                second=0
-            elif dom not in self.dom or dow not in self.dow:
+            i = bisect.bisect_left(self.hours, hour)
+            if i==len(self.hours):
                 # go to beginning of the next day
                 dom += 1
-                hour = 0
-                minute = 0
-                second = 0
-            elif hour not in self.hour:
+                hour,minute = 0,0
+                continue
+            elif self.hours[i]!=hour:
+                hour,minute = self.hours[i],0
+
+            i = bisect.bisect_left(self.minutes, minute)
+            if i==len(self.minutes):
                 # go to beginning of the next hour
                 hour += 1
                 minute = 0
-                second = 0
-            elif minute not in self.minute:
-                # go to beginning of next minute
-                minute += 1
-                second = 0
-            else:
-                # everything is fitting, so return this time
-                timestamp = calendar.timegm((year,month,dom,hour,minute,second,dow,doy,isdst))
-                return timestamp
+                continue
+
+            # everything is fitting, so return this time
+            return calendar.timegm((year,month,dom,hour,self.minutes[i],0))
 
-            # reconvert it to a proper date (i.e. hour=24 -> hour=0)
-            year, month, dom, hour, minute, dow = normalize(year, month, dom, hour, minute)
+        raise NoMatchingTimestamp
 
-class Job(threading.Thread):
-    """ A :class:`threading.Thread` that executes a given callback
-        following a given :class:`TimePattern`.
+    def _next_dom(self, year, month, dom):
+        """ Returns the first day of the month from dom on that matches both the day of month and
+            the day of week, or None. """
+
+        first_dow,days_in_month = calendar.monthrange(year, month)
+
+        for valid_dom in self.doms[bisect.bisect_left(self.doms, dom):]:
+            if valid_dom>days_in_month: return None
+            if (first_dow+valid_dom-1)%7 in self.dow: return valid_dom
+
+        return None
+
+class Job:
+    """ Executes a given callback following a given :class:`TimePattern`. The callback is
+        called by the threads of a :class:`Scheduler`, but never by two threads at once.
     """
 
-    def __init__(self, pattern, callback, args=(), last_execution=None):
+    #: The time pattern (:class:`TimePattern`).
+    pattern = None
+
+    callback = None
+    args = None
+
+    #: The unix time stamp the last execution was registered for, as returned by the callback (integer).
+    last_execution = None
+
+    #: Due jobs with a lower priority are dispatched first, before all due jobs with a higher one which still wait for a worker (integer).
+    priority = None
+
+    #: The scheduler the job was added to, if any (:class:`Scheduler`).
+    scheduler = None
+
+    # whether the callback is being executed, guarded by the condition of the scheduler
+    running = False
+
+    # the sequence number of the job's entry in the heap of the scheduler; a dispatched
+    # entry with another number is outdated because the job was removed meanwhile
+    sequence = None
+
+    def __init__(self, pattern, callback, args=(), last_execution=None, priority=0):
         """ :param pattern: callback execution pattern
             :type pattern: :class:`TimePattern`
             :param callback: must return the unix time stamp for which the execution should be registered
@@ -246,8 +297,9 @@ class Job(threading.Thread):
             :type args: tuple
             :param last_execution: unix time stamp of the last execution (optional)
             :type last_execution: integer
+            :param priority: due jobs with a lower priority are dispatched first (optional)
+            :type priority: integer
         """
-        threading.Thread.__init__(self)
 
         self.pattern = pattern
 
@@ -255,8 +307,7 @@ class Job(threading.Thread):
         self.args = args
 
         self.last_execution = last_execution
-
-        self.finish = threading.Event()
+        self.priority = priority
 
     def overdue(self, reference_timestamp=None):
         """ This can be called before `start()` to determine
@@ -276,27 +327,215 @@ class Job(threading.Thread):
 
         return clearance <= reference_timestamp
 
-    def run(self):
-        if self.last_execution is None:
-            self.last_execution = self.callback(*self.args)
-
-        while True:
-            # calculate the time the callback must be called next
-            clearance = self.pattern.next_clearance(self.last_execution)
+    def start(self, scheduler=None):
+        """ Adds the :class:`Job` to a scheduler. If the job was never executed, the callback is called immediately.
 
-            # calculate interval
-            now = time.time()
-            interval = clearance - now
-            if interval<=0: interval=0
+            :param scheduler: the scheduler, by default a shared one which is started on first use (optional)
+            :type scheduler: :class:`Scheduler`
+        """
 
-            # wait
-            self.finish.wait(interval)
-            if self.finish.is_set(): return
+        if scheduler is None:
+            scheduler = default_scheduler()
 
-            # call callback
-            self.last_execution = self.callback(*self.args)
+        scheduler.add(self)
 
     def terminate(self):
         """ Terminates the :class:`Job` at the next opportunity; blocks until terminating is finished. """
-        self.finish.set()
-        self.join()
+
+        scheduler = self.scheduler
+        if scheduler: scheduler.remove(self)
+
+class Scheduler:
+    """ Executes the callbacks of many :class:`Job` objects with a single timer thread and
+        a bounded number of worker threads.
+
+        The timer thread keeps the jobs in a heap ordered by the time of their next clearance.
+        When jobs are due, it hands them to the worker threads through a priority queue, so
+        that a due job with a lower priority overtakes all jobs that are still waiting for a
+        worker, even if they became due earlier; after the callback returned,
+        the worker calculates the next clearance from the returned time stamp and puts the
+        job back into the heap.
+    """
+
+    condition = None
+    heap = None
+    sequence = None
+    jobs = None
+    tasks = None
+    finished = None
+
+    timer = None
+    workers = None
+
+    def __init__(self, workers=4):
+        """ :param workers: the number of worker threads, i.e. of callbacks executed at once (optional)
+            :type workers: integer
+        """
+
+        self.condition = threading.Condition()
+
+        # (clearance, sequence, job) tuples, the sequence keeps jobs with equal clearances in order
+        self.heap = []
+        self.sequence = 0
+
+        self.jobs = set()
+        # (priority, clearance, sequence, job) tuples of due jobs waiting for a worker
+        self.tasks = Queue.PriorityQueue()
+        self.finished = False
+
+        self.timer = threading.Thread(target=self._run_timer)
+        self.timer.daemon = True
+
+        self.workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._run_worker)
+            worker.daemon = True
+            self.workers.append(worker)
+
+    def start(self):
+        """ Starts the timer and worker threads. """
+
+        self.timer.start()
+
+        for worker in self.workers:
+            worker.start()
+
+    def add(self, job):
+        """ Schedules a job. If the job was never executed, the callback is called immediately.
+
+            :param job: the job
+            :type job: :class:`Job`
+        """
+
+        with self.condition:
+            if job in self.jobs: return
+
+            if job.last_execution is None:
+                clearance = time.time()
+            else:
+                clearance = job.pattern.next_clearance(job.last_execution)
+
+            job.scheduler = self
+            self.jobs.add(job)
+            self._push(job, clearance)
+
+            self.condition.notify_all()
+
+    def remove(self, job):
+        """ Unschedules a job; blocks until its callback is finished if it is being executed.
+            If the job is due but its callback was not started yet, it is not executed anymore.
+
+            :param job: the job
+            :type job: :class:`Job`
+        """
+
+        with self.condition:
+            if not job in self.jobs: return
+
+            self.jobs.discard(job)
+            self.heap = [entry for entry in self.heap if entry[2] is not job]
+            heapq.heapify(self.heap)
+
+            while job.running:
+                self.condition.wait()
+
+            job.scheduler = None
+
+            self.condition.notify_all()
+
+    def terminate(self):
+        """ Unschedules all jobs and stops the threads; blocks until the running callbacks are finished. """
+
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+        if self.timer.is_alive():
+            self.timer.join()
+
+        # drop the jobs which are due but not started, so that the workers stop at once
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except Queue.Empty:
+                break
+
+        # the sentinels sort after all jobs
+        for worker in self.workers:
+            self.tasks.put((float("inf"), None, None, None))
+
+        for worker in self.workers:
+            if worker.is_alive(): worker.join()
+
+        with self.condition:
+            for job in self.jobs:
+                job.scheduler = None
+
+            self.jobs = set()
+            self.heap = []
+
+    def _push(self, job, clearance):
+        self.sequence += 1
+        job.sequence = self.sequence
+        heapq.heappush(self.heap, (clearance, self.sequence, job))
+
+    def _run_timer(self):
+        with self.condition:
+            while not self.finished:
+                now = time.time()
+
+                while self.heap and self.heap[0][0] <= now:
+                    clearance, sequence, job = heapq.heappop(self.heap)
+                    self.tasks.put((job.priority, clearance, sequence, job))
+
+                if self.heap:
+                    self.condition.wait(self.heap[0][0] - now)
+                else:
+                    self.condition.wait()
+
+    def _run_worker(self):
+        while True:
+            priority, clearance, sequence, job = self.tasks.get()
+            if job is None: return
+
+            with self.condition:
+                # the job was removed or the scheduler terminated after the job was dispatched
+                if not job in self.jobs or self.finished or sequence!=job.sequence:
+                    continue
+
+                job.running = True
+
+            try:
+                last_execution = job.callback(*job.args)
+            except Exception:
+                logging.getLogger(__name__).exception("Callback of job failed.")
+                # do not retry at once
+                last_execution = time.time()
+
+            with self.condition:
+                job.running = False
+                job.last_execution = last_execution
+
+                if job in self.jobs and not self.finished:
+                    try:
+                        self._push(job, job.pattern.next_clearance(last_execution))
+                    except NoMatchingTimestamp:
+                        self.jobs.discard(job)
+                        job.scheduler = None
+
+                self.condition.notify_all()
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+def default_scheduler():
+    """ Returns the shared :class:`Scheduler` used by :meth:`Job.start` if no scheduler is given. """
+
+    global _default_scheduler
+
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+            _default_scheduler.start()
+
+        return _default_scheduler
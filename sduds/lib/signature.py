@@ -6,11 +6,54 @@ the RSA PKCS#1 standard.
 
 As PyCrypto versions older than 2.5 do not include an implementation of PKCS#1,
 the paramiko module is used for that, which depends on PyCrypto.
+
+The same signatures are checked over and over again when profiles are re-synchronized
+or control samples are taken, so :func:`signature_valid` keeps the parsed public keys
+in :data:`public_key_cache` and the verification results in :data:`verification_cache`.
+The processes of a validation pool disable the verification cache with
+:func:`disable_verification_cache`, as each of them would only see a part of the
+signatures; the parent process looks the results up with :func:`cached_verification`
+before sending a state to the pool and stores them with :func:`cache_verification`.
 """
 
 import paramiko
 import base64, StringIO
 
+from sduds.lib.lrucache import LRUCache
+
+#: Maps base64-encoded public keys to parsed :class:`paramiko.RSAKey` instances.
+public_key_cache = LRUCache(16)
+
+#: Maps ``(public_key_base64, signature, data)`` tuples to verification results, or ``None``
+#: if the results are not cached in this process.
+verification_cache = LRUCache(100000)
+
+#: Maps private key blocks to parsed :class:`paramiko.RSAKey` instances, used by :func:`sign`.
+private_key_cache = LRUCache(16)
+
+def disable_verification_cache():
+    """ Stops caching verification results in this process. Meant as initializer of the
+        processes of a :class:`multiprocessing.Pool`. """
+
+    global verification_cache
+    verification_cache = None
+
+def cached_verification(public_key_base64, signature, data):
+    """ Returns the cached result of :func:`signature_valid` for the given arguments, or
+        ``None`` if there is none. """
+
+    if verification_cache is None: return None
+
+    return verification_cache.get((public_key_base64, signature, data))
+
+def cache_verification(public_key_base64, signature, data, valid):
+    """ Caches the result of a verification made by :func:`signature_valid`, e.g. in
+        another process. """
+
+    if verification_cache is None: return
+
+    verification_cache.set((public_key_base64, signature, data), valid)
+
 def signature_valid(public_key_base64, signature, data):
     """ Checks a signature of given data using the public key.
 
@@ -23,15 +66,24 @@ def signature_valid(public_key_base64, signature, data):
         :rtype: boolean
     """
 
-    public_key_data = base64.decodestring(public_key_base64)
-    public_key = paramiko.RSAKey(data=public_key_data)
+    valid = cached_verification(public_key_base64, signature, data)
+    if valid is not None: return valid
+
+    public_key = public_key_cache.get(public_key_base64)
+    if public_key is None:
+        public_key_data = base64.decodestring(public_key_base64)
+        public_key = paramiko.RSAKey(data=public_key_data)
+        public_key_cache.set(public_key_base64, public_key)
 
     sig_message = paramiko.Message()
     sig_message.add_string("ssh-rsa")
     sig_message.add_string(signature)
     sig_message.rewind()
 
-    return public_key.verify_ssh_sig(data, sig_message)
+    valid = bool(public_key.verify_ssh_sig(data, sig_message))
+    cache_verification(public_key_base64, signature, data, valid)
+
+    return valid
 
 def sign(private_key_block, data):
     """ Calculates signature for given data using the private key.
@@ -43,8 +95,11 @@ def sign(private_key_block, data):
         :returns: the raw signature
         :rtype: string
     """
-    f = StringIO.StringIO(private_key_block)
-    private_key = paramiko.RSAKey(file_obj=f)
+    private_key = private_key_cache.get(private_key_block)
+    if private_key is None:
+        f = StringIO.StringIO(private_key_block)
+        private_key = paramiko.RSAKey(file_obj=f)
+        private_key_cache.set(private_key_block, private_key)
 
     randpool = None # RSA keys don't need a random number generator for signing
     sig_message = private_key.sign_ssh_data(randpool, data)
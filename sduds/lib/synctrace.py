@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+This module records what happens during synchronizations, so that it can be found out
+which phase of a synchronization takes longest for which partner.
+
+A synchronization is described by a :class:`Session`. It is divided into phases, e.g. the
+reconciliation of the hash tries and the exchange of the deletion requests. For each
+phase, the session records its duration, the number of messages sent and received, and
+the number of bytes sent and received, which are counted by a :class:`CountingFile`
+wrapping the file of the partner socket.
+
+When the synchronization is finished, the record of the session is written as one line
+of JSON to a :class:`TraceLog`. The log file is rotated when it becomes too large. The
+trace log also keeps a summary of the sessions of each partner, see
+:meth:`TraceLog.summary`; the same summary can be calculated from the log files by
+:func:`summarize`.
+
+Example usage::
+
+    trace_log = TraceLog("synchronizations.jsonl")
+
+    f = CountingFile(partnersocket.makefile())
+    session = Session(partner_name, "client", f)
+
+    with session.phase("send_states") as phase:
+        phase.received += synchronization.receive_state_requests(f)
+        phase.sent += synchronization.send_states(f, statedb)
+
+    trace_log.write(session)
+"""
+
+import logging, logging.handlers
+import threading, time, json, os, copy
+
+class CountingFile:
+    """ Wraps a file-like object and counts the bytes read from and written to it. """
+
+    f = None
+
+    #: The number of bytes read (integer).
+    bytes_read = None
+
+    #: The number of bytes written (integer).
+    bytes_written = None
+
+    def __init__(self, f):
+        """ :param f: the file-like object, e.g. returned by :meth:`socket.socket.makefile`
+            :type f: file
+        """
+
+        self.f = f
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        self.f.write(data)
+        self.bytes_written += len(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class Phase:
+    """ The record of one phase of a :class:`Session`, returned by :meth:`Session.phase`. """
+
+    session = None
+    name = None
+
+    start = None
+    bytes_read = None
+    bytes_written = None
+
+    #: The duration of the phase in seconds (float).
+    duration = None
+
+    #: The number of messages sent (integer), to be increased by the caller.
+    sent = None
+
+    #: The number of messages received (integer), to be increased by the caller.
+    received = None
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+        self.sent = 0
+        self.received = 0
+
+    def __enter__(self):
+        f = self.session.f
+        if f:
+            self.bytes_read = f.bytes_read
+            self.bytes_written = f.bytes_written
+
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+
+        record = {"duration": self.duration, "sent": self.sent, "received": self.received}
+
+        f = self.session.f
+        if f:
+            record["bytes_sent"] = f.bytes_written - self.bytes_written
+            record["bytes_received"] = f.bytes_read - self.bytes_read
+
+        self.session.phases[self.name] = record
+
+        for callback in self.session.phase_callbacks:
+            callback(self)
+
+class Session:
+    """ The record of one synchronization with a partner. """
+
+    f = None
+    phase_callbacks = None
+
+    #: The name of the partner (string).
+    partner_name = None
+
+    #: Either ``"server"`` or ``"client"`` (string).
+    role = None
+
+    #: Either ``"reconciliation"`` or, if all states were transferred before the reconciliation, ``"catch_up"`` (string).
+    mode = None
+
+    #: The time the synchronization started (float).
+    start = None
+
+    #: The number of hashes found missing by the reconciliation (integer).
+    missing_hashes = None
+
+    #: The number of received states which were dropped because a queue was full (integer).
+    drops = None
+
+    #: Maps the names of the finished phases to dictionaries with the keys ``duration``,
+    #: ``sent``, ``received`` and, if a :class:`CountingFile` is used, ``bytes_sent`` and
+    #: ``bytes_received``.
+    phases = None
+
+    def __init__(self, partner_name, role, f=None, phase_callbacks=()):
+        """ :param partner_name: the name of the partner
+            :type partner_name: string
+            :param role: either ``"server"`` or ``"client"``
+            :type role: string
+            :param f: the file the messages are exchanged through (optional)
+            :type f: :class:`CountingFile`
+            :param phase_callbacks: functions called with each :class:`Phase` when it is finished (optional)
+            :type phase_callbacks: list of functions
+        """
+
+        self.partner_name = partner_name
+        self.role = role
+        self.f = f
+        self.phase_callbacks = list(phase_callbacks)
+
+        self.start = time.time()
+        self.mode = "reconciliation"
+        self.missing_hashes = 0
+        self.drops = 0
+        self.phases = {}
+
+    def phase(self, name):
+        """ Returns a context manager which records a phase. The messages must be counted
+            by increasing the ``sent`` and ``received`` attributes of the object it returns.
+
+            :param name: the name of the phase
+            :type name: string
+            :rtype: :class:`Phase`
+        """
+
+        return Phase(self, name)
+
+    def record(self):
+        """ Returns the record of the session, which is written to the trace log.
+
+            :rtype: dictionary
+        """
+
+        record = {"partner": self.partner_name,
+                  "role": self.role,
+                  "mode": self.mode,
+                  "start": self.start,
+                  "duration": time.time() - self.start,
+                  "missing_hashes": self.missing_hashes,
+                  "drops": self.drops,
+                  "phases": self.phases}
+
+        return record
+
+def _add_record(summary, record):
+    """ Adds a session record to a summary as returned by :func:`summarize`. """
+
+    partner = summary.setdefault(record["partner"], {"sessions": 0, "duration": 0., "missing_hashes": 0, "drops": 0, "phases": {}})
+
+    partner["sessions"] += 1
+    partner["duration"] += record["duration"]
+    partner["missing_hashes"] += record["missing_hashes"]
+    partner["drops"] += record["drops"]
+
+    for name, values in record["phases"].iteritems():
+        totals = partner["phases"].setdefault(name, {})
+
+        for key, value in values.iteritems():
+            totals[key] = totals.get(key, 0) + value
+
+    partner["dominant_phase"] = max(partner["phases"], key=lambda name: partner["phases"][name]["duration"]) if partner["phases"] else None
+
+def summarize(path):
+    """ Reads the session records of a trace log file and its rotated backups and sums
+        them up per partner.
+
+        :param path: the path of the trace log file
+        :type path: string
+        :rtype: dictionary mapping partner names to dictionaries with the sums of the
+                number of ``sessions``, their ``duration``, ``missing_hashes``, ``drops``
+                and the values of their ``phases``, and the name of the ``dominant_phase``
+                which took longest in total
+    """
+
+    paths = [path]
+
+    i = 1
+    while os.path.exists("%s.%d" % (path, i)):
+        paths.append("%s.%d" % (path, i))
+        i += 1
+
+    summary = {}
+
+    for p in reversed(paths):
+        if not os.path.exists(p): continue
+
+        with open(p) as f:
+            for line in f:
+                line = line.strip()
+                if line: _add_record(summary, json.loads(line))
+
+    return summary
+
+class TraceLog:
+    """ Writes session records to a rotating file of JSON lines. Can be shared by several threads. """
+
+    lock = None
+    logger = None
+    handler = None
+    sessions = None
+
+    #: The path of the log file (string).
+    path = None
+
+    def __init__(self, path, max_bytes=10*1024*1024, backup_count=5):
+        """ :param path: the path of the log file
+            :type path: string
+            :param max_bytes: the size at which the file is rotated (optional)
+            :type max_bytes: integer
+            :param backup_count: the number of rotated files kept (optional)
+            :type backup_count: integer
+        """
+
+        self.lock = threading.Lock()
+        self.path = path
+
+        # the summary of the sessions since the trace log was opened
+        self.sessions = {}
+
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+        # a logger of its own, which does not propagate to the application log
+        self.logger = logging.getLogger("synctrace.%d" % id(self))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def write(self, session):
+        """ Writes the record of a finished session to the log file.
+
+            :param session: the session
+            :type session: :class:`Session`
+        """
+
+        record = session.record()
+
+        with self.lock:
+            _add_record(self.sessions, record)
+
+        self.logger.info(json.dumps(record, sort_keys=True))
+
+    def summary(self):
+        """ Returns the summary of the sessions written since the trace log was opened,
+            in the format of :func:`summarize`.
+
+            :rtype: dictionary
+        """
+
+        with self.lock:
+            return copy.deepcopy(self.sessions)
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+This module implements webfinger lookups on top of a :class:`~sduds.lib.connectionpool.ConnectionPool`,
+so that the requests for the host-meta document, the LRDD document and the profile itself can share
+persistent connections to a pod.
+
+A lookup works as follows: The host-meta document ``/.well-known/host-meta`` of the domain of the
+webfinger address is retrieved, using https and falling back to plain http only if the https request
+fails, and the LRDD template is extracted from it. The ``{uri}`` placeholder
+of this template is replaced by the ``acct:`` URI of the address, and the resulting XRD document is
+retrieved. Its links are made accessible by a :class:`WebfingerProfile` instance.
+
+The host-meta document is the same for all users of a pod, so the LRDD templates can be kept in
+an :class:`~sduds.lib.lrucache.LRUCache`, together with the scheme they were retrieved with. The
+lifetime of a cached template is taken from the ``Cache-Control`` or ``Expires`` header of the
+host-meta response if present.
+
+Example usage::
+
+    pool = ConnectionPool()
+    cache = LRUCache(1000)
+
+    wf = finger("johndoe@example.org", pool, cache=cache)
+    print wf.find_link("http://hoegners.de/sduds/spec", attr="href")
+"""
+
+import urllib, time, email.utils
+import xml.etree.ElementTree as ElementTree
+from xml.parsers.expat import ExpatError
+
+XRD_NAMESPACE = "http://docs.oasis-open.org/ns/xri/xrd-1.0"
+LINK_TAG = "{%s}Link" % XRD_NAMESPACE
+
+DEFAULT_TEMPLATE_LIFETIME = 3600*24 # used if host-meta response has no caching headers
+HOST_META_SCHEMES = ("https", "http") # tried in this order to retrieve the host-meta document
+
+class WebfingerError(Exception):
+    """ Raised by :func:`finger` if a document is malformed or does not contain the expected links.
+        Connection problems raise :class:`IOError` instead.
+    """
+    pass
+
+def parse_links(xrd_string):
+    """ Parses an XRD document and returns the attributes of its ``Link`` elements.
+
+        :param xrd_string: the XRD document
+        :type xrd_string: string
+        :rtype: list of dicts
+    """
+
+    try:
+        root = ElementTree.fromstring(xrd_string)
+    except (SyntaxError, ExpatError), e:
+        raise WebfingerError("Invalid XRD document: %s" % str(e))
+
+    if not root.tag=="{%s}XRD" % XRD_NAMESPACE:
+        raise WebfingerError("Document is not an XRD document.")
+
+    links = [dict(link.attrib) for link in root.findall(LINK_TAG)]
+
+    return links
+
+def cache_lifetime(headers, default=DEFAULT_TEMPLATE_LIFETIME):
+    """ Calculates for how many seconds a response may be cached, using the ``Cache-Control``
+        header, or the ``Expires`` and ``Date`` headers. Returns ``default`` if none of these
+        headers is present and ``0`` if the response must not be cached.
+
+        :param headers: the response headers, with lower-case names
+        :type headers: dict
+        :param default: the lifetime for responses without caching headers (optional)
+        :type default: integer
+        :rtype: integer
+    """
+
+    if "cache-control" in headers:
+        directives = [d.strip().lower() for d in headers["cache-control"].split(",")]
+
+        if "no-store" in directives or "no-cache" in directives:
+            return 0
+
+        for directive in directives:
+            if directive.startswith("max-age="):
+                try:
+                    return max(0, int(directive[len("max-age="):]))
+                except ValueError:
+                    return 0
+
+    if "expires" in headers:
+        expires = email.utils.parsedate_tz(headers["expires"])
+        if expires is None: return 0
+
+        date = email.utils.parsedate_tz(headers.get("date", ""))
+        if date is None:
+            now = time.time()
+        else:
+            now = email.utils.mktime_tz(date)
+
+        return max(0, int(email.utils.mktime_tz(expires) - now))
+
+    return default
+
+def get_lrdd_template(domain, pool, timeout=None, cache=None, schemes=HOST_META_SCHEMES):
+    """ Retrieves the host-meta document of a domain and returns the LRDD template. The
+        schemes are tried in the given order, and the next one is only used if the request
+        with the previous one raised an :class:`IOError`.
+
+        :param domain: the domain, optionally with port
+        :type domain: string
+        :param pool: the pool used for the request
+        :type pool: :class:`~sduds.lib.connectionpool.ConnectionPool`
+        :param timeout: timeout in seconds (optional)
+        :type timeout: float
+        :param cache: a cache mapping domains to tuples of the scheme and the LRDD template (optional)
+        :type cache: :class:`~sduds.lib.lrucache.LRUCache`
+        :param schemes: the schemes used for the host-meta document (optional)
+        :type schemes: tuple of strings
+        :rtype: string
+    """
+
+    if cache is not None:
+        cached = cache.get(domain)
+        if cached is not None:
+            scheme, template = cached
+            return template
+
+    for i, scheme in enumerate(schemes):
+        host_meta_url = "%s://%s/.well-known/host-meta" % (scheme, domain)
+
+        try:
+            response = pool.request(host_meta_url, timeout=timeout)
+            break
+        except IOError:
+            if i==len(schemes)-1: raise
+
+    for link in parse_links(response.body):
+        if link.get("rel")=="lrdd" and "template" in link:
+            template = link["template"]
+            break
+    else:
+        raise WebfingerError("Host-meta document of %s contains no LRDD template." % domain)
+
+    if cache is not None:
+        lifetime = cache_lifetime(response.headers)
+        if lifetime>0:
+            cache.set(domain, (scheme, template), time.time() + lifetime)
+
+    return template
+
+class WebfingerProfile:
+    """ Represents the XRD document of a webfinger address. """
+
+    #: The attributes of the ``Link`` elements (list of dicts).
+    links = None
+
+    def __init__(self, links):
+        """ For a description of the arguments see the documentation of the attributes of this class. """
+
+        self.links = links
+
+    def find_link(self, rel, attr="href"):
+        """ Returns an attribute of the first link with a given relation.
+            Raises :class:`WebfingerError` if there is no such link.
+
+            :param rel: the relation
+            :type rel: string
+            :param attr: the attribute that should be returned (optional)
+            :type attr: string
+            :rtype: string
+        """
+
+        for link in self.links:
+            if link.get("rel")==rel and attr in link:
+                return link[attr]
+
+        raise WebfingerError("No link with relation %s found." % rel)
+
+def finger(address, pool, timeout=None, cache=None, schemes=HOST_META_SCHEMES):
+    """ Performs a webfinger lookup.
+
+        Raises :class:`IOError` if there are connection problems or :class:`WebfingerError`
+        if a document is malformed.
+
+        :param address: the webfinger address
+        :type address: string
+        :param pool: the pool used for the requests
+        :type pool: :class:`~sduds.lib.connectionpool.ConnectionPool`
+        :param timeout: timeout in seconds for each request (optional)
+        :type timeout: float
+        :param cache: a cache for LRDD templates, passed to :func:`get_lrdd_template` (optional)
+        :type cache: :class:`~sduds.lib.lrucache.LRUCache`
+        :param schemes: the schemes used for the host-meta document, passed to :func:`get_lrdd_template` (optional)
+        :type schemes: tuple of strings
+        :rtype: :class:`WebfingerProfile`
+    """
+
+    try:
+        user, domain = address.rsplit("@", 1)
+    except ValueError:
+        raise WebfingerError("Invalid webfinger address: %s" % address)
+
+    template = get_lrdd_template(domain, pool, timeout, cache, schemes)
+
+    uri = urllib.quote("acct:"+address, safe="")
+    xrd_url = template.replace("{uri}", uri)
+
+    response = pool.request(xrd_url, timeout=timeout)
+    links = parse_links(response.body)
+
+    return WebfingerProfile(links)
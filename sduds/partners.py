@@ -12,7 +12,7 @@ methods to register :meth:`control samples <PartnerDatabase.register_control_sam
 and :meth:`malformed states <PartnerDatabase.register_malformed_state>`.
 """
 
-import random
+import random, logging
 import urllib, json
 
 from constants import *
@@ -109,6 +109,9 @@ class Partner(object):
 
 # sqlalchemy mapping for Partner class
 import lib.sqlalchemyExtensions as sqlalchemyExt
+from lib.metrics import registry
+from lib.instrumentedlock import InstrumentedLock
+from lib import migrations
 import sqlalchemy, sqlalchemy.orm, sqlalchemy.ext.declarative
 
 metadata = sqlalchemy.MetaData()
@@ -164,7 +167,10 @@ class SuccessfulSamplesSummary(DatabaseObject):
     #: The number of successful control samples by the specified partner in the specified time interval.
     samples = sqlalchemy.Column(sqlalchemy.Integer)
 
-    # TODO: index for better performance
+    __table_args__ = (
+        sqlalchemy.Index("ix_successful_samples_partner_id_interval", "partner_id", "interval"),
+        sqlalchemy.Index("ix_successful_samples_interval", "interval"),
+    )
 
     def __init__(self, partner_id, interval):
         """ For a description of the arguments see the documentation of the attributes of this class. """
@@ -194,9 +200,13 @@ class FailedSample(DatabaseObject):
     #: :class:`~sduds.context.Claim` was made. This is needed because only one failed control sample
     #: per address may be counted, otherwise a single profile owner could get a server kicked from his
     #: partners by changing his profile frequently.
-    webfinger_address = sqlalchemy.Column(sqlalchemyExt.String, unique=True)
+    webfinger_address = sqlalchemy.Column(sqlalchemyExt.String)
 
-    # TODO: index for better performance
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint("partner_id", "webfinger_address"),
+        sqlalchemy.Index("ix_failed_samples_partner_id_interval", "partner_id", "interval"),
+        sqlalchemy.Index("ix_failed_samples_interval", "interval"),
+    )
 
     def __init__(self, partner_id, interval, webfinger_address):
         """ For a description of the arguments see the documentation of the attributes of this class. """
@@ -207,100 +217,246 @@ class FailedSample(DatabaseObject):
         self.interval = interval
         self.webfinger_address = webfinger_address
 
+# schema migrations, see sduds.lib.migrations
+
+def add_sample_indexes(connection):
+    """ Adds the indexes for counting and cleaning up control samples. Missing tables are
+        created with their indexes after the migrations. """
+
+    if connection.dialect.has_table(connection, "successful_samples"):
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_successful_samples_partner_id_interval ON successful_samples (partner_id, interval)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_successful_samples_interval ON successful_samples (interval)")
+
+    if connection.dialect.has_table(connection, "failed_samples"):
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_failed_samples_partner_id_interval ON failed_samples (partner_id, interval)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_failed_samples_interval ON failed_samples (interval)")
+
+def failed_sample_unique_per_partner(connection):
+    """ Makes the webfinger address of a failed control sample unique per partner instead
+        of globally, which requires SQLite to copy the table. """
+
+    # an interrupted attempt dropped the table after copying it completely
+    if not connection.dialect.has_table(connection, "failed_samples"):
+        if connection.dialect.has_table(connection, "failed_samples_new"):
+            connection.execute("ALTER TABLE failed_samples_new RENAME TO failed_samples")
+            add_sample_indexes(connection)
+        return
+
+    connection.execute("DROP TABLE IF EXISTS failed_samples_new")
+    connection.execute("""CREATE TABLE failed_samples_new (
+        id INTEGER NOT NULL,
+        partner_id INTEGER,
+        interval INTEGER,
+        webfinger_address TEXT,
+        PRIMARY KEY (id),
+        UNIQUE (partner_id, webfinger_address),
+        FOREIGN KEY(partner_id) REFERENCES partners (id)
+    )""")
+    connection.execute("INSERT INTO failed_samples_new SELECT id, partner_id, interval, webfinger_address FROM failed_samples")
+    connection.execute("DROP TABLE failed_samples")
+    connection.execute("ALTER TABLE failed_samples_new RENAME TO failed_samples")
+
+    # the indexes were dropped with the table
+    add_sample_indexes(connection)
+
+#: The migrations of the partner database, see :func:`~sduds.lib.migrations.upgrade`.
+schema_migrations = [add_sample_indexes, failed_sample_unique_per_partner]
+
+class SampleWindow:
+    """ The control samples of one partner within the window, used by :class:`ControlSampleCache`.
+        The samples are kept in ring buffers with one slot for each of the CONTROL_SAMPLE_WINDOW
+        intervals, so that they can be counted without a database query.
+    """
+
+    #: The interval number held by each slot, or ``None``.
+    intervals = None
+
+    #: The number of successful control samples in each slot.
+    successful = None
+
+    #: The set of webfinger addresses whose last failed control sample is in each slot.
+    failed = None
+
+    #: Maps the webfinger addresses of failed control samples within the window to their interval.
+    addresses = None
+
+    #: The number of successful control samples within the window.
+    successful_total = None
+
+    #: The end of the window (interval number) the slots were last expired for.
+    window_end = None
+
+    def __init__(self, window_end):
+        self.intervals = [None]*CONTROL_SAMPLE_WINDOW
+        self.successful = [0]*CONTROL_SAMPLE_WINDOW
+        self.failed = [set() for i in xrange(CONTROL_SAMPLE_WINDOW)]
+        self.addresses = {}
+        self.successful_total = 0
+        self.window_end = window_end
+
+    def _empty_slot(self, i):
+        self.successful_total -= self.successful[i]
+        self.successful[i] = 0
+
+        for address in self.failed[i]:
+            del self.addresses[address]
+        self.failed[i] = set()
+
+        self.intervals[i] = None
+
+    def move_to(self, window_end):
+        """ Empties the slots of the intervals which are not within the window ending at window_end. """
+
+        if window_end==self.window_end: return
+        self.window_end = window_end
+
+        window_start = window_end - CONTROL_SAMPLE_WINDOW + 1
+
+        for i, interval in enumerate(self.intervals):
+            if interval is not None and interval<window_start:
+                self._empty_slot(i)
+
+    def _slot(self, interval):
+        i = interval % CONTROL_SAMPLE_WINDOW
+
+        if not self.intervals[i]==interval:
+            self._empty_slot(i)
+            self.intervals[i] = interval
+
+        return i
+
+    def add_successful(self, interval, samples=1):
+        self.successful[self._slot(interval)] += samples
+        self.successful_total += samples
+
+    def add_failed(self, interval, webfinger_address):
+        """ Returns ``False`` if a failed control sample for the address was already within the window. """
+
+        previous_interval = self.addresses.get(webfinger_address, None)
+        if previous_interval is not None:
+            self.failed[previous_interval % CONTROL_SAMPLE_WINDOW].discard(webfinger_address)
+
+        self.failed[self._slot(interval)].add(webfinger_address)
+        self.addresses[webfinger_address] = interval
+
+        return previous_interval is None
+
+    def count_failed(self):
+        return len(self.addresses)
+
 class ControlSampleCache:
     """ This class is used by the :meth:`PartnerDatabase.register_control_sample` method to save the
         control samples in an efficient manner. As control samples are registered very often, it would
         slow down the application if they would be written to the database immediately each time.
-        Therefore the newly added control samples are cached.
+        Therefore the control samples are kept in memory and written to the database in the background.
 
         For caching, the time scale is divided into equally large intervals of SAMPLE_SUMMARY_SIZE seconds,
         starting at unix timestamp ``0``.
         Control samples expire after a certain time, so only samples from a certain time window must be
         considered. This time window ends at the present interval and has a length of CONTROL_SAMPLE_WINDOW
-        intervals. As long as the current time does not exceed the border of an interval, this window stays
-        at the same position, and no database write is performed except the cache grows too big.
-        If current time does exceed a border, the window moves forward, and all control samples are commited
-        to the database.
+        intervals. The samples of each partner within the window are kept in a :class:`SampleWindow`,
+        which is loaded from the database when the cache is created, so that counting the samples never
+        needs a database query.
+
+        New samples are additionally collected until they are flushed to the database in bulk by a
+        background thread, every ``flush_interval`` seconds or as soon as more than ``max_cache_size_failed``
+        failed samples are pending.
     """
 
     Session = None
+    lock = None
+    flush_lock = None
 
     window_end = None
-    successful_cache = None
-    successful_stored_count = None
-    failed_cache = None
-    failed_update_count = None
-    failed_stored_count = None
+    windows = None
+
+    pending_successful = None
+    pending_failed = None
 
     max_cache_size_failed = None
+    flush_interval = None
+    flush_requested = None
+    flusher = None
+    closed = None
 
-    def __init__(self, Session, window_end, max_cache_size_failed=500):
+    def __init__(self, Session, window_end, max_cache_size_failed=500, flush_interval=CONTROL_SAMPLE_FLUSH_INTERVAL):
         """ :param Session: the sqlalchemy :class:`Session`
             :param window_end: the initial end of the window (interval number)
             :type window_end: integer
-            :param max_cache_size_failed: the maximal number of failed control samples that should be cached
-                                          before the cache is commited to the database (optional)
+            :param max_cache_size_failed: the maximal number of failed control samples that should be pending
+                                          before they are flushed to the database (optional)
             :type max_cache_size_failed: integer
+            :param flush_interval: the number of seconds after which pending samples are flushed (optional)
+            :type flush_interval: float
         """
 
         self.Session = Session
         self.max_cache_size_failed = max_cache_size_failed
+        self.flush_interval = flush_interval
 
-        self._reinitialize_cache(window_end)
+        # guards the windows and the pending samples
+        self.lock = threading.Lock()
 
-    def _commit_successful_cache(self):
-        session = self.Session()
+        # serializes the database writes
+        self.flush_lock = threading.Lock()
 
-        for partner_id in self.successful_cache:
-            # get stored summary, if present
-            query = session.query(SuccessfulSamplesSummary)
-            query = query.filter_by(partner_id=partner_id)
-            query = query.filter_by(interval=self.window_end)
-            summary = query.scalar()
+        self.window_end = window_end
+        self.windows = {}
 
-            # if not present, create new summary
-            if summary is None:
-                summary = SuccessfulSamplesSummary(partner_id, self.window_end)
+        # maps (partner_id, interval) to the number of successful samples not yet flushed
+        self.pending_successful = {}
 
-            # update summary
-            summary.samples += self.successful_cache[partner_id]
+        # maps (partner_id, webfinger_address) to the interval of the failed sample not yet flushed
+        self.pending_failed = {}
 
-            # save summary to database
-            session.add(summary)
+        self._load()
 
-        session.commit()
-        session.close()
+        self.closed = False
+        self.flush_requested = threading.Event()
+        self.flusher = threading.Thread(target=self._run_flusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _load(self):
+        window_start = self.window_end - CONTROL_SAMPLE_WINDOW + 1
 
-    def _commit_failed_cache(self):
         session = self.Session()
 
-        for partner_id in self.failed_cache:
-            samples_dict = self.failed_cache[partner_id]
-            for failedsample in samples_dict.itervalues():
-                session.add(failedsample)
+        query = session.query(SuccessfulSamplesSummary.partner_id, SuccessfulSamplesSummary.interval, SuccessfulSamplesSummary.samples)
+        query = query.filter(SuccessfulSamplesSummary.interval>=window_start)
+        query = query.filter(SuccessfulSamplesSummary.interval<=self.window_end)
+        for partner_id, interval, samples in query:
+            self._get_window(partner_id).add_successful(interval, samples)
+
+        query = session.query(FailedSample.partner_id, FailedSample.interval, FailedSample.webfinger_address)
+        query = query.filter(FailedSample.interval>=window_start)
+        query = query.filter(FailedSample.interval<=self.window_end)
+        query = query.order_by(FailedSample.interval)
+        for partner_id, interval, webfinger_address in query:
+            self._get_window(partner_id).add_failed(interval, webfinger_address)
 
-        session.commit()
         session.close()
 
-    def _reinitialize_cache(self, window_end):
-        self.window_end = window_end
+    def _get_window(self, partner_id):
+        window = self.windows.get(partner_id, None)
 
-        self.successful_cache = {}
-        self.failed_cache = {}
+        if window is None:
+            window = self.windows[partner_id] = SampleWindow(self.window_end)
+        else:
+            window.move_to(self.window_end)
 
-        self.successful_stored_count = {}
-        self.failed_update_count = {}
-        self.failed_stored_count = {}
+        return window
 
     def _move_forward_to(self, interval):
-        self._commit_successful_cache()
-        self._commit_failed_cache()
-        self._reinitialize_cache(interval)
+        assert interval>=self.window_end, "interval must be monotonously increasing"
+
+        # the windows of the partners are moved when they are used
+        self.window_end = interval
 
     def add_successful_sample(self, partner_id, interval):
-        """ Saves a successful control sample by increasing an interval counter. If the window
-            is moved, this counter is used to update the corresponding :class:`SuccessfulSamplesSummary`
-            in the database. This method moves the window automatically if necessary.
+        """ Saves a successful control sample by increasing an interval counter, which is used to update
+            the corresponding :class:`SuccessfulSamplesSummary` in the database when the samples are flushed.
+            This method moves the window automatically if necessary.
 
             :param partner_id: the id of the :class:`Partner` from the database mapping
             :type partner_id: integer
@@ -308,15 +464,13 @@ class ControlSampleCache:
             :type interval: integer
         """
 
-        assert interval>=self.window_end, "interval must be monotonously increasing"
-
-        # move window forward if necessary
-        if not interval==self.window_end:
+        with self.lock:
             self._move_forward_to(interval)
 
-        # add sample to cache
-        self.successful_cache.setdefault(partner_id, 0)
-        self.successful_cache[partner_id] += 1
+            self._get_window(partner_id).add_successful(interval)
+
+            key = (partner_id, interval)
+            self.pending_successful[key] = self.pending_successful.get(key, 0) + 1
 
     def count_successful_samples(self, partner_id, interval):
         """ Returns the number of successful control samples in the window ending
@@ -329,44 +483,16 @@ class ControlSampleCache:
             :rtype: integer
         """
 
-        assert interval>=self.window_end, "interval must be monotonously increasing"
-
-        # move window forward if necessary
-        if not interval==self.window_end:
+        with self.lock:
             self._move_forward_to(interval)
 
-        # get number of failed samples that are stored in the database
-        stored_samples = self.successful_stored_count.get(partner_id, None)
-        if stored_samples is None:
-            window_start = interval - CONTROL_SAMPLE_WINDOW + 1
-
-            session = self.Session()
-            aggregator = sqlalchemy.sql.functions.sum(SuccessfulSamplesSummary.samples)
-            query = session.query(aggregator)
-            query = query.filter_by(partner_id=partner_id)
-            query = query.filter(SuccessfulSamplesSummary.interval>=window_start)
-            stored_samples = query.scalar()
-            session.close()
-
-            if stored_samples is None:
-                # no successful samples found
-                stored_samples = 0
-
-            self.successful_stored_count[partner_id] = stored_samples
-
-        # get number of cached samples
-        self.successful_cache.setdefault(partner_id, 0)
-        cached_samples = self.successful_cache[partner_id]
+            if not partner_id in self.windows: return 0
 
-        # calculate total number of failed samples within window
-        successful_samples = stored_samples + cached_samples
-
-        return successful_samples
+            return self._get_window(partner_id).successful_total
 
     def add_failed_sample(self, partner_id, interval, webfinger_address):
-        """ Saves a failed control sample to an internal cache using the :class:`FailedSample` class.
-            If the window is moved, this cache is commited to the database. This method moves the window
-            automatically if necessary.
+        """ Saves a failed control sample, which is written to the database as :class:`FailedSample`
+            when the samples are flushed. This method moves the window automatically if necessary.
 
             :param partner_id: the id of the :class:`Partner` from the database mapping
             :type partner_id: integer
@@ -376,46 +502,17 @@ class ControlSampleCache:
             :type webfinger_address: string
         """
 
-        assert interval>=self.window_end, "interval must be monotonously increasing"
-
-        # move window forward if necessary
-        if not interval==self.window_end:
+        with self.lock:
             self._move_forward_to(interval)
 
-        # get stored FailedSample for this address, if present
-        window_start = interval - CONTROL_SAMPLE_WINDOW + 1
-
-        session = self.Session()
-        query = session.query(FailedSample)
-        query = query.filter_by(partner_id=partner_id)
-        query = query.filter_by(webfinger_address=webfinger_address)
-        query = query.filter(FailedSample.interval>=window_start)
-        failedsample = query.scalar()
-        session.close()
-
-        if failedsample is None:
-            # if not present, create new FailedSample
-            failedsample = FailedSample(partner_id, interval, webfinger_address)
-        else:
-            # if present, update this sample
-            failedsample.interval = interval
-
-            # increase update counter to be able to subtract it in count_failed_samples()
-            self.failed_update_count.setdefault(partner_id, 0)
-            self.failed_update_count[partner_id] += 1
+            self._get_window(partner_id).add_failed(interval, webfinger_address)
 
-        # write failed sample to cache
-        self.failed_cache.setdefault(partner_id, {})
-        self.failed_cache[partner_id][webfinger_address] = failedsample
+            self.pending_failed[(partner_id, webfinger_address)] = interval
+            pending = len(self.pending_failed)
 
-        # check if cache for failed samples has grown too big
-        cache_size = 0
-        for cache_dict in self.failed_cache.itervalues():
-            cache_size += len(cache_dict)
-
-        if cache_size>self.max_cache_size_failed:
-            # if this is the case, write cache to database
-            self._move_forward_to(interval)
+        # check if too many failed samples are pending
+        if pending>self.max_cache_size_failed:
+            self.flush_requested.set()
 
     def count_failed_samples(self, partner_id, interval):
         """ Returns the number of failed control samples in the window ending
@@ -428,38 +525,81 @@ class ControlSampleCache:
             :rtype: integer
         """
 
-        assert interval>=self.window_end, "interval must be monotonously increasing"
-
-        # move window forward if necessary
-        if not interval==self.window_end:
+        with self.lock:
             self._move_forward_to(interval)
 
-        # get number of failed samples that are stored in the database
-        stored_samples = self.failed_stored_count.get(partner_id, None)
-        if stored_samples is None:
-            window_start = interval - CONTROL_SAMPLE_WINDOW + 1
+            if not partner_id in self.windows: return 0
 
-            session = self.Session()
-            query = session.query(FailedSample)
-            query = query.filter_by(partner_id=partner_id)
-            query = query.filter(FailedSample.interval>=window_start)
-            stored_samples = query.count()
-            session.close()
+            return self._get_window(partner_id).count_failed()
+
+    def flush(self):
+        """ Writes the pending control samples to the database. If writing fails, the samples
+            stay pending and the exception is raised.
+        """
+
+        with self.flush_lock:
+            with self.lock:
+                pending_successful = self.pending_successful
+                pending_failed = self.pending_failed
+                self.pending_successful = {}
+                self.pending_failed = {}
+
+            if not pending_successful and not pending_failed: return
 
-            self.failed_stored_count[partner_id] = stored_samples
+            try:
+                self._write(pending_successful, pending_failed)
+            except:
+                # keep the samples for the next attempt
+                with self.lock:
+                    for key, samples in pending_successful.iteritems():
+                        self.pending_successful[key] = self.pending_successful.get(key, 0) + samples
 
-        # get number of cached samples
-        self.failed_cache.setdefault(partner_id, {})
-        cached_samples = len(self.failed_cache[partner_id])
+                    for key, interval in pending_failed.iteritems():
+                        self.pending_failed.setdefault(key, interval)
 
-        # get number of updated samples
-        self.failed_update_count.setdefault(partner_id, 0)
-        updated_samples = self.failed_update_count[partner_id]
+                raise
+
+    def _write(self, pending_successful, pending_failed):
+        summaries = SuccessfulSamplesSummary.__table__
+        failed_samples = FailedSample.__table__
+
+        session = self.Session()
 
-        # calculate total number of failed samples within window
-        failed_samples = stored_samples + cached_samples - updated_samples
+        try:
+            for (partner_id, interval), samples in pending_successful.iteritems():
+                update = summaries.update()
+                update = update.where(summaries.c.partner_id==partner_id)
+                update = update.where(summaries.c.interval==interval)
+                update = update.values(samples=summaries.c.samples+samples)
 
-        return failed_samples
+                if session.execute(update).rowcount==0:
+                    session.execute(summaries.insert(), {"partner_id": partner_id, "interval": interval, "samples": samples})
+
+            if pending_failed:
+                # replace the stored sample of each address by the latest one
+                delete = failed_samples.delete()
+                delete = delete.where(failed_samples.c.partner_id==sqlalchemy.bindparam("p"))
+                delete = delete.where(failed_samples.c.webfinger_address==sqlalchemy.bindparam("a"))
+                session.execute(delete, [{"p": partner_id, "a": address} for partner_id, address in pending_failed])
+
+                rows = [{"partner_id": partner_id, "interval": interval, "webfinger_address": address}
+                        for (partner_id, address), interval in pending_failed.iteritems()]
+                session.execute(failed_samples.insert(), rows)
+
+            session.commit()
+        finally:
+            session.close()
+
+    def _run_flusher(self):
+        while not self.closed:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            if self.closed: return
+
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception("Flushing control samples failed.")
 
     def cleanup(self, interval):
         """ Deletes all control samples which are too old to reside in the window ending
@@ -469,30 +609,34 @@ class ControlSampleCache:
             :type interval: integer
         """
 
-        assert interval>=self.window_end, "interval must be monotonously increasing"
+        with self.lock:
+            self._move_forward_to(interval)
 
-        # empty caches
-        self._commit_successful_cache()
-        self._commit_failed_cache()
+            # drop the windows of partners without samples in the window
+            for partner_id in self.windows.keys():
+                window = self._get_window(partner_id)
+                if window.successful_total==0 and window.count_failed()==0:
+                    del self.windows[partner_id]
 
-        # move window forward if necessary
-        if not interval==self.window_end:
-            self._move_forward_to(interval)
+        # write pending samples
+        self.flush()
 
         # clean up database
         window_start = interval - CONTROL_SAMPLE_WINDOW + 1
 
-        session = self.Session()
+        with self.flush_lock:
+            session = self.Session()
 
-        query = session.query(SuccessfulSamplesSummary)
-        query = query.filter(SuccessfulSamplesSummary.interval<window_start)
-        query.delete()
+            query = session.query(SuccessfulSamplesSummary)
+            query = query.filter(SuccessfulSamplesSummary.interval<window_start)
+            query.delete()
 
-        query = session.query(FailedSample)
-        query = query.filter(FailedSample.interval<window_start)
-        query.delete()
+            query = session.query(FailedSample)
+            query = query.filter(FailedSample.interval<window_start)
+            query.delete()
 
-        session.commit()
+            session.commit()
+            session.close()
 
     def clear(self, partner_id):
         """ Remove all cached and stored control samples for a given :class:`Partner`.
@@ -502,62 +646,98 @@ class ControlSampleCache:
             :type partner_id: integer
         """
 
-        # clear cache
-        if partner_id in self.successful_cache:
-            del self.successful_cache[partner_id]
+        with self.flush_lock:
+            # clear cache
+            with self.lock:
+                if partner_id in self.windows:
+                    del self.windows[partner_id]
 
-        if partner_id in self.failed_cache:
-            del self.failed_cache[partner_id]
+                for key in self.pending_successful.keys():
+                    if key[0]==partner_id: del self.pending_successful[key]
 
-        # clear database
-        session = self.Session()
+                for key in self.pending_failed.keys():
+                    if key[0]==partner_id: del self.pending_failed[key]
 
-        query = session.query(SuccessfulSamplesSummary)
-        query = query.filter_by(partner_id=partner_id)
-        query.delete()
+            # clear database
+            session = self.Session()
 
-        query = session.query(FailedSample)
-        query = query.filter_by(partner_id=partner_id)
-        query.delete()
+            query = session.query(SuccessfulSamplesSummary)
+            query = query.filter_by(partner_id=partner_id)
+            query.delete()
 
-        session.commit()
-        session.close()
+            query = session.query(FailedSample)
+            query = query.filter_by(partner_id=partner_id)
+            query.delete()
+
+            session.commit()
+            session.close()
 
     def close(self):
-        """ Commits the cache to the database. May not be called more than one time.
+        """ Stops the background thread and writes the pending samples to the database.
+            May not be called more than one time.
         """
 
-        self._commit_successful_cache()
-        self._commit_failed_cache()
+        self.closed = True
+        self.flush_requested.set()
+        self.flusher.join()
+
+        self.flush()
 
         self.window_end = None
 
 import threading, os, time
 
+control_samples = registry.counter("control_samples_total", "Number of control samples by partner and outcome.", ["partner", "outcome"])
+partners_kicked = registry.counter("partners_kicked_total", "Number of times a partner was kicked for failed control samples.", ["partner"])
+
+def copy_partner(partner):
+    """ Returns a new :class:`Partner` instance with the same attributes, which is not attached
+        to a sqlalchemy session.
+
+        :param partner: the partner
+        :type partner: :class:`Partner`
+        :rtype: :class:`Partner`
+    """
+
+    copy = Partner(partner.name, partner.accept_password, partner.base_url, partner.control_probability,
+                   partner.connection_schedule, partner.provide_username, partner.provide_password)
+
+    copy.id = partner.id
+    copy.last_connection = partner.last_connection
+    copy.kicked = partner.kicked
+
+    return copy
+
 class PartnerDatabase:
     """ This class is used to save :class:`Partner` instances to a sqlite database, and to keep
         track of whether the partners are reliable.
+
+        All partners are kept in memory, so that they can be looked up without a database query.
+        The methods changing partners write to the database and the memory at once. If the database
+        is changed by another process, e.g. by ``manage_partners.py``, :meth:`reload_partners` must
+        be called.
     """
 
     Session = None
     lock = None
     samples_cache = None
 
+    #: Maps the names of all partners to :class:`Partner` instances, which are never handed out.
+    partners = None
+
     def __init__(self, database_path, reference_timestamp=None):
         """ :param database_path: the path to the sqlite database file -- will be
                                   created automatically if it doesn't exist
             :type database_path: string
         """
 
-        self.lock = threading.Lock()
+        self.lock = InstrumentedLock("partnerdb")
 
         engine = sqlalchemy.create_engine("sqlite:///"+database_path)
 
-        # create partners table if it doesn't exist
-        metadata.create_all(engine)
-
-        # create tables for control samples if they don't exist
-        DatabaseObject.metadata.create_all(engine)
+        # create the partners and control samples tables if they don't exist,
+        # and bring older databases up to date
+        migrations.upgrade(engine, [metadata, DatabaseObject.metadata], schema_migrations)
 
         self.Session = sqlalchemy.orm.sessionmaker(bind=engine)
 
@@ -567,6 +747,18 @@ class PartnerDatabase:
         window_end = int(reference_timestamp/SAMPLE_SUMMARY_INTERVAL)
         self.samples_cache = ControlSampleCache(self.Session, window_end)
 
+        self.reload_partners()
+
+    def reload_partners(self):
+        """ Loads all partners from the database into memory. """
+
+        with self.lock:
+            session = self.Session()
+            partners = dict((partner.name, copy_partner(partner)) for partner in session.query(Partner))
+            session.close()
+
+            self.partners = partners
+
     def cleanup(self, reference_timestamp=None):
         """ Deletes expired control samples. Returns the current timestamp,
             so that this method can be used directly as a callback for the
@@ -592,13 +784,12 @@ class PartnerDatabase:
         """
 
         with self.lock:
-            session = self.Session()
-            query = session.query(Partner)
-            for partner in query:
-                session.expunge(partner)
-                yield partner
+            partners = [copy_partner(partner) for partner in self.partners.itervalues()]
 
-            session.close()
+        partners.sort(key=lambda partner: partner.id)
+
+        for partner in partners:
+            yield partner
 
     def get_partner(self, partner_name):
         """ Gets the corresponding :class:`Partner` instance to a given
@@ -611,12 +802,10 @@ class PartnerDatabase:
         """
 
         with self.lock:
-            session = self.Session()
-            query = session.query(Partner).filter(Partner.name==partner_name)
-            partner = query.scalar()
-            session.close()
+            partner = self.partners.get(partner_name, None)
+            if partner is None: return None
 
-            return partner
+            return copy_partner(partner)
 
     def save_partner(self, partner):
         """ Saves a :class:`Partner` instance to the database.
@@ -626,8 +815,14 @@ class PartnerDatabase:
 
         with self.lock:
             session = self.Session()
-            session.merge(partner)
+            partner = session.merge(partner)
             session.commit()
+
+            # the partner might have been renamed
+            for name, cached in self.partners.items():
+                if cached.id==partner.id: del self.partners[name]
+
+            self.partners[partner.name] = copy_partner(partner)
             session.close()
 
     def delete_partner(self, partner_name):
@@ -654,6 +849,8 @@ class PartnerDatabase:
             session.commit()
             session.close()
 
+            self.partners.pop(partner_name, None)
+
     def register_control_sample(self, partner_name, reference_timestamp, failed_address=None):
         """ Saves a control sample using the :class:`ControlSampleCache` class. Returns ``False``
             if the specified partner was not found.
@@ -669,20 +866,20 @@ class PartnerDatabase:
         """
 
         with self.lock:
-            # get partner id
-            session = self.Session()
-            query = session.query(Partner.id).filter_by(name=partner_name)
-            partner_id = query.scalar()
-            session.close()
+            partner = self.partners.get(partner_name, None)
 
             # return False if partner name was not found
-            if partner_id is None:
+            if partner is None:
                 return False
 
+            partner_id = partner.id
+
             # calculate current interval
             interval = int(reference_timestamp/SAMPLE_SUMMARY_INTERVAL)
 
             if failed_address:
+                control_samples.inc(partner_name, "failure")
+
                 # write the failed sample to the cache
                 self.samples_cache.add_failed_sample(partner_id, interval, failed_address)
 
@@ -697,14 +894,13 @@ class PartnerDatabase:
                 failed_percentage = 100.*failed_samples
 
                 if sample_count>=SIGNIFICANCE_THRESHOLD and failed_percentage>MAX_FAILED_PERCENTAGE:
-                    session = self.Session()
-                    query = session.query(Partner)
-                    query = query.filter_by(name=partner_name)
-                    query.update({Partner.kicked: True})
-                    session.commit()
-                    session.close()
+                    self._kick(partner_name)
+
+                    partners_kicked.inc(partner_name)
 
             else:
+                control_samples.inc(partner_name, "success")
+
                 # write the successful sample to the cache
                 self.samples_cache.add_successful_sample(partner_id, interval)
 
@@ -737,8 +933,22 @@ class PartnerDatabase:
             session.commit()
             session.close()
 
+            if partner_name in self.partners:
+                self.partners[partner_name].last_connection = timestamp
+
             return timestamp
 
+    def _kick(self, partner_name):
+        session = self.Session()
+        query = session.query(Partner)
+        query = query.filter_by(name=partner_name)
+        query.update({Partner.kicked: True})
+        session.commit()
+        session.close()
+
+        if partner_name in self.partners:
+            self.partners[partner_name].kicked = True
+
     def register_malformed_state(self, partner_name):
         """ This method is called when a synchronization partner transmits a malformed
             :class:`~sduds.states.State`. It kicks the partner by setting the
@@ -750,12 +960,7 @@ class PartnerDatabase:
         """
 
         with self.lock:
-            session = self.Session()
-            query = session.query(Partner)
-            query = query.filter_by(name=partner_name)
-            query.update({Partner.kicked: True})
-            session.commit()
-            session.close()
+            self._kick(partner_name)
 
     def unkick_partner(self, partner_name, delete_control_samples=False):
         """ This method sets the :attr:`~Partner.kicked` attribute of the specified partner to ``False`` so that
@@ -787,6 +992,9 @@ class PartnerDatabase:
             session.commit()
             session.close()
 
+            if partner_name in self.partners:
+                self.partners[partner_name].kicked = False
+
             return True
 
     def close(self):
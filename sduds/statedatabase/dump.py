@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+"""
+This module reads and writes dumps of states, which can be loaded into a
+:class:`~sduds.statedatabase.sqlite.StateDatabase` with its
+:meth:`~sduds.statedatabase.sqlite.StateDatabase.bulk_load` method, and generates
+synthetic states to seed test and staging nodes.
+
+A dump is either a file of JSON objects, one per line (NDJSON), or a CSV file with a
+header line. Both have the fields listed in :data:`FIELDS`, which are named like the
+fields of the sduds document of a profile; the CAPTCHA signature is hex-encoded.
+
+A snapshot is a compressed and checksummed NDJSON file with all states and ghosts of a
+database, written by :meth:`~sduds.statedatabase.sqlite.StateDatabase.export_snapshot`.
+A new node can load it with :meth:`~sduds.statedatabase.sqlite.StateDatabase.import_snapshot`
+and then only has to reconcile the states that changed since the snapshot was taken.
+
+Example usage::
+
+    with open("states.ndjson", "w") as f:
+        write_ndjson(generate_states(100000, private_key_block), f)
+
+    with open("states.ndjson") as f:
+        statedb.bulk_load(read_ndjson(f))
+"""
+
+import json, csv, binascii, random, time
+import gzip, zlib, hashlib, os
+
+from sduds.constants import *
+from sduds.states import Profile, StateRecord
+from sduds.lib import signature
+
+#: The fields of a dumped state (tuple of strings).
+FIELDS = ("webfinger_address", "full_name", "hometown", "country_code", "services",
+          "captcha_signature", "submission_timestamp", "retrieval_timestamp")
+
+def state_to_record(state):
+    """ Returns the fields of a state with profile as a dictionary of JSON types. """
+
+    profile = state.profile
+
+    return {"webfinger_address": state.address,
+            "full_name": profile.full_name,
+            "hometown": profile.hometown,
+            "country_code": profile.country_code,
+            "services": profile.services,
+            "captcha_signature": binascii.hexlify(profile.captcha_signature),
+            "submission_timestamp": profile.submission_timestamp,
+            "retrieval_timestamp": state.retrieval_timestamp}
+
+def record_to_state(record):
+    """ Returns the :class:`~sduds.states.StateRecord` described by a dictionary as returned
+        by :func:`state_to_record`. Raises :class:`ValueError` if the record is malformed.
+    """
+
+    try:
+        profile = Profile(unicode(record["full_name"]),
+                          unicode(record["hometown"]),
+                          record["country_code"].encode("utf8"),
+                          record["services"].encode("utf8"),
+                          binascii.unhexlify(record["captcha_signature"]),
+                          int(record["submission_timestamp"]))
+
+        return StateRecord(record["webfinger_address"].encode("utf8"), int(record["retrieval_timestamp"]), profile)
+    except (KeyError, TypeError, AttributeError, binascii.Error), e:
+        raise ValueError("Malformed record: %s" % str(e))
+
+def read_ndjson(f):
+    """ Reads states from a file of JSON objects, one per line.
+
+        :param f: the file
+        :type f: file
+        :rtype: iterator of :class:`~sduds.states.StateRecord`
+    """
+
+    for line in f:
+        line = line.strip()
+        if not line: continue
+
+        yield record_to_state(json.loads(line))
+
+def write_ndjson(states, f):
+    """ Writes states with profile to a file, one JSON object per line. Returns the number of
+        written states.
+
+        :param states: the states
+        :type states: iterable
+        :param f: the file
+        :type f: file
+        :rtype: integer
+    """
+
+    number = 0
+
+    for state in states:
+        f.write(json.dumps(state_to_record(state), sort_keys=True))
+        f.write("\n")
+        number += 1
+
+    return number
+
+def read_csv(f):
+    """ Reads states from a UTF-8 encoded CSV file whose first line contains the names of
+        the :data:`FIELDS`.
+
+        :param f: the file
+        :type f: file
+        :rtype: iterator of :class:`~sduds.states.StateRecord`
+    """
+
+    for row in csv.DictReader(f):
+        record = dict((key, unicode(value, "utf8")) for key, value in row.iteritems() if key is not None)
+        yield record_to_state(record)
+
+def write_csv(states, f):
+    """ Writes states with profile to a UTF-8 encoded CSV file with a header line. Returns
+        the number of written states.
+
+        :param states: the states
+        :type states: iterable
+        :param f: the file
+        :type f: file
+        :rtype: integer
+    """
+
+    writer = csv.writer(f)
+    writer.writerow(FIELDS)
+
+    number = 0
+
+    for state in states:
+        record = state_to_record(state)
+        writer.writerow([unicode(record[field]).encode("utf8") for field in FIELDS])
+        number += 1
+
+    return number
+
+# building blocks of synthetic profiles
+_first_names = [u"Anna", u"Ben", u"Chlo\xe9", u"David", u"Elif", u"Fatima", u"Gustav", u"Hana",
+                u"Igor", u"J\xfcrgen", u"Kim", u"Lucas", u"Mar\xeda", u"Noah", u"Olga", u"Pedro",
+                u"Qiang", u"Rosa", u"Sven", u"Tariq", u"Ursula", u"Vera", u"Wei", u"Yusuf", u"Zo\xeb"]
+
+_last_names = [u"Andersson", u"Bauer", u"Costa", u"Dubois", u"Eriksen", u"Fischer", u"Garc\xeda",
+               u"Hoffmann", u"Ivanova", u"Jansen", u"Kowalski", u"Lefebvre", u"M\xfcller", u"Nowak",
+               u"O'Brien", u"Petrov", u"Rossi", u"Schmidt", u"Tanaka", u"Umarov", u"Virtanen",
+               u"Wagner", u"Yilmaz", u"Zhang"]
+
+_hometowns = [(u"Berlin", "de"), (u"M\xfcnchen", "de"), (u"Wien", "at"), (u"Z\xfcrich", "ch"),
+              (u"Paris", "fr"), (u"Lyon", "fr"), (u"Madrid", "es"), (u"Lisboa", "pt"),
+              (u"Amsterdam", "nl"), (u"Bruxelles", "be"), (u"London", "gb"), (u"Dublin", "ie"),
+              (u"Stockholm", "se"), (u"Helsinki", "fi"), (u"Warszawa", "pl"), (u"Praha", "cz"),
+              (u"Roma", "it"), (u"Istanbul", "tr"), (u"New York", "us"), (u"Toronto", "ca"),
+              (u"S\xe3o Paulo", "br"), (u"Tokyo", "jp"), (u"Seoul", "kr"), (u"Sydney", "au")]
+
+_services = ["diaspora", "friendica", "email", "xmpp", "statusnet", "identica", "libertree"]
+
+def generate_states(number, private_key_block, timestamp=None, seed=None, pods=100):
+    """ Generates valid states with synthetic profiles and distinct webfinger addresses.
+        The addresses are spread over the pods such that a few pods have most of the
+        users, the submission timestamps are spread over the lifetime of a profile, and
+        the states were retrieved less than ``MAX_AGE`` seconds ago.
+
+        :param number: the number of states
+        :type number: integer
+        :param private_key_block: the private key of the CAPTCHA provider
+        :type private_key_block: string
+        :param timestamp: the current time (optional)
+        :type timestamp: integer
+        :param seed: the seed of the random number generator (optional)
+        :param pods: the number of pods (optional)
+        :type pods: integer
+        :rtype: iterator of :class:`~sduds.states.StateRecord`
+    """
+
+    if timestamp is None: timestamp = int(time.time())
+
+    generator = random.Random(seed)
+
+    for i in xrange(number):
+        first_name = generator.choice(_first_names)
+        last_name = generator.choice(_last_names)
+        hometown, country_code = generator.choice(_hometowns)
+
+        services = generator.sample(_services, generator.randint(1, 3))
+        if not "diaspora" in services and generator.random()<0.8:
+            services[0] = "diaspora"
+
+        # pod sizes follow a power law
+        pod = int(pods*generator.random()**3)
+
+        username = "%s.%s%d" % (first_name, last_name, i)
+        username = username.lower().encode("ascii", "ignore").replace("'", "")
+        address = "%s@pod%d.example.org" % (username, pod)
+
+        submission_timestamp = timestamp - generator.randint(60, PROFILE_LIFETIME - 3600)
+        retrieval_timestamp = max(submission_timestamp, timestamp - generator.randint(0, MAX_AGE - 3600))
+
+        captcha_signature = signature.sign(private_key_block, address)
+
+        profile = Profile(u"%s %s" % (first_name, last_name), hometown, country_code,
+                          ",".join(services), captcha_signature, submission_timestamp)
+
+        yield StateRecord(address, retrieval_timestamp, profile)
+
+SNAPSHOT_FORMAT = "sduds-snapshot"
+SNAPSHOT_VERSION = 1
+
+def write_snapshot(path, states, ghosts, created=None):
+    """ Writes a snapshot of a state database to a gzip-compressed file. The file is written
+        to a temporary file first, which is renamed when it is complete. Returns the number
+        of written states and ghosts.
+
+        The snapshot is a header line, one line per state with the fields of
+        :func:`state_to_record` and its hash, one line per ghost, and a trailer line with
+        the numbers of states and ghosts and the SHA-256 checksum of all preceding lines.
+
+        :param path: the path of the snapshot file
+        :type path: string
+        :param states: the states with profile
+        :type states: iterable
+        :param ghosts: the ghosts as ``(binhash, retrieval_timestamp)`` tuples
+        :type ghosts: iterable
+        :param created: the time the snapshot was taken (optional)
+        :type created: integer
+        :rtype: (integer, integer)-tuple
+    """
+
+    if created is None: created = int(time.time())
+
+    temporary_path = path + ".tmp"
+    checksum = hashlib.sha256()
+
+    f = gzip.open(temporary_path, "wb")
+
+    try:
+        def write(record):
+            line = json.dumps(record, sort_keys=True) + "\n"
+            checksum.update(line)
+            f.write(line)
+
+        write({"format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION, "created": created})
+
+        number_of_states = 0
+        for state in states:
+            record = state_to_record(state)
+            record["type"] = "state"
+            record["hash"] = binascii.hexlify(state.hash)
+            write(record)
+            number_of_states += 1
+
+        number_of_ghosts = 0
+        for binhash, retrieval_timestamp in ghosts:
+            write({"type": "ghost", "hash": binascii.hexlify(binhash), "retrieval_timestamp": retrieval_timestamp})
+            number_of_ghosts += 1
+
+        f.write(json.dumps({"type": "end", "states": number_of_states, "ghosts": number_of_ghosts, "sha256": checksum.hexdigest()}, sort_keys=True) + "\n")
+    finally:
+        f.close()
+
+    os.rename(temporary_path, path)
+
+    return number_of_states, number_of_ghosts
+
+def _read_snapshot_records(path):
+    """ Yields the records of a snapshot between header and trailer. """
+
+    f = gzip.open(path, "rb")
+
+    try:
+        header = json.loads(f.readline() or "null")
+        if not isinstance(header, dict) or not header.get("format")==SNAPSHOT_FORMAT:
+            raise ValueError("Not a snapshot file.")
+
+        for line in f:
+            record = json.loads(line)
+            if record.get("type")=="end": break
+
+            yield record
+    finally:
+        f.close()
+
+def verify_snapshot(path):
+    """ Checks the checksum and the numbers of records of a snapshot. Raises
+        :class:`ValueError` if the snapshot is corrupt or incomplete.
+
+        :param path: the path of the snapshot file
+        :type path: string
+        :returns: the header, with the numbers of ``states`` and ``ghosts`` added
+        :rtype: dictionary
+    """
+
+    checksum = hashlib.sha256()
+    counts = {"state": 0, "ghost": 0}
+    header = trailer = None
+
+    f = gzip.open(path, "rb")
+
+    try:
+        for line in f:
+            record = json.loads(line)
+
+            if header is None:
+                header = record
+                if not isinstance(header, dict) or not header.get("format")==SNAPSHOT_FORMAT:
+                    raise ValueError("Not a snapshot file.")
+            elif record.get("type")=="end":
+                trailer = record
+                break
+            else:
+                counts[record.get("type")] = counts.get(record.get("type"), 0) + 1
+
+            checksum.update(line)
+    except (IOError, EOFError, zlib.error), e:
+        raise ValueError("Snapshot is corrupt: %s" % str(e))
+    finally:
+        f.close()
+
+    if header is None or trailer is None:
+        raise ValueError("Snapshot is incomplete.")
+
+    if not header.get("version")==SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version %s." % header.get("version"))
+
+    if not trailer.get("sha256")==checksum.hexdigest():
+        raise ValueError("Snapshot checksum mismatch.")
+
+    if not (trailer.get("states"), trailer.get("ghosts"))==(counts["state"], counts["ghost"]):
+        raise ValueError("Snapshot record counts mismatch.")
+
+    header = dict(header)
+    header["states"] = counts["state"]
+    header["ghosts"] = counts["ghost"]
+
+    return header
+
+def read_snapshot_states(path):
+    """ Reads the states of a snapshot, which should be verified by :func:`verify_snapshot`
+        first. Raises :class:`ValueError` if the hash of a state differs from the saved one.
+
+        :param path: the path of the snapshot file
+        :type path: string
+        :rtype: iterator of :class:`~sduds.states.StateRecord`
+    """
+
+    for record in _read_snapshot_records(path):
+        if not record.get("type")=="state": continue
+
+        state = record_to_state(record)
+        if not binascii.hexlify(state.hash)==record["hash"]:
+            raise ValueError("Hash mismatch for %s." % state.address)
+
+        yield state
+
+def read_snapshot_ghosts(path):
+    """ Reads the ghosts of a snapshot, which should be verified by :func:`verify_snapshot` first.
+
+        :param path: the path of the snapshot file
+        :type path: string
+        :rtype: iterator of ``(binhash, retrieval_timestamp)`` tuples
+    """
+
+    for record in _read_snapshot_records(path):
+        if not record.get("type")=="ghost": continue
+
+        yield binascii.unhexlify(record["hash"]), record["retrieval_timestamp"]
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 
-import os, threading, time
+import os, threading, time, itertools
 
 from sduds.constants import *
 from sduds.states import *
 from sduds.hashtrie import HashTrie
+from sduds.statedatabase import dump
 
 # sqlalchemy mapping for State and Ghost classes
 import sqlalchemy, sqlalchemy.orm
 import sduds.lib.sqlalchemyExtensions as sqlalchemyExt
+from sduds.lib.metrics import registry
+from sduds.lib.instrumentedlock import InstrumentedLock
+from sduds.lib.lrucache import LRUCache
+from sduds.lib import migrations
 
 metadata = sqlalchemy.MetaData()
 
@@ -21,7 +26,7 @@ state_table = sqlalchemy.Table('states', metadata,
     sqlalchemy.Column("country_code", sqlalchemyExt.String(MAX_COUNTRY_CODE_LENGTH)),
     sqlalchemy.Column("services", sqlalchemyExt.String(MAX_SERVICES_LENGTH)),
     sqlalchemy.Column("captcha_signature", sqlalchemyExt.Binary),
-    sqlalchemy.Column("submission_timestamp", sqlalchemy.Integer),
+    sqlalchemy.Column("submission_timestamp", sqlalchemy.Integer, index=True),
     sqlalchemy.Column("retrieval_timestamp", sqlalchemy.Integer)
 )
 
@@ -35,6 +40,16 @@ variables_table = sqlalchemy.Table('variables', metadata,
     sqlalchemy.Column("cleanup_timestamp", sqlalchemy.Integer)
 )
 
+# schema migrations, see sduds.lib.migrations
+
+def add_submission_timestamp_index(connection):
+    """ Adds the index for finding expired states. """
+
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_states_submission_timestamp ON states (submission_timestamp)")
+
+#: The migrations of the state database, see :func:`~sduds.lib.migrations.upgrade`.
+schema_migrations = [add_submission_timestamp_index]
+
 sqlalchemy.orm.mapper(State, state_table, extension=sqlalchemyExt.CalculatedPropertyExtension({"hash":"_hash"}),
     properties={
         "id": state_table.c.id,
@@ -53,25 +68,97 @@ sqlalchemy.orm.mapper(Ghost, ghost_table,
     }
 )
 
+states_saved = registry.counter("states_saved_total", "Number of states saved to the state database.")
+states_discarded = registry.counter("states_discarded_total", "Number of states discarded by the state database.", ["reason"])
+states_expired = registry.counter("states_expired_total", "Number of expired states deleted by the cleanup.")
+search_requests = registry.counter("search_requests_total", "Number of searches by whether their result was cached.", ["result"])
+
+def lower_ascii(string):
+    """ Returns the string with ASCII letters in lower case, because SQLite compares only
+        those case-insensitively in LIKE. """
+
+    return "".join(c.lower() if ord(c)<128 else c for c in string)
+
+def normalize_search_terms(terms):
+    """ Returns the search terms as sorted tuple without duplicates, with ASCII letters in
+        lower case. """
+
+    return tuple(sorted(set(lower_ascii(term) for term in terms)))
+
+def search_matches(state, words, services):
+    """ Whether a state matches a search for the normalized ``words`` and ``services`` in
+        the same way as in :meth:`StateDatabase.search`, i.e. whether adding or deleting the
+        state may change the results. Terms containing the wildcards of LIKE are assumed to
+        match. """
+
+    profile = state.profile
+    if profile is None: return False
+
+    fields = []
+    for field in (state.address, profile.full_name, profile.hometown, profile.country_code):
+        if isinstance(field, str): field = field.decode("utf8")
+        fields.append(lower_ascii(field or u""))
+
+    for word in words:
+        if "%" in word or "_" in word: continue
+        if not any(word in field for field in fields): return False
+
+    state_services = lower_ascii(profile.services).split(",")
+
+    for service in services:
+        if "%" in service or "_" in service: continue
+        if not service in state_services: return False
+
+    return True
+
+def loadable(state, reference_timestamp, check_signature=False):
+    """ Whether a state from a dump or snapshot may be loaded: its profile must pass
+        :meth:`~sduds.states.Profile.check` and must not be expired. The CAPTCHA signature
+        is only verified if ``check_signature`` is set; the other checks are cheap. """
+
+    try:
+        state.profile.check(state.address, reference_timestamp, signature_checked=not check_signature)
+    except (CheckFailed, RecentlyExpiredProfileException):
+        return False
+
+    return True
+
 class StateDatabase:
     database_path = None # for erasing when closing
+    hashtrie_path = None
     hashtrie = None
+    engine = None
     Session = None
     lock = None
 
     cleanup_timestamp = None
 
+    #: The :class:`~sduds.lib.lrucache.LRUCache` mapping the normalized search terms and
+    #: the limit to the lists of found states. Entries are removed when a state matching
+    #: their terms is added or deleted.
+    search_cache = None
+
+    # the numbers of states and ghosts, counted once when opening the database and then
+    # kept up to date by the methods changing the tables, guarded by the lock
+    states_count = None
+    ghosts_count = None
+
     def __init__(self, hashtrie_path, statedb_path, erase=False):
         self.database_path = statedb_path
+        self.hashtrie_path = hashtrie_path
         self.hashtrie = HashTrie(hashtrie_path)
-        self.lock = threading.Lock()
+        self.lock = InstrumentedLock("statedb")
+        self.search_cache = LRUCache(SEARCH_CACHE_SIZE)
 
         if erase and os.path.exists(statedb_path):
             os.remove(statedb_path)
 
         engine = sqlalchemy.create_engine("sqlite:///"+statedb_path)
-        metadata.create_all(engine)
 
+        # create the tables if they don't exist, and bring older databases up to date
+        migrations.upgrade(engine, [metadata], schema_migrations)
+
+        self.engine = engine
         self.Session = sqlalchemy.orm.sessionmaker(bind=engine)
 
         # initialize cleanup_timestamp so that the cleanup thread can
@@ -87,6 +174,9 @@ class StateDatabase:
             # insert one empty row; None is kept for self.cleanup_timestamp
             session.execute(variables_table.insert().values())
 
+        self.states_count = session.query(State).count()
+        self.ghosts_count = session.query(Ghost).count()
+
         session.close()
 
     def cleanup(self):
@@ -94,8 +184,10 @@ class StateDatabase:
             session = self.Session()
 
             now = time.time()
-            age = now - state_table.c.submission_timestamp
-            query = session.query(State).filter(age > PROFILE_LIFETIME)
+
+            # compare the column itself, so that its index is used
+            expired = state_table.c.submission_timestamp < now - PROFILE_LIFETIME
+            query = session.query(State).filter(expired)
 
             delete_hashes = []
             for state in query:
@@ -111,6 +203,12 @@ class StateDatabase:
             session.close()
 
             self.hashtrie.delete(delete_hashes)
+            states_expired.add(len(delete_hashes))
+            self.states_count -= len(delete_hashes)
+
+            # expired states are deleted in large numbers, so drop all results at once
+            if delete_hashes:
+                self.search_cache.clear()
 
         return now
 
@@ -119,43 +217,73 @@ class StateDatabase:
             of users who use certain services.
             'words' must be a list of unicode objects and 'services' must be
             a list of str objects.
-            Warning: Probably very slow! """
+            The results are cached until states matching the search are added
+            or deleted, so the yielded states must not be changed. """
 
         if words is None: words = []
         if services is None: services = []
 
+        key = (normalize_search_terms(words), normalize_search_terms(services), limit)
+
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            search_requests.inc("hit")
+            return iter(cached)
+
+        search_requests.inc("miss")
+
+        # cache the results with the lock held, so that they cannot miss an invalidation
         with self.lock:
-            session = self.Session()
+            states = list(self._search(words, services, limit))
+            self.search_cache.set(key, states)
 
-            query = session.query(State)
+        return iter(states)
 
-            for word in words:
-                like_str = "%" + word.encode("utf8") + "%"
-                like_unicode = u"%" + word + u"%"
+    def _invalidate_searches(self, states):
+        """ Removes the cached search results which the addition or deletion of the given
+            states may change. Must be called with the lock held. """
 
-                condition = state_table.c.webfinger_address.like(like_str)
-                condition |= state_table.c.full_name.like(like_unicode)
-                condition |= state_table.c.hometown.like(like_unicode)
-                condition |= state_table.c.country_code.like(like_str)
+        for key in self.search_cache.keys():
+            words, services, limit = key
 
-                query = query.filter(condition)
+            if any(search_matches(state, words, services) for state in states):
+                self.search_cache.delete(key)
 
-            for service in services:
-                query = query.filter(
-                      state_table.c.services.like(service)
-                    | state_table.c.services.like(service+",%")
-                    | state_table.c.services.like("%,"+service+",%")
-                    | state_table.c.services.like("%,"+service)
-                )
+    def _search(self, words, services, limit):
+        """ Queries the database for :meth:`search`. Must be called with the lock held.
+            Warning: Probably very slow! """
 
-            if limit is not None:
-                query = query.limit(limit)
+        session = self.Session()
 
-            for state in query:
-                session.expunge(state)
-                yield state
+        query = session.query(State)
 
-            session.close()
+        for word in words:
+            like_str = "%" + word.encode("utf8") + "%"
+            like_unicode = u"%" + word + u"%"
+
+            condition = state_table.c.webfinger_address.like(like_str)
+            condition |= state_table.c.full_name.like(like_unicode)
+            condition |= state_table.c.hometown.like(like_unicode)
+            condition |= state_table.c.country_code.like(like_str)
+
+            query = query.filter(condition)
+
+        for service in services:
+            query = query.filter(
+                  state_table.c.services.like(service)
+                | state_table.c.services.like(service+",%")
+                | state_table.c.services.like("%,"+service+",%")
+                | state_table.c.services.like("%,"+service)
+            )
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        for state in query:
+            session.expunge(state)
+            yield state
+
+        session.close()
 
     def save(self, state):
         # TODO: for performance: state -> states, then in assimilation_worker: wait some seconds to acquire states, then save all of them.
@@ -171,6 +299,7 @@ class StateDatabase:
                 if state.retrieval_timestamp<existing_state.retrieval_timestamp:
                     # TODO: logging
                     session.close()
+                    states_discarded.inc("outdated")
                     return False
 
             if state.profile and existing_state:
@@ -182,10 +311,14 @@ class StateDatabase:
                 if interval<MIN_RESUBMISSION_INTERVAL:
                     # TODO: logging
                     session.close()
+                    states_discarded.inc("resubmission_interval")
                     return False
 
+            changed_states = []
+
             if existing_state:
                 # delete existing state
+                changed_states.append(existing_state)
                 binhash = existing_state.hash
                 retrieval_timestamp = existing_state.retrieval_timestamp
 
@@ -195,15 +328,253 @@ class StateDatabase:
                 ghost = Ghost(binhash, retrieval_timestamp)
                 session.add(ghost)
 
+                # the new state has the same address, so it must not be inserted before the deletion
+                session.flush()
+
+                self.states_count -= 1
+                self.ghosts_count += 1
+
             if state.profile:
-                # add new state
+                # add new state, records from the queues have to be converted to mapped objects
+                if isinstance(state, StateRecord):
+                    state = state.to_state()
+
                 session.add(state)
                 self.hashtrie.add([state.hash])
+                changed_states.append(state)
+
+                self.states_count += 1
+
+            # before committing, as the attributes of the existing state expire then
+            self._invalidate_searches(changed_states)
 
             session.commit()
             session.close()
+            states_saved.inc()
             return True
 
+    def bulk_load(self, states, batch_size=BULK_LOAD_BATCH_SIZE, check=False):
+        """ Inserts many states at once, e.g. to seed a new node from a dump. Unlike
+            :meth:`save`, states are not compared to existing ones: states without profile
+            and states whose address is already in the database or occurs earlier in
+            ``states`` are skipped. Each batch is inserted in one transaction, and the
+            hashes of all loaded states are added to the hash trie in one sorted stream
+            at the end, so the database must not be used by others meanwhile. If ``states``
+            raises an exception, the batches inserted so far are kept.
+
+            The states are trusted, as they are offered to the partners afterwards: expired
+            states and states which fail the cheap checks of :meth:`~sduds.states.Profile.check`
+            are skipped, but the CAPTCHA signatures are only verified if ``check`` is set.
+
+            :param states: the states to load
+            :type states: iterable of :class:`~sduds.states.StateRecord` or :class:`~sduds.states.State`
+            :param batch_size: the number of states inserted per transaction (optional)
+            :type batch_size: integer
+            :param check: whether to verify the CAPTCHA signatures (optional)
+            :type check: boolean
+            :returns: the number of loaded and of skipped states
+            :rtype: (integer, integer)-tuple
+        """
+
+        loaded_hashes = []
+        skipped = 0
+
+        now = int(time.time())
+
+        with self.lock:
+            try:
+                batch = []
+
+                for state in states:
+                    if state.profile is None:
+                        skipped += 1
+                        continue
+
+                    batch.append(state)
+
+                    if len(batch)>=batch_size:
+                        skipped += self._insert_batch(batch, loaded_hashes, now, check)
+                        batch = []
+
+                if batch:
+                    skipped += self._insert_batch(batch, loaded_hashes, now, check)
+            finally:
+                # also if reading the states failed, the committed batches must be in the trie
+                loaded_hashes.sort()
+                self.hashtrie.add(loaded_hashes)
+                self.states_count += len(loaded_hashes)
+
+                if loaded_hashes:
+                    self.search_cache.clear()
+
+        states_saved.add(len(loaded_hashes))
+        states_discarded.add(skipped, "bulk_load_skipped")
+
+        return len(loaded_hashes), skipped
+
+    def _insert_batch(self, batch, loaded_hashes, reference_timestamp, check):
+        """ Inserts a batch of states in one transaction and appends their hashes to
+            ``loaded_hashes``. States which are not :func:`loadable` are skipped. Returns
+            the number of skipped states. Must be called with the lock held. """
+
+        connection = self.engine.connect()
+        transaction = connection.begin()
+
+        try:
+            # addresses which are already in the database, queried in chunks to stay
+            # below the limit of SQL variables
+            addresses = [state.address for state in batch]
+            existing = set()
+
+            for i in xrange(0, len(addresses), 500):
+                column = state_table.c.webfinger_address
+                query = sqlalchemy.select([column], column.in_(addresses[i:i+500]))
+                existing.update(address for address, in connection.execute(query))
+
+            rows = []
+
+            for state in batch:
+                if state.address in existing: continue
+                if not loadable(state, reference_timestamp, check): continue
+                existing.add(state.address)
+
+                profile = state.profile
+
+                rows.append({"hash": state.hash,
+                             "webfinger_address": state.address,
+                             "full_name": profile.full_name,
+                             "hometown": profile.hometown,
+                             "country_code": profile.country_code,
+                             "services": profile.services,
+                             "captcha_signature": profile.captcha_signature,
+                             "submission_timestamp": profile.submission_timestamp,
+                             "retrieval_timestamp": state.retrieval_timestamp})
+
+            if rows:
+                connection.execute(state_table.insert(), rows)
+
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
+        loaded_hashes.extend(row["hash"] for row in rows)
+
+        return len(batch) - len(rows)
+
+    def _insert_ghosts(self, ghosts, batch_size):
+        """ Inserts ``(binhash, retrieval_timestamp)`` tuples whose hash is not in the database
+            yet into the ghosts table, one transaction per batch. Returns the number of
+            inserted ghosts. Must be called with the lock held. """
+
+        inserted = 0
+        ghosts = iter(ghosts)
+
+        while True:
+            batch = list(itertools.islice(ghosts, batch_size))
+            if not batch: break
+
+            connection = self.engine.connect()
+            transaction = connection.begin()
+
+            try:
+                existing = set()
+                column = ghost_table.c.hash
+
+                for i in xrange(0, len(batch), 500):
+                    query = sqlalchemy.select([column], column.in_([binhash for binhash, timestamp in batch[i:i+500]]))
+                    existing.update(binhash for binhash, in connection.execute(query))
+
+                rows = []
+                for binhash, retrieval_timestamp in batch:
+                    if binhash in existing: continue
+                    existing.add(binhash)
+                    rows.append({"hash": binhash, "retrieval_timestamp": retrieval_timestamp})
+
+                if rows:
+                    connection.execute(ghost_table.insert(), rows)
+
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            finally:
+                connection.close()
+
+            inserted += len(rows)
+            self.ghosts_count += len(rows)
+
+        return inserted
+
+    def export_snapshot(self, path):
+        """ Writes all states and ghosts to a snapshot file, see :mod:`sduds.statedatabase.dump`.
+            The database is locked meanwhile, so that the snapshot is consistent with the
+            hash trie.
+
+            :param path: the path of the snapshot file
+            :type path: string
+            :returns: the number of exported states and ghosts
+            :rtype: (integer, integer)-tuple
+        """
+
+        with self.lock:
+            connection = self.engine.connect()
+
+            try:
+                def states():
+                    query = sqlalchemy.select([state_table]).order_by(state_table.c.hash)
+
+                    for row in connection.execute(query):
+                        profile = Profile(row.full_name, row.hometown, row.country_code, row.services, row.captcha_signature, row.submission_timestamp)
+                        yield StateRecord(row.webfinger_address, row.retrieval_timestamp, profile)
+
+                def ghosts():
+                    query = sqlalchemy.select([ghost_table.c.hash, ghost_table.c.retrieval_timestamp]).order_by(ghost_table.c.hash)
+
+                    for binhash, retrieval_timestamp in connection.execute(query):
+                        yield binhash, retrieval_timestamp
+
+                return dump.write_snapshot(path, states(), ghosts())
+            finally:
+                connection.close()
+
+    def import_snapshot(self, path, batch_size=BULK_LOAD_BATCH_SIZE, check=False):
+        """ Loads a snapshot written by :meth:`export_snapshot`, usually into a new database.
+            The snapshot is verified first; states and ghosts which are already in the
+            database are skipped, as in :meth:`bulk_load`. Raises :class:`ValueError` if
+            the snapshot is corrupt.
+
+            The snapshot is trusted like the states passed to :meth:`bulk_load`: expired and
+            malformed states are skipped, but the CAPTCHA signatures are only verified if
+            ``check`` is set.
+
+            :param path: the path of the snapshot file
+            :type path: string
+            :param batch_size: the number of records inserted per transaction (optional)
+            :type batch_size: integer
+            :param check: whether to verify the CAPTCHA signatures (optional)
+            :type check: boolean
+            :returns: the numbers of loaded states, skipped states and loaded ghosts
+            :rtype: (integer, integer, integer)-tuple
+        """
+
+        dump.verify_snapshot(path)
+
+        loaded, skipped = self.bulk_load(dump.read_snapshot_states(path), batch_size, check)
+
+        with self.lock:
+            ghosts = self._insert_ghosts(dump.read_snapshot_ghosts(path), batch_size)
+
+        return loaded, skipped, ghosts
+
+    def count(self):
+        """ Returns the number of states and ghosts in the database. The numbers are
+            kept in memory, so this does not query the database or wait for the lock. """
+
+        return self.states_count, self.ghosts_count
+
     def get_ghosts(self, binhashes):
         with self.lock:
             session = self.Session()
@@ -225,7 +596,7 @@ class StateDatabase:
             address, = query.one()
             session.close()
 
-        invalid_state = State(address, timestamp, None)
+        invalid_state = StateRecord(address, timestamp, None)
         return invalid_state
 
     def get_valid_state(self, binhash):
@@ -245,6 +616,86 @@ class StateDatabase:
         else:
             return state
 
+    def iter_valid_states(self, chunk_size=1000):
+        """ Yields all states ordered by hash, for the catch-up mode of synchronizations. As
+            in :meth:`get_valid_state`, states retrieved more than ``MAX_AGE`` seconds ago
+            are yielded without profile and retrieval timestamp. The states are read in
+            chunks, each with the lock held, so that the database can be used meanwhile.
+
+            Therefore the iteration is not atomic: states saved or deleted while it runs
+            are yielded or not depending on where their hashes fall relative to the
+            current chunk, so the result need not match any single point in time. The
+            catch-up mode tolerates this because the regular reconciliation of the hash
+            tries follows and transfers whatever changed in the meantime.
+
+            :param chunk_size: the number of states read at once (optional)
+            :type chunk_size: integer
+            :rtype: iterator of ``(binhash, state)`` tuples
+        """
+
+        last_hash = None
+
+        while True:
+            query = sqlalchemy.select([state_table]).order_by(state_table.c.hash).limit(chunk_size)
+            if last_hash is not None:
+                query = query.where(state_table.c.hash>last_hash)
+
+            with self.lock:
+                connection = self.engine.connect()
+                rows = connection.execute(query).fetchall()
+                connection.close()
+
+            if not rows: break
+
+            now = time.time()
+
+            for row in rows:
+                if now - row.retrieval_timestamp > MAX_AGE:
+                    state = StateRecord(row.webfinger_address, None, None)
+                else:
+                    profile = Profile(row.full_name, row.hometown, row.country_code, row.services, row.captcha_signature, row.submission_timestamp)
+                    state = StateRecord(row.webfinger_address, row.retrieval_timestamp, profile)
+
+                yield row.hash, state
+
+            last_hash = rows[-1].hash
+
+    def iter_hashes(self, ghosts=False, chunk_size=10000):
+        """ Yields the hashes of all states or of all ghosts in ascending order. They are
+            read in chunks like in :meth:`iter_valid_states`, so the iteration is not atomic
+            either.
+
+            :param ghosts: whether to read the hashes of the ghosts instead of the states (optional)
+            :type ghosts: boolean
+            :param chunk_size: the number of hashes read at once (optional)
+            :type chunk_size: integer
+            :rtype: iterator of raw 16-byte hashes
+        """
+
+        if ghosts:
+            column = ghost_table.c.hash
+        else:
+            column = state_table.c.hash
+
+        last_hash = None
+
+        while True:
+            query = sqlalchemy.select([column]).order_by(column).limit(chunk_size)
+            if last_hash is not None:
+                query = query.where(column>last_hash)
+
+            with self.lock:
+                connection = self.engine.connect()
+                binhashes = [binhash for binhash, in connection.execute(query)]
+                connection.close()
+
+            if not binhashes: break
+
+            for binhash in binhashes:
+                yield binhash
+
+            last_hash = binhashes[-1]
+
     def close(self, erase=False):
         with self.lock:
             if self.Session is not None:
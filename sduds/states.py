@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 
-import urllib2, json, pywebfinger, binascii, hashlib, time
+import json, binascii, hashlib, time
 
 from constants import *
 from lib.signature import signature_valid
+from lib.connectionpool import ConnectionPool
+from lib.lrucache import LRUCache
+from lib import webfinger
+from lib.metrics import registry
+
+#: The :class:`~sduds.lib.connectionpool.ConnectionPool` shared by all threads retrieving profiles.
+connection_pool = ConnectionPool(HTTP_MAX_IDLE_PER_HOST, HTTP_MAX_IDLE, HTTP_IDLE_TIMEOUT)
+
+#: The :class:`~sduds.lib.lrucache.LRUCache` of LRDD templates shared by all threads retrieving profiles.
+host_meta_cache = LRUCache(HOST_META_CACHE_SIZE)
+
+#: The :class:`~sduds.lib.lrucache.LRUCache` mapping sduds URIs to ``(etag, last_modified, json_string)``
+#: tuples, used by :meth:`Profile.retrieve` to send conditional requests.
+document_cache = LRUCache(DOCUMENT_CACHE_SIZE)
+
+#: The :class:`~sduds.lib.metrics.Histogram` of the durations of :meth:`State.retrieve`, labeled
+#: with the outcome (``success`` or ``failure``).
+retrieval_duration = registry.histogram("retrieval_duration_seconds", "Duration of profile retrievals.", ["outcome"])
 
 class RetrievalFailed(Exception):
     """ Raised by :meth:`Profile.retrieve` if the profile retrieval fails for other reasons than
@@ -114,7 +132,7 @@ class Profile:
 
         return s
 
-    def check(self, webfinger_address, reference_timestamp=None, public_key=None):
+    def check(self, webfinger_address, reference_timestamp=None, public_key=None, signature_checked=False):
         """ Checks the profile against a certain webfinger address. It performs the following checks:
 
             * The CAPTCHA provider's :attr:`signature <captcha_signature>` of the webfinger address is
@@ -143,6 +161,8 @@ class Profile:
             :param public_key: the base64-encoded public key of the CAPTCHA provider (optional)
                                -- defaults to ``constants.CAPTCHA_PUBLIC_KEY``
             :type public_key: string
+            :param signature_checked: whether the signature is already known to be valid (optional)
+            :type signature_checked: boolean
             :rtype: boolean
         """
 
@@ -153,7 +173,7 @@ class Profile:
             public_key = CAPTCHA_PUBLIC_KEY
 
         # validate CAPTCHA signature for given webfinger address
-        if not signature_valid(public_key, self.captcha_signature, webfinger_address):
+        if not signature_checked and not signature_valid(public_key, self.captcha_signature, webfinger_address):
             raise MalformedProfileException(str(self), "Invalid captcha signature")
 
         # make sure that submission_timestamp is not in future
@@ -193,30 +213,62 @@ class Profile:
         return True
 
     @classmethod
-    def retrieve(cls, address, timeout=None):
+    def retrieve(cls, address, timeout=None, pool=None):
         """ Retrieves a profile from the web, given the webfinger address.
             Raises :class:`IOError` if there are connection problems or :class:`RetrievalFailed`
             if the profile could not be retrieved for other reasons.
 
+            The sduds document is requested conditionally if it was retrieved before and the
+            server sent an ``ETag`` or ``Last-Modified`` header. If the server answers with
+            ``304 Not Modified``, the document kept in :data:`document_cache` is used.
+
             :param address: the webfinger address of the profile that should be retrieved
             :type address: string
             :param timeout: timout in seconds (optional)
             :type timeout: float
+            :param pool: the pool of persistent connections used for the requests (optional)
+                         -- defaults to the module-wide :data:`connection_pool`
+            :type pool: :class:`~sduds.lib.connectionpool.ConnectionPool`
             :rtype: :class:`Profile`
         """
 
+        if pool is None:
+            pool = connection_pool
+
         try:
-            wf = pywebfinger.finger(address, timeout=timeout)
+            wf = webfinger.finger(address, pool, timeout, host_meta_cache)
             sduds_uri = wf.find_link("http://hoegners.de/sduds/spec", attr="href")
         except IOError:
             raise
         except Exception, e:
             raise RetrievalFailed("Could not get the sduds URL from the webfinger profile: %s" % str(e))
 
+        cached_document = document_cache.get(sduds_uri)
+
+        headers = {}
+        if cached_document is not None:
+            etag, last_modified, cached_json_string = cached_document
+
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
         try:
-            f = urllib2.urlopen(sduds_uri, timeout=timeout)
-            json_string = f.read()
-            f.close()
+            response = pool.request(sduds_uri, headers=headers, timeout=timeout)
+
+            if response.status==304 and cached_document is not None:
+                json_string = cached_json_string
+            else:
+                json_string = response.body
+
+                etag = response.headers.get("etag")
+                last_modified = response.headers.get("last-modified")
+
+                if etag is None and last_modified is None:
+                    document_cache.delete(sduds_uri)
+                else:
+                    document_cache.set(sduds_uri, (etag, last_modified, json_string))
 
             json_dict = json.loads(json_string)
         except IOError:
@@ -253,48 +305,15 @@ class Profile:
 
         return profile
 
-class State(object):
-    """ Given a certain webfinger address, a profile may be accessible there or not.
-        The accessible profile, or whether there is one at all, may change with time.
-        This class is used to represent the state of a webfinger address at a certain
-        time.
-
-        States are used in two different contexts: As an argument to
-        :meth:`StateDatabase.save <sduds.statedatabase.interface.StateDatabase.save>`
-        or in :class:`StateMessages <sduds.synchronization.StateMessage>` to communicate
-        profile states to partners.
-        Therefore, there are three kinds of states, defined as follows:
-
-        * A *valid-up-to-date* state is a state with none of the :attr:`address`,
-          :attr:`retrieval_timestamp` and :attr:`profile` attributes set to ``None``.
-        * A *valid-out-dated* state is a state with both :attr:`retrieval_timestamp`
-          and :attr:`profile` set to ``None``.
-        * An *invalid* state is a state with only :attr:`profile` set to ``None``.
-
-        Only valid-up-to-date states are actually stored in the database, the two other kinds
-        of states are only used as intermediary objects.
+class BaseState(object):
+    """ Implements the methods shared by :class:`State` and :class:`StateRecord`. Has no
+        instance dictionary itself, so that :class:`StateRecord` can use ``__slots__``.
     """
 
-    #: The webfinger address (string).
-    address = None
-
-    #: The timestamp to which the data saved in the :attr:`profile` attribute refers (integer).
-    #: In :class:`State` instances used in :class:`StateMessages <sduds.synchronization.StateMessage>`,
-    #: this may also be set to ``None`` to indicate to a partner that the profile has changed,
-    #: but we do not have up-to-date data, so the partner should retrieve the profile by himself.
-    #: If set to ``None``, :attr:`profile` must also be ``None``.
-    retrieval_timestamp = None
-
-    #: The :class:`Profile` which is accessible at the given webfinger address, or ``None``
-    #: if no profile can be retrieved from this address.
-    profile = None
-
-    def __init__(self, address, retrieval_timestamp, profile):
-        """ For a description of the arguments see the documentation of the attributes of this class. """
+    __slots__ = ()
 
-        self.address = address
-        self.retrieval_timestamp = retrieval_timestamp
-        self.profile = profile
+    # the relevant data and the result of the last hash calculation, see hash
+    _hash_cache = None
 
     def __eq__(self, other):
         assert self.retrieval_timestamp is not None
@@ -321,7 +340,7 @@ class State(object):
 
         return s
 
-    def check(self, reference_timestamp=None):
+    def check(self, reference_timestamp=None, signature_checked=False):
         """ This method is only applicable for invalid or valid-up-to-date states, i.e.
             states that can be used for `StateDatabase.save`.
 
@@ -342,6 +361,9 @@ class State(object):
             :param reference_timestamp: the timestamp to compare the submission timestamp against
                                         (optional) -- defaults to the current time
             :type reference_timestamp: integer
+            :param signature_checked: whether the CAPTCHA signature is already known to be valid,
+                                      passed to :meth:`Profile.check` (optional)
+            :type signature_checked: boolean
             :rtype: boolean
         """
 
@@ -360,7 +382,7 @@ class State(object):
 
         if self.profile:
             # check profile for valid-up-to-date states
-            self.profile.check(self.address, reference_timestamp)
+            self.profile.check(self.address, reference_timestamp, signature_checked=signature_checked)
 
             # make sure retrieval_timestamp is not before submission timestamp
             if not self.retrieval_timestamp>=self.profile.submission_timestamp:
@@ -381,11 +403,16 @@ class State(object):
             :rtype: :class:`State`
         """
 
+        start = time.time()
+
         try:
             profile = Profile.retrieve(address, timeout)
         except (RetrievalFailed, IOError), e:
             # TODO: logging
             profile = None
+            retrieval_duration.observe(time.time() - start, "failure")
+        else:
+            retrieval_duration.observe(time.time() - start, "success")
 
         retrieval_timestamp = int(time.time())
 
@@ -398,15 +425,22 @@ class State(object):
         """ Calculated property which returns a raw 16-byte hash value (string) built of the
             :attr:`address` and the :attr:`profile`. Used to keep track of profile changes.
             Only applicable for valid-up-to-date states.
+
+            The value is cached together with the data it was calculated of, so it is only
+            recalculated if the address or a profile field has changed.
         """
 
         assert self.profile is not None
 
-        combinedhash = hashlib.sha1()
-
-        relevant_data = [self.address, self.profile.full_name,
+        relevant_data = (self.address, self.profile.full_name,
             self.profile.hometown, self.profile.country_code,
-            self.profile.services, int(self.profile.submission_timestamp)]
+            self.profile.services, int(self.profile.submission_timestamp))
+
+        cached = self._hash_cache
+        if cached is not None and cached[0]==relevant_data:
+            return cached[1]
+
+        combinedhash = hashlib.sha1()
 
         for data in relevant_data:
             # convert data to string
@@ -421,8 +455,87 @@ class State(object):
 
         # TODO: is it unsecure to take only 16 bytes of the hash?
         binhash = combinedhash.digest()[:16]
+
+        self._hash_cache = (relevant_data, binhash)
         return binhash
 
+class State(BaseState):
+    """ Given a certain webfinger address, a profile may be accessible there or not.
+        The accessible profile, or whether there is one at all, may change with time.
+        This class is used to represent the state of a webfinger address at a certain
+        time.
+
+        States are used in two different contexts: As an argument to
+        :meth:`StateDatabase.save <sduds.statedatabase.interface.StateDatabase.save>`
+        or in :class:`StateMessages <sduds.synchronization.StateMessage>` to communicate
+        profile states to partners.
+        Therefore, there are three kinds of states, defined as follows:
+
+        * A *valid-up-to-date* state is a state with none of the :attr:`address`,
+          :attr:`retrieval_timestamp` and :attr:`profile` attributes set to ``None``.
+        * A *valid-out-dated* state is a state with both :attr:`retrieval_timestamp`
+          and :attr:`profile` set to ``None``.
+        * An *invalid* state is a state with only :attr:`profile` set to ``None``.
+
+        Only valid-up-to-date states are actually stored in the database, the two other kinds
+        of states are only used as intermediary objects.
+
+        This class is mapped by the SQLAlchemy-based database backend, so its instances carry
+        instrumentation. States that are only received, queued and checked are represented by
+        :class:`StateRecord` instances instead, which are converted to :class:`State` instances
+        when they are saved.
+    """
+
+    #: The webfinger address (string).
+    address = None
+
+    #: The timestamp to which the data saved in the :attr:`profile` attribute refers (integer).
+    #: In :class:`State` instances used in :class:`StateMessages <sduds.synchronization.StateMessage>`,
+    #: this may also be set to ``None`` to indicate to a partner that the profile has changed,
+    #: but we do not have up-to-date data, so the partner should retrieve the profile by himself.
+    #: If set to ``None``, :attr:`profile` must also be ``None``.
+    retrieval_timestamp = None
+
+    #: The :class:`Profile` which is accessible at the given webfinger address, or ``None``
+    #: if no profile can be retrieved from this address.
+    profile = None
+
+    def __init__(self, address, retrieval_timestamp, profile):
+        """ For a description of the arguments see the documentation of the attributes of this class. """
+
+        self.address = address
+        self.retrieval_timestamp = retrieval_timestamp
+        self.profile = profile
+
+
+class StateRecord(BaseState):
+    """ A compact, unmapped counterpart of :class:`State` with the same attributes and methods,
+        used for states decoded from messages, retrieved profiles and claims in the queues.
+        Uses ``__slots__``, so it does not carry an instance dictionary or SQLAlchemy
+        instrumentation.
+    """
+
+    __slots__ = ("address", "retrieval_timestamp", "profile", "_hash_cache")
+
+    def __init__(self, address, retrieval_timestamp, profile):
+        """ For a description of the arguments see the documentation of :class:`State`. """
+
+        self.address = address
+        self.retrieval_timestamp = retrieval_timestamp
+        self.profile = profile
+        self._hash_cache = None
+
+    def to_state(self):
+        """ Returns a :class:`State` with the same attributes, which can be saved in the database.
+
+            :rtype: :class:`State`
+        """
+
+        state = State(self.address, self.retrieval_timestamp, self.profile)
+        state._hash_cache = self._hash_cache
+
+        return state
+
 class Ghost(object):
     """ Represents a former :class:`State` which was made obsolete by a more recent state.
         An instance of this class is saved when a :attr:`~State.hash` is deleted from the
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
-import struct, time
-from states import Profile, State # to be able to construct these objects from messages
+import struct, time, heapq
+from states import Profile, StateRecord # to be able to construct these objects from messages
 
 from constants import *
 
@@ -65,6 +65,19 @@ def _read_unicode(f):
 
     return u
 
+#: The name of the authentication extension with which both partners agree to
+#: exchange their numbers of states and possibly use the catch-up mode.
+CATCH_UP_EXTENSION = "catch-up"
+
+def catch_up(own_size, partner_size):
+    """ Decides from the numbers of states of both partners whether they are so
+        different that one partner should send all of its states before the hash
+        tries are reconciled. Gives the same result on both sides. """
+
+    smaller, larger = sorted((own_size, partner_size))
+
+    return larger - smaller>=CATCH_UP_MIN_DIFFERENCE and smaller<=CATCH_UP_MAX_RATIO*larger
+
 ###################
 
 class Message:
@@ -128,7 +141,7 @@ class DeletionRequest(Message):
             if now < ghost.retrieval_timestamp + MAX_AGE:
                 self.retrieval_timestamp = ghost.retrieval_timestamp
 
-            self.binhash = ghost.binhash
+            self.binhash = ghost.hash
 
     def write(self, f):
         # send message type
@@ -256,10 +269,51 @@ class StateMessage(Message):
             profile = Profile(full_name, hometown, country_code, services,
                               captcha_signature, submission_timestamp)
 
-        state = State(address, retrieval_timestamp, profile)
+        state = StateRecord(address, retrieval_timestamp, profile)
 
         return cls(state)
 
+class BulkStateMessage(Message):
+    """ The BulkStateMessage is used in the catch-up mode, in which one partner
+        sends all of its states ordered by hash. It contains the hash of the
+        state in addition to a StateMessage, so that the receiver can compare
+        the hashes to its own without calculating them, and also for states
+        sent without profile. """
+
+    message_type = 'b'
+
+    binhash = None
+    state = None
+
+    def __init__(self, binhash, state):
+        self.binhash = binhash
+        self.state = state
+
+    def write(self, f):
+        # send message type
+        f.write(self.message_type)
+
+        # send binhash
+        _write_short_str(f, self.binhash)
+
+        # send state
+        StateMessage(self.state).write(f)
+
+    @classmethod
+    def read(cls, f):
+        # read message type
+        message_type = f.read(1)
+        if not message_type==cls.message_type: return None
+
+        # read binhash
+        binhash = _read_short_str(f)
+
+        # read state
+        message = StateMessage.read(f)
+        if not message: raise ValueError("Bulk state message without state.")
+
+        return cls(binhash, message.state)
+
 class Synchronization:
     """ This is a helper class to avoid duplicated code blocks in the
         synchronization functions. """
@@ -268,22 +322,27 @@ class Synchronization:
     preliminary_invalid_states = None
     request_hashes = None
     requests = None
+    received = None
+    bulk_hashes = None
 
-    def __init__(self, missing_hashes):
+    def __init__(self, missing_hashes=None):
         self.missing_hashes = missing_hashes
 
     def send_deletion_requests(self, f, statedb):
-        """ filter out ghost states the partner doesn't know yet and tell him
+        """ filter out ghost states the partner doesn't know yet and tell him;
+            returns the number of sent deletion requests
         """
 
         deleted_hashes = set()
+        count = 0
 
         for ghost in statedb.get_ghosts(self.missing_hashes):
-            deleted_hashes += ghost.hash
+            deleted_hashes.add(ghost.hash)
 
             if ghost.retrieval_timestamp is not None:
                 deletion_request = DeletionRequest(ghost)
                 deletion_request.write(f)
+                count += 1
 
         terminator.write(f)
         f.flush()
@@ -291,12 +350,21 @@ class Synchronization:
         self.request_hashes = self.missing_hashes - deleted_hashes
         self.missing_hashes = None
 
+        # states received in catch-up mode need not be requested again
+        if self.bulk_hashes is not None:
+            self.request_hashes -= self.bulk_hashes
+            self.bulk_hashes = None
+
+        return count
+
     def receive_deletion_requests(self, f, statedb):
         """ Receive delete requests and construct preliminary invalid states
             from them. These states may be omitted later if there is a new valid
-            state for the same webfinger address. """
+            state for the same webfinger address. Returns the number of received
+            deletion requests. """
 
         self.preliminary_invalid_states = {}
+        count = 0
 
         while True:
             deletion_request = DeletionRequest.read(f)
@@ -307,9 +375,14 @@ class Synchronization:
 
             state = statedb.get_invalid_state(binhash, timestamp)
             self.preliminary_invalid_states[state.address] = state
+            count += 1
+
+        return count
 
     def send_state_requests(self, f):
-        """ request valid states """
+        """ request valid states; returns the number of sent requests """
+
+        count = len(self.request_hashes)
 
         for binhash in self.request_hashes:
             request = StateRequest(binhash)
@@ -320,6 +393,8 @@ class Synchronization:
 
         self.request_hashes = None
 
+        return count
+
     def receive_states(self, f):
         """ Receive valid states, removing the preliminarily constructed invalid
             states for the respective webfinger addresses. Will yield the
@@ -347,7 +422,7 @@ class Synchronization:
             yield invalid_state
 
     def receive_state_requests(self, f):
-        """ receive requests for valid states """
+        """ receive requests for valid states; returns the number of received requests """
 
         self.requests = []
 
@@ -357,8 +432,10 @@ class Synchronization:
 
             self.requests.append(request)
 
+        return len(self.requests)
+
     def send_states(self, f, statedb):
-        """ answer state requests """
+        """ answer state requests; returns the number of sent states """
 
         for request in self.requests:
             state = statedb.get_valid_state(request.binhash)
@@ -367,3 +444,56 @@ class Synchronization:
 
         terminator.write(f)
         f.flush()
+
+        return len(self.requests)
+
+    def send_all_states(self, f, statedb):
+        """ catch-up mode: send all states ordered by hash; returns the number
+            of sent states """
+
+        count = 0
+
+        for binhash, state in statedb.iter_valid_states():
+            message = BulkStateMessage(binhash, state)
+            message.write(f)
+            count += 1
+
+        terminator.write(f)
+        f.flush()
+
+        return count
+
+    def receive_all_states(self, f, statedb):
+        """ catch-up mode: receive all states of the partner and yield those
+            whose hash is neither a state nor a ghost in our database. As both
+            the received and our own hashes are ordered, they are compared by a
+            merge join. Sets the number of received messages in the received
+            attribute and collects the hashes of the yielded states in the
+            bulk_hashes attribute, so that they are not requested again in the
+            following regular synchronization. """
+
+        own_hashes = heapq.merge(statedb.iter_hashes(), statedb.iter_hashes(ghosts=True))
+        own_hash = next(own_hashes, None)
+
+        previous_hash = None
+        self.received = 0
+        self.bulk_hashes = set()
+
+        while True:
+            message = BulkStateMessage.read(f)
+            if not message: break
+
+            self.received += 1
+
+            binhash = message.binhash
+            if previous_hash is not None and not binhash>previous_hash:
+                raise ValueError("States in catch-up mode are not ordered by hash.")
+            previous_hash = binhash
+
+            while own_hash is not None and own_hash<binhash:
+                own_hash = next(own_hashes, None)
+
+            if own_hash==binhash: continue
+
+            self.bulk_hashes.add(binhash)
+            yield message.state
@@ -5,32 +5,65 @@ import threading
 
 import json
 
+from constants import *
+from lib.metrics import registry
+from lib.asyncwsgi import AsyncWSGIServer
+
 class ThreadingWSGIServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
     allow_reuse_address = True
 
     def __init__(self, *args, **kwargs):
         wsgiref.simple_server.WSGIServer.__init__(self, *args, **kwargs)
 
+def make_async_server(interface, port, application):
+    return AsyncWSGIServer((interface, port), application, WEB_SERVER_WORKERS, WEB_SERVER_MAX_PENDING,
+                           WEB_SERVER_MAX_CONNECTIONS, WEB_SERVER_REQUEST_TIMEOUT, WEB_SERVER_KEEPALIVE_TIMEOUT)
+
+def make_threading_server(interface, port, application):
+    return wsgiref.simple_server.make_server(interface, port, application, ThreadingWSGIServer)
+
+#: Maps the names of the server implementations to functions which take the interface, the port
+#: and the WSGI application, and return a server with the methods ``serve_forever``, ``shutdown``
+#: and ``server_close`` of :class:`SocketServer.TCPServer`.
+servers = {
+    "async": make_async_server,
+    "threading": make_threading_server,
+}
+
 class WebServer(threading.Thread):
     context = None
     httpd = None
 
-    def __init__(self, context, interface="", port=20000):
+    #: Whether this server only serves the monitoring pages ``/metrics`` and ``/synchronizations``
+    #: instead of the public pages. They show the names of the partners, their failed control
+    #: samples and the timings of the synchronizations, so a monitoring server should only listen
+    #: on a loopback interface (boolean).
+    monitoring = None
+
+    def __init__(self, context, interface="", port=20000, server="async", monitoring=False):
         threading.Thread.__init__(self)
 
         self.context = context
-        self.httpd = wsgiref.simple_server.make_server(interface, port, self.dispatch, ThreadingWSGIServer)
+        self.monitoring = monitoring
+        self.httpd = servers[server](interface, port, self.dispatch)
 
     def run(self):
         self.httpd.serve_forever()
 
     def terminate(self):
         self.httpd.shutdown()
-        self.httpd.socket.close()
+        self.httpd.server_close()
 
     # WSGI applications
     def dispatch(self, environment, start_response):
-        if environment["PATH_INFO"]=="/":
+        if self.monitoring:
+            if environment["PATH_INFO"]=="/metrics":
+                func = self.metrics
+            elif environment["PATH_INFO"]=="/synchronizations":
+                func = self.synchronizations
+            else:
+                func = self.not_found
+        elif environment["PATH_INFO"]=="/":
             func = self.index
         elif environment["PATH_INFO"]=="/submit":
             func = self.submit
@@ -108,6 +141,19 @@ class WebServer(threading.Thread):
             start_response("200 OK", [("Content-type","application/json")])
             yield json.dumps((fqdn, port))
 
+    def metrics(self, environment, start_response):
+        start_response("200 OK", [("Content-type", "text/plain; version=0.0.4")])
+        yield registry.render()
+
+    def synchronizations(self, environment, start_response):
+        if not self.context.trace_log:
+            start_response("404 Not Found", [("Content-type", "text/plain")])
+            yield "Synchronization tracing disabled."
+            return
+
+        start_response("200 OK", [("Content-type","application/json")])
+        yield json.dumps(self.context.trace_log.summary(), sort_keys=True)
+
     def not_found(self, environment, start_response):
         start_response("404 Not Found", [("Content-type", "text/plain")])
         yield "%s not found." % environment["PATH_INFO"]
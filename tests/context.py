@@ -0,0 +1,265 @@
+import unittest
+
+import time, logging, threading
+import os, tempfile, shutil
+
+from sduds import context
+from sduds.partners import Partner, PartnerDatabase
+from sduds.statedatabase import dump
+from sduds.lib import signature
+
+from tests.states import private_key_block
+
+class StateDatabaseDummy:
+    """ Stands in for the state database, which is not used by the tested methods. """
+
+    database_path = None
+    hashtrie_path = None
+
+    def close(self, erase=False):
+        pass
+
+class ContextTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.partnerdb = PartnerDatabase(os.path.join(directory, "partners.sqlite"))
+
+        self.context = context.Context(StateDatabaseDummy(), self.partnerdb)
+        self.addCleanup(self.context.close)
+
+        self.logger = logging.getLogger("tests.context")
+        self.logger.disabled = True
+
+        self.timestamp = int(time.time())
+        self.states = list(dump.generate_states(5, private_key_block, self.timestamp, seed=1))
+
+class PendingAddresses(unittest.TestCase):
+    def setUp(self):
+        self.pending = context.PendingAddresses(60)
+
+    def test_add_finish(self):
+        """ an address must be pending from add() until the window after finish() has passed """
+
+        self.assertTrue(self.pending.add("a@example.org", now=0))
+        self.assertFalse(self.pending.add("a@example.org", now=1))
+        self.assertEqual(self.pending.coalesced, 1)
+
+        self.pending.finish("a@example.org", now=10)
+        self.assertFalse(self.pending.add("a@example.org", now=69))
+        self.assertEqual(self.pending.coalesced, 2)
+
+        self.assertTrue(self.pending.add("a@example.org", now=70))
+        self.assertEqual(len(self.pending), 1)
+
+    def test_force(self):
+        """ a forced add must be counted, so that the address stays pending until each add is finished """
+
+        self.pending = context.PendingAddresses()
+
+        self.assertTrue(self.pending.add("a@example.org"))
+        self.assertTrue(self.pending.add("a@example.org", force=True))
+
+        self.pending.finish("a@example.org")
+        self.assertFalse(self.pending.add("a@example.org"))
+
+        self.pending.finish("a@example.org")
+        self.assertTrue(self.pending.add("a@example.org"))
+
+    def test_discard(self):
+        """ a discarded address must not be pending and must not be kept for the window """
+
+        self.assertTrue(self.pending.add("a@example.org", now=0))
+        self.pending.discard("a@example.org")
+
+        self.assertEqual(len(self.pending), 0)
+        self.assertTrue(self.pending.add("a@example.org", now=1))
+
+    def test_newer_timestamp(self):
+        """ an address must not be coalesced with pending ones if its timestamp is newer """
+
+        self.pending = context.PendingAddresses()
+
+        self.assertTrue(self.pending.add("a@example.org", timestamp=100))
+        self.assertFalse(self.pending.add("a@example.org", timestamp=100))
+        self.assertFalse(self.pending.add("a@example.org", timestamp=50))
+        self.assertTrue(self.pending.add("a@example.org", timestamp=150))
+        self.assertFalse(self.pending.add("a@example.org", timestamp=120))
+
+    def test_metric(self):
+        """ coalesced addresses must be counted by the coalesced_total metric """
+
+        self.pending = context.PendingAddresses(name="test")
+
+        self.pending.add("a@example.org")
+        self.pending.add("a@example.org")
+        self.pending.add("a@example.org")
+
+        self.assertIn('coalesced_total{queue="test"} 2', context.addresses_coalesced.render())
+
+class Coalescing(ContextTestCase):
+    def test_submit_address(self):
+        """ duplicate submissions must be accepted, but queued once """
+
+        self.assertTrue(self.context.submit_address("a@example.org"))
+        self.assertTrue(self.context.submit_address("a@example.org"))
+
+        self.assertEqual(self.context.submission_queue.qsize(), 1)
+        self.assertEqual(self.context.pending_submissions.coalesced, 1)
+
+        self.context.submission_queue.get_nowait()
+        self.context.submission_queue.task_done()
+
+    def test_process_state(self):
+        """ claims for an address must be coalesced unless they carry a newer state """
+
+        state = self.states[0]
+        newer = dump.generate_states(1, private_key_block, self.timestamp + 3600, seed=1).next()
+        self.assertEqual(newer.address, state.address)
+
+        self.assertTrue(self.context.process_state(state, "first", self.timestamp))
+        self.assertTrue(self.context.process_state(state, "second", self.timestamp))
+        self.assertEqual(self.context.validation_queue.qsize(), 1)
+
+        self.assertTrue(self.context.process_state(newer, "second", self.timestamp))
+        self.assertEqual(self.context.validation_queue.qsize(), 2)
+
+        for i in xrange(2):
+            claim = self.context.validation_queue.get_nowait()
+            self.context.pending_claims.finish(claim.state.address)
+            self.context.validation_queue.task_done()
+
+    def test_process_address(self):
+        """ addresses received without responsibility must be coalesced with pending submissions """
+
+        state = context.StateRecord(self.states[0].address, None, None)
+
+        self.context.submit_address(state.address)
+        self.assertTrue(self.context.process_state(state, "partner", self.timestamp))
+        self.assertEqual(self.context.submission_queue.qsize(), 1)
+
+        self.context.submission_queue.get_nowait()
+        self.context.submission_queue.task_done()
+
+class FailingPool:
+    def map(self, function, arguments):
+        raise Exception("pool failed")
+
+class SignaturePool:
+    """ Checks the states in this thread without the verification cache, like the processes
+        of a validation pool, and records the arguments. """
+
+    def __init__(self):
+        self.arguments = []
+
+    def map(self, function, arguments):
+        self.arguments.append(arguments)
+
+        cache = signature.verification_cache
+        signature.disable_verification_cache()
+        try:
+            return map(function, arguments)
+        finally:
+            signature.verification_cache = cache
+
+class ValidationBatchWorker(ContextTestCase):
+    def test_failing_pool(self):
+        """ if the pool fails, the claims must be checked in the worker thread and finished """
+
+        context_logger = self.context.logger
+        context_logger.disabled = True
+        self.addCleanup(setattr, context_logger, "disabled", False)
+
+        for state in self.states:
+            self.context.pending_claims.add(state.address, force=True)
+            self.context.validation_queue.put(context.Claim(state))
+        self.context.validation_queue.put(None)
+
+        worker = threading.Thread(target=self.context.validation_batch_worker, args=(FailingPool(), 3))
+        worker.start()
+        worker.join(10)
+
+        self.assertFalse(worker.is_alive())
+        self.context.validation_queue.join()
+
+        validated = []
+        while not self.context.assimilation_queue.empty():
+            validated.append(self.context.assimilation_queue.get_nowait().address)
+            self.context.assimilation_queue.task_done()
+
+        self.assertEqual(sorted(validated), sorted(state.address for state in self.states))
+        self.assertEqual(len(self.context.pending_claims), 0)
+
+    def test_signature_cache(self):
+        """ the signatures checked in the pool must be cached in this process and not be checked again """
+
+        signature.verification_cache.clear()
+        pool = SignaturePool()
+
+        for i in xrange(2):
+            claims = [context.Claim(state) for state in self.states]
+            for claim in claims:
+                self.context.pending_claims.add(claim.state.address, force=True)
+
+            self.context._validate_batch(pool, claims)
+
+            validated = []
+            while not self.context.assimilation_queue.empty():
+                validated.append(self.context.assimilation_queue.get_nowait())
+                self.context.assimilation_queue.task_done()
+            self.assertEqual(len(validated), len(self.states))
+
+        self.assertEqual([signature_checked for data, timestamp, signature_checked in pool.arguments[0]], [False]*len(self.states))
+        self.assertEqual([signature_checked for data, timestamp, signature_checked in pool.arguments[1]], [True]*len(self.states))
+        self.assertEqual(len(signature.verification_cache), len(self.states))
+
+class ControlSample(ContextTestCase):
+    def setUp(self):
+        ContextTestCase.setUp(self)
+
+        # take a control sample of every claim
+        partner = Partner("partner", "secret", "http://partner.example.org/", 1.0)
+        self.partnerdb.save_partner(partner)
+
+    def take_claim(self):
+        claim = self.context.validation_queue.get()
+        self.context.validation_queue.task_done()
+        return claim
+
+    def test_deferred(self):
+        """ the control sample of a claim must be retrieved through the submission queue """
+
+        state = self.states[0]
+
+        self.context.defer_control_samples(True)
+        self.context.process_state(state, "partner", self.timestamp)
+
+        claim = self.take_claim()
+        prepared = claim.prepare(self.partnerdb, self.logger, self.context._defer_control_sample)
+        self.assertIs(prepared, context.CONTROL_SAMPLE_DEFERRED)
+
+        submission = self.context.submission_queue.get_nowait()
+        self.context.submission_queue.task_done()
+        self.assertEqual(submission.webfinger_address, state.address)
+        self.assertIs(submission.claim, claim)
+
+        # the state was retrieved by the submission worker
+        claim.retrieved_state = state
+        trusted_state, partner_name = claim.prepare(self.partnerdb, self.logger, self.context._defer_control_sample)
+        self.assertEqual(trusted_state, state)
+        self.assertEqual(partner_name, "partner")
+
+        self.context.pending_claims.finish(state.address)
+
+    def test_not_deferred(self):
+        """ control samples must not be queued unless deferring is enabled """
+
+        self.context.defer_control_samples(True)
+        self.context.defer_control_samples(False)
+
+        self.assertFalse(self.context._defer_control_sample(context.Claim(self.states[0], "partner")))
+        self.assertTrue(self.context.submission_queue.empty())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import unittest
+
+import threading, socket, httplib, time
+
+from sduds.lib import asyncwsgi
+
+def application(environment, start_response):
+    if environment["PATH_INFO"]=="/echo":
+        body = environment["wsgi.input"].read(int(environment["CONTENT_LENGTH"] or 0))
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environment["REQUEST_METHOD"], " ", environment["QUERY_STRING"], " ", body]
+
+    elif environment["PATH_INFO"]=="/fail":
+        raise Exception("failure")
+
+    start_response("404 Not Found", [("Content-Type", "text/plain")])
+    return ["not found"]
+
+class AsyncWSGIServer(unittest.TestCase):
+    def start_server(self, application=application, **kwargs):
+        self.server = asyncwsgi.AsyncWSGIServer(("localhost", 0), application, **kwargs)
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+
+        def stop():
+            self.server.shutdown()
+            self.server.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+
+        return self.server.server_port
+
+    def connect(self, port):
+        s = socket.create_connection(("localhost", port))
+        s.settimeout(5)
+        self.addCleanup(s.close)
+        return s
+
+    def receive(self, s):
+        data = ""
+        while True:
+            chunk = s.recv(65536)
+            if not chunk: return data
+            data += chunk
+
+    def test_keep_alive(self):
+        """ several requests must be answered on one connection """
+
+        port = self.start_server()
+
+        connection = httplib.HTTPConnection("localhost", port)
+        self.addCleanup(connection.close)
+
+        for i in xrange(3):
+            connection.request("POST", "/echo?i=%d" % i, "body%d" % i)
+            response = connection.getresponse()
+
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), "POST i=%d body%d" % (i, i))
+
+        # the connection was not replaced
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_pipelining(self):
+        """ pipelined requests must be answered in order """
+
+        port = self.start_server()
+
+        s = self.connect(port)
+        s.sendall("GET /echo?1 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                  "GET /echo?2 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+
+        data = self.receive(s)
+
+        self.assertEqual(data.count("HTTP/1.1 200 OK"), 2)
+        self.assertTrue(data.index("GET 1") < data.index("GET 2"))
+
+    def test_http10_close(self):
+        """ HTTP/1.0 connections must be closed after the response """
+
+        port = self.start_server()
+
+        s = self.connect(port)
+        s.sendall("GET /missing HTTP/1.0\r\n\r\n")
+
+        data = self.receive(s)
+        self.assertTrue(data.startswith("HTTP/1.1 404 Not Found"))
+        self.assertIn("Connection: close", data)
+        self.assertTrue(data.endswith("not found"))
+
+    def test_head(self):
+        """ responses to HEAD requests must have no body """
+
+        port = self.start_server()
+
+        s = self.connect(port)
+        s.sendall("HEAD /echo HTTP/1.0\r\n\r\n")
+
+        data = self.receive(s)
+        self.assertIn("Content-Length: 6", data)
+        self.assertTrue(data.endswith("\r\n\r\n"))
+
+    def test_application_error(self):
+        """ an exception of the application must be answered with 500 """
+
+        port = self.start_server()
+
+        connection = httplib.HTTPConnection("localhost", port)
+        self.addCleanup(connection.close)
+
+        logger = asyncwsgi.logging.getLogger(asyncwsgi.__name__)
+        logger.disabled = True
+        self.addCleanup(setattr, logger, "disabled", False)
+
+        connection.request("GET", "/fail")
+        self.assertEqual(connection.getresponse().status, 500)
+
+    def test_bad_requests(self):
+        """ chunked bodies, large headers and malformed requests must be rejected """
+
+        port = self.start_server(max_header_size=1000)
+
+        for request, status in (("POST /echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n", "411"),
+                                ("GET /echo HTTP/1.1\r\nX-Large: %s\r\n\r\n" % ("x"*2000), "431"),
+                                ("GARBAGE\r\n\r\n", "400")):
+            s = self.connect(port)
+            s.sendall(request)
+
+            self.assertTrue(self.receive(s).startswith("HTTP/1.1 %s" % status))
+
+    def test_request_timeout(self):
+        """ a request which is not completed in time must be answered with 408 """
+
+        port = self.start_server(request_timeout=0.5)
+
+        s = self.connect(port)
+        s.sendall("GET /echo HTTP/1.1\r\n")
+
+        self.assertTrue(self.receive(s).startswith("HTTP/1.1 408"))
+
+    def test_keepalive_timeout(self):
+        """ idle connections must be closed """
+
+        port = self.start_server(keepalive_timeout=0.5)
+
+        s = self.connect(port)
+        self.assertEqual(self.receive(s), "")
+
+    def test_backpressure(self):
+        """ requests must be answered with 503 if too many are waiting for a worker """
+
+        release = threading.Event()
+
+        def blocking_application(environment, start_response):
+            release.wait()
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return ["done"]
+
+        port = self.start_server(blocking_application, workers=1, max_pending=1)
+
+        # the first request occupies the worker, the second one waits for it
+        sockets = []
+        for i in xrange(2):
+            s = self.connect(port)
+            s.sendall("GET / HTTP/1.0\r\n\r\n")
+            sockets.append(s)
+            time.sleep(0.2)
+
+        s = self.connect(port)
+        s.sendall("GET / HTTP/1.0\r\n\r\n")
+        self.assertTrue(self.receive(s).startswith("HTTP/1.1 503"))
+
+        release.set()
+
+        for s in sockets:
+            self.assertTrue(self.receive(s).endswith("done"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,15 +15,21 @@ class RequestHandler(authentication.AuthenticatingRequestHandler):
             return None
 
     def handle_user(self, username):
-        """ saves all accepted users """
+        """ saves all accepted users and the extensions they agreed to """
         self.server.successfully_authenticated.add(username)
+        self.server.agreed_extensions = self.agreed_extensions
         self.request.close()
 
+class ExtendedRequestHandler(RequestHandler):
+    extensions = ("ext1", "ext2")
+
 class Authentication(unittest.TestCase):
+    request_handler = RequestHandler
+
     def setUp(self):
         # set up server
         # http://stackoverflow.com/questions/1365265/on-localhost-how-to-pick-a-free-port-number
-        self.server = Server(("", 0), RequestHandler)
+        self.server = Server(("", 0), self.request_handler)
         self.server.successfully_authenticated = set()
 
         server_thread = threading.Thread(target=self.server.serve_forever)
@@ -73,5 +79,38 @@ class Authentication(unittest.TestCase):
         expected = set()
         self.assertEqual(expected, self.server.successfully_authenticated)
 
+    def test_no_extensions(self):
+        """ a server without extensions must accept clients which support some """
+
+        success, extensions = authentication.authenticate_socket_with_extensions(self.sock, "user1", "1234", ["ext1"])
+        self.assertTrue(success)
+        self.assertEqual(extensions, frozenset())
+
+        assert self.sock.recv(1)==""
+        self.assertEqual(self.server.agreed_extensions, frozenset())
+
+class Extensions(Authentication):
+    request_handler = ExtendedRequestHandler
+
+    def test_agreed(self):
+        """ only the extensions both sides support must be agreed on """
+
+        success, extensions = authentication.authenticate_socket_with_extensions(self.sock, "user1", "1234", ["ext2", "ext3"])
+        self.assertTrue(success)
+        self.assertEqual(extensions, frozenset(["ext2"]))
+
+        assert self.sock.recv(1)==""
+        self.assertEqual(self.server.successfully_authenticated, set(["user1"]))
+        self.assertEqual(self.server.agreed_extensions, frozenset(["ext2"]))
+
+    def test_no_extensions(self):
+        """ clients which do not know about extensions must still be accepted """
+
+        success = authentication.authenticate_socket(self.sock, "user1", "1234")
+        self.assertTrue(success)
+
+        assert self.sock.recv(1)==""
+        self.assertEqual(self.server.agreed_extensions, frozenset())
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+
+import threading, BaseHTTPServer, SocketServer
+import time, socket
+
+from sduds.lib import connectionpool
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args): pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def send_body(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path=="/document":
+            self.send_body(200, "document")
+        elif self.path=="/redirect":
+            self.send_body(302, "", {"Location": "/document"})
+        else:
+            self.send_body(404, "not found")
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ConnectionPool(unittest.TestCase):
+    def setUp(self):
+        # start a web server
+        address = ("localhost", 0)
+        httpd = ThreadingHTTPServer(address, RequestHandler)
+        httpd.connections = 0
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+
+        self.addCleanup(thread.join)
+        self.addCleanup(httpd.socket.close)
+        self.addCleanup(httpd.shutdown)
+
+        host, port = httpd.socket.getsockname()
+        self.base_url = "http://%s:%d" % (host, port)
+        self.httpd = httpd
+
+        self.pool = connectionpool.ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def test_request(self):
+        """ request() must return the response body and status """
+
+        response = self.pool.request(self.base_url+"/document")
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, "document")
+        self.assertEqual(response.headers["content-length"], "8")
+
+    def test_reuse(self):
+        """ subsequent requests to the same host must use the same connection """
+
+        for i in xrange(5):
+            response = self.pool.request(self.base_url+"/document")
+            self.assertEqual(response.body, "document")
+
+        self.assertEqual(self.httpd.connections, 1)
+
+    def test_redirect(self):
+        """ request() must follow redirects """
+
+        response = self.pool.request(self.base_url+"/redirect")
+
+        self.assertEqual(response.body, "document")
+        self.assertEqual(response.url, self.base_url+"/document")
+
+    def test_http_error(self):
+        """ request() must raise HTTPError, which is an IOError, for status codes >= 400 """
+
+        with self.assertRaises(connectionpool.HTTPError) as cm:
+            self.pool.request(self.base_url+"/nonexistant")
+
+        self.assertEqual(cm.exception.status, 404)
+        self.assertIsInstance(cm.exception, IOError)
+
+    def test_idle_timeout(self):
+        """ connections must not be reused after the idle timeout """
+
+        self.pool.idle_timeout = 0.01
+
+        self.pool.request(self.base_url+"/document")
+        time.sleep(0.05)
+        self.pool.request(self.base_url+"/document")
+
+        self.assertEqual(self.httpd.connections, 2)
+
+    def test_bounded(self):
+        """ the number of idle connections must not exceed max_idle_per_host """
+
+        self.pool.max_idle_per_host = 1
+
+        # acquire two connections for the same host and give both back
+        key = ("http", "localhost", self.httpd.socket.getsockname()[1])
+        first, reused = self.pool._acquire(key, None)
+        second, reused = self.pool._acquire(key, None)
+
+        self.pool._release(key, first)
+        self.pool._release(key, second)
+
+        self.assertEqual(self.pool.idle_count, 1)
+
+    def test_closed_by_server(self):
+        """ request() must reconnect if the server closed an idle connection """
+
+        self.pool.request(self.base_url+"/document")
+
+        # close the idle connection on the client side, simulating a server that closed it
+        for connections in self.pool.idle_connections.itervalues():
+            for connection, last_used in connections:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+
+        response = self.pool.request(self.base_url+"/document")
+        self.assertEqual(response.body, "document")
+
+if __name__ == '__main__':
+    unittest.main()
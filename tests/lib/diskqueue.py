@@ -0,0 +1,154 @@
+import unittest
+
+import threading
+import Queue
+import os, tempfile, shutil
+
+from sduds.lib import diskqueue
+
+class DiskQueue(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "queues.sqlite")
+
+    def open_queue(self, memory_size=3, priority_function=None):
+        journal = diskqueue.Journal(self.path, "items")
+        queue = diskqueue.DiskQueue(journal, memory_size, priority_function)
+        self.addCleanup(queue.close)
+        return queue
+
+    def test_fifo(self):
+        """ without priority function, items must be handed out in the order they were put """
+
+        queue = self.open_queue()
+
+        for i in xrange(10):
+            queue.put(i)
+
+        # only a part of the items is kept in memory
+        self.assertEqual(len(queue.window), 3)
+        self.assertEqual(queue.qsize(), 10)
+
+        items = [queue.get_nowait() for i in xrange(10)]
+        self.assertEqual(items, range(10))
+
+        with self.assertRaises(Queue.Empty):
+            queue.get_nowait()
+
+    def test_priority(self):
+        """ items must be handed out by priority, also if they were spilled to disk """
+
+        queue = self.open_queue(priority_function=lambda item: item[0])
+
+        items = [(5, "a"), (3, "b"), (9, "c"), (1, "d"), (7, "e"), (3, "f"), (0, "g")]
+        for item in items:
+            queue.put(item)
+
+        first = queue.get_nowait()
+
+        # put items while part of the queue is on disk
+        queue.put((2, "h"))
+        queue.put((10, "i"))
+
+        rest = [queue.get_nowait() for i in xrange(len(items)+1)]
+
+        self.assertEqual(first, (0, "g"))
+        self.assertEqual(rest, [(1, "d"), (2, "h"), (3, "b"), (3, "f"), (5, "a"), (7, "e"), (9, "c"), (10, "i")])
+
+    def test_priority_window(self):
+        """ items with a high priority must not grow the window beyond memory_size """
+
+        queue = self.open_queue(priority_function=lambda item: item)
+
+        for item in [10, 20, 30, 40]:
+            queue.put(item)
+
+        for item in [5, 4, 3, 2, 1]:
+            queue.put(item)
+            self.assertLessEqual(len(queue.window), 3)
+
+        items = [queue.get_nowait() for i in xrange(9)]
+        self.assertEqual(items, [1, 2, 3, 4, 5, 10, 20, 30, 40])
+
+    def test_priority_handed_out(self):
+        """ items which were handed out must not be handed out again after the window was lowered """
+
+        queue = self.open_queue(memory_size=2, priority_function=lambda item: item)
+
+        queue.put(5)
+        queue.put(6)
+        self.assertEqual([queue.get_nowait(), queue.get_nowait()], [5, 6])
+
+        for item in [1, 2, 3]:
+            queue.put(item)
+
+        items = [queue.get_nowait() for i in xrange(3)]
+        self.assertEqual(items, [1, 2, 3])
+
+        with self.assertRaises(Queue.Empty):
+            queue.get_nowait()
+        self.assertEqual(queue.qsize(), 0)
+
+        for i in xrange(5):
+            queue.task_done()
+        self.assertEqual(queue.journal.count(), 0)
+
+    def test_restart(self):
+        """ items for which task_done was not called must be handed out again after reopening """
+
+        queue = self.open_queue()
+
+        for i in xrange(5):
+            queue.put(i)
+
+        self.assertEqual(queue.get(), 0)
+        queue.task_done()
+        self.assertEqual(queue.get(), 1)
+        queue.close()
+
+        queue = self.open_queue()
+
+        self.assertEqual(queue.qsize(), 4)
+        self.assertEqual(queue.unfinished_tasks, 4)
+
+        items = [queue.get_nowait() for i in xrange(4)]
+        self.assertEqual(items, [1, 2, 3, 4])
+
+    def test_terminator(self):
+        """ None must be handed out first and must not be written to the journal """
+
+        queue = self.open_queue()
+
+        queue.put(1)
+        queue.put(None)
+
+        self.assertEqual(queue.get(), None)
+        queue.task_done()
+        self.assertEqual(queue.journal.count(), 1)
+
+    def test_join(self):
+        """ join must return after task_done was called for all items, which removes them from the journal """
+
+        queue = self.open_queue()
+
+        def worker():
+            while True:
+                item = queue.get()
+                queue.task_done()
+                if item is None: return
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+
+        for i in xrange(10):
+            queue.put(i)
+
+        queue.join()
+        queue.put(None)
+        thread.join()
+
+        self.assertEqual(queue.journal.count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
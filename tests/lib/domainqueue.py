@@ -0,0 +1,218 @@
+import unittest
+
+import threading, time
+import Queue
+import os, tempfile, shutil
+
+from sduds.lib import domainqueue, diskqueue
+
+def get_domain(address):
+    return address.rsplit("@", 1)[-1]
+
+class RateLimiter(unittest.TestCase):
+    def test_burst(self):
+        """ try_acquire must succeed burst times and then fail until tokens are refilled """
+
+        limiter = domainqueue.RateLimiter(1.0, 3)
+        now = 1000000000
+
+        for i in xrange(3):
+            self.assertTrue(limiter.try_acquire("example.org", now))
+
+        self.assertFalse(limiter.try_acquire("example.org", now))
+        self.assertEqual(limiter.delay("example.org", now), 1.0)
+
+        # other domains are not affected
+        self.assertTrue(limiter.try_acquire("example.com", now))
+
+        # one token is refilled after one second
+        self.assertTrue(limiter.try_acquire("example.org", now+1))
+        self.assertFalse(limiter.try_acquire("example.org", now+1))
+
+class DomainQueue(unittest.TestCase):
+    def test_round_robin(self):
+        """ items of different domains must be handed out alternately """
+
+        limiter = domainqueue.RateLimiter(1000, 1000)
+        queue = domainqueue.DomainQueue(get_domain, limiter)
+
+        for i in xrange(3):
+            queue.put("user%d@a.org" % i)
+        for i in xrange(3):
+            queue.put("user%d@b.org" % i)
+
+        self.assertEqual(queue.backlog(), {"a.org":3, "b.org":3})
+
+        domains = [get_domain(queue.get()) for i in xrange(6)]
+        self.assertEqual(domains, ["a.org", "b.org"]*3)
+
+    def test_rate_limit(self):
+        """ items of a throttled domain must not hold up other domains """
+
+        limiter = domainqueue.RateLimiter(0.001, 1)
+        queue = domainqueue.DomainQueue(get_domain, limiter)
+
+        queue.put("user1@a.org")
+        queue.put("user2@a.org")
+        queue.put("user1@b.org")
+
+        self.assertEqual(queue.get_nowait(), "user1@a.org")
+        self.assertEqual(queue.get_nowait(), "user1@b.org")
+
+        # a.org has no token left
+        with self.assertRaises(Queue.Empty):
+            queue.get_nowait()
+
+        with self.assertRaises(Queue.Empty):
+            queue.get(timeout=0.01)
+
+        self.assertEqual(queue.backlog(), {"a.org":1})
+
+    def test_terminator(self):
+        """ None must only be handed out after all other items """
+
+        limiter = domainqueue.RateLimiter(1000, 1000)
+        queue = domainqueue.DomainQueue(get_domain, limiter)
+
+        queue.put("user@a.org")
+        queue.put(None)
+        queue.put("user@b.org")
+
+        items = [queue.get() for i in xrange(3)]
+        self.assertEqual(items, ["user@a.org", "user@b.org", None])
+
+    def test_full(self):
+        """ put_nowait must raise Queue.Full if maxsize is reached """
+
+        limiter = domainqueue.RateLimiter(1000, 1000)
+        queue = domainqueue.DomainQueue(get_domain, limiter, 1)
+
+        queue.put("user@a.org")
+        with self.assertRaises(Queue.Full):
+            queue.put_nowait("user@b.org")
+
+    def test_join(self):
+        """ join must return after task_done was called for all items """
+
+        limiter = domainqueue.RateLimiter(1000, 1000)
+        queue = domainqueue.DomainQueue(get_domain, limiter)
+
+        def worker():
+            while True:
+                item = queue.get()
+                queue.task_done()
+                if item is None: return
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+
+        for i in xrange(10):
+            queue.put("user%d@a.org" % i)
+        queue.put(None)
+
+        queue.join()
+        thread.join()
+
+        self.assertEqual(queue.qsize(), 0)
+
+    def test_journal(self):
+        """ unfinished items must be queued again by a new queue using the same journal """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "queues.sqlite")
+
+        limiter = domainqueue.RateLimiter(1000, 1000)
+        queue = domainqueue.DomainQueue(get_domain, limiter, journal=diskqueue.Journal(path, "submissions"))
+
+        queue.put("user1@a.org")
+        queue.put("user2@a.org")
+        queue.put("user1@b.org")
+
+        # finish one item, take another one without finishing it
+        queue.get()
+        queue.task_done()
+        queue.get()
+        queue.close()
+
+        queue = domainqueue.DomainQueue(get_domain, limiter, journal=diskqueue.Journal(path, "submissions"))
+        self.addCleanup(queue.close)
+
+        self.assertEqual(queue.backlog(), {"a.org":1, "b.org":1})
+        self.assertEqual(queue.unfinished_tasks, 2)
+
+    def test_journal_window(self):
+        """ with a journal, only memory_size items must be kept in memory, and the others
+            must be handed out round-robin in the order they were put """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "queues.sqlite")
+
+        limiter = domainqueue.RateLimiter(1000, 1000)
+        queue = domainqueue.DomainQueue(get_domain, limiter, journal=diskqueue.Journal(path, "submissions"), memory_size=3)
+
+        for i in xrange(5):
+            queue.put("user%d@a.org" % i)
+        for i in xrange(3):
+            queue.put("user%d@b.org" % i)
+
+        self.assertEqual(queue.in_memory, 3)
+        self.assertEqual(queue.qsize(), 8)
+        self.assertEqual(queue.backlog(), {"a.org":5, "b.org":3})
+
+        items = []
+        for i in xrange(8):
+            items.append(queue.get_nowait())
+            queue.task_done()
+            self.assertLessEqual(queue.in_memory, 3)
+
+        self.assertEqual([item for item in items if item.endswith("a.org")], ["user%d@a.org" % i for i in xrange(5)])
+        self.assertEqual([item for item in items if item.endswith("b.org")], ["user%d@b.org" % i for i in xrange(3)])
+        self.assertEqual(items[:4], ["user0@a.org", "user0@b.org", "user1@a.org", "user1@b.org"])
+
+        # the window is refilled when it was emptied, also after some items were spilled
+        for i in xrange(5):
+            queue.put("user%d@c.org" % i)
+        self.assertEqual(queue.get_nowait(), "user0@c.org")
+        queue.task_done()
+
+        queue.put("user5@c.org")
+        items = [queue.get_nowait() for i in xrange(5)]
+        self.assertEqual(items, ["user%d@c.org" % i for i in xrange(1, 6)])
+
+        with self.assertRaises(Queue.Empty):
+            queue.get_nowait()
+
+        queue.close()
+
+    def test_journal_missing(self):
+        """ no token must be used up for a domain whose items are missing in the journal """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "queues.sqlite")
+
+        limiter = domainqueue.RateLimiter(1000, 1000)
+        journal = diskqueue.Journal(path, "submissions")
+        queue = domainqueue.DomainQueue(get_domain, limiter, journal=journal, memory_size=1)
+        self.addCleanup(queue.close)
+
+        queue.put("user0@a.org")
+        queue.put("user0@b.org")
+
+        # the second item was spilled to the journal
+        self.assertEqual(queue.in_memory, 1)
+        journal.remove(2)
+
+        self.assertEqual(queue.get_nowait(), "user0@a.org")
+        queue.task_done()
+
+        with self.assertRaises(Queue.Empty):
+            queue.get_nowait()
+
+        self.assertEqual(queue.qsize(), 0)
+        self.assertNotIn("b.org", limiter.buckets)
+
+if __name__ == '__main__':
+    unittest.main()
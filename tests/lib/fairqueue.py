@@ -0,0 +1,207 @@
+import unittest
+
+import Queue
+import os, tempfile, shutil
+
+from sduds.lib import fairqueue, diskqueue
+
+def get_source(item):
+    return item[0]
+
+def get_weight(source):
+    if source is None:
+        return 10
+    else:
+        return 1
+
+class FairQueue(unittest.TestCase):
+    def test_weights(self):
+        """ sources must be served in proportion to their weights """
+
+        queue = fairqueue.FairQueue(get_source, get_weight)
+
+        for i in xrange(100):
+            queue.put(("partner", i))
+            queue.put((None, i))
+
+        sources = [get_source(queue.get_nowait()) for i in xrange(55)]
+
+        self.assertEqual(sources.count(None), 50)
+        self.assertEqual(sources.count("partner"), 5)
+
+    def test_fifo_per_source(self):
+        """ the items of one source must be handed out in the order they were put """
+
+        queue = fairqueue.FairQueue(get_source, get_weight)
+
+        for i in xrange(5):
+            queue.put(("a", i))
+            queue.put(("b", i))
+
+        items = [queue.get_nowait() for i in xrange(10)]
+
+        self.assertEqual([i for source, i in items if source=="a"], range(5))
+        self.assertEqual([i for source, i in items if source=="b"], range(5))
+
+    def test_backlog(self):
+        """ a new source must be served soon even if another source has a large backlog """
+
+        queue = fairqueue.FairQueue(get_source, get_weight)
+
+        for i in xrange(10000):
+            queue.put(("partner1", i))
+
+        for i in xrange(100):
+            queue.get_nowait()
+
+        queue.put(("partner2", 0))
+        queue.put((None, 0))
+
+        sources = [get_source(queue.get_nowait()) for i in xrange(3)]
+        self.assertIn(None, sources)
+        self.assertIn("partner2", sources)
+
+        self.assertEqual(queue.depths(), {"partner1": 9899})
+
+    def test_aging(self):
+        """ a source that was not served for a long time must be preferred """
+
+        queue = fairqueue.FairQueue(get_source, get_weight, aging=1.)
+
+        queue.put(("a", 0))
+        queue.put(("b", 0))
+        queue.put(("b", 1))
+
+        # a has waited longer than b
+        queue.sources["a"].last_served -= 100
+        queue.sources["a"].pass_value += 50
+        queue.heap = []
+        queue._push(queue.sources["a"])
+        queue._push(queue.sources["b"])
+
+        self.assertEqual(queue.get_nowait(), ("a", 0))
+
+    def test_terminator(self):
+        """ without a journal, None must be handed out after all other items """
+
+        queue = fairqueue.FairQueue(get_source, get_weight)
+
+        queue.put(None)
+        queue.put(("a", 0))
+
+        self.assertEqual(queue.get_nowait(), ("a", 0))
+        self.assertEqual(queue.get_nowait(), None)
+
+        with self.assertRaises(Queue.Empty):
+            queue.get_nowait()
+
+    def test_terminator_journal(self):
+        """ with a journal, None must be handed out first """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        queue = fairqueue.FairQueue(get_source, get_weight, journal=diskqueue.Journal(os.path.join(directory, "queues.sqlite"), "claims"))
+        self.addCleanup(queue.close)
+
+        queue.put(("a", 0))
+        queue.put(None)
+
+        self.assertEqual(queue.get_nowait(), None)
+        self.assertEqual(queue.get_nowait(), ("a", 0))
+
+    def test_full(self):
+        """ put_nowait must raise Queue.Full if maxsize is reached """
+
+        queue = fairqueue.FairQueue(get_source, get_weight, maxsize=1)
+
+        queue.put(("a", 0))
+        with self.assertRaises(Queue.Full):
+            queue.put_nowait(("b", 0))
+
+    def test_journal(self):
+        """ with a journal, items must be spilled to disk and survive reopening """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "queues.sqlite")
+
+        queue = fairqueue.FairQueue(get_source, get_weight, journal=diskqueue.Journal(path, "claims"), memory_size=2)
+
+        for i in xrange(5):
+            queue.put(("a", i))
+            queue.put(("b", i))
+
+        # the memory size bounds the items of all sources together
+        self.assertEqual(queue.in_memory, 2)
+        self.assertEqual(len(queue.sources["a"].items), 1)
+
+        items = [queue.get_nowait() for i in xrange(6)]
+        self.assertEqual(len(set(items)), 6)
+
+        # the last item is not finished
+        for i in xrange(5):
+            queue.task_done()
+        queue.close()
+
+        queue = fairqueue.FairQueue(get_source, get_weight, journal=diskqueue.Journal(path, "claims"), memory_size=2)
+        self.addCleanup(queue.close)
+
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual(sum(queue.depths().values()), 5)
+
+        remaining = [queue.get_nowait() for i in xrange(5)]
+        self.assertIn(items[5], remaining)
+
+        expected = set((source, i) for source in ("a", "b") for i in xrange(5)) - set(items[:5])
+        self.assertEqual(set(remaining), expected)
+
+    def test_journal_window(self):
+        """ with a journal, at most memory_size items of all sources must be kept in memory """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        queue = fairqueue.FairQueue(get_source, get_weight, journal=diskqueue.Journal(os.path.join(directory, "queues.sqlite"), "claims"), memory_size=3)
+        self.addCleanup(queue.close)
+
+        for source in "abcde":
+            for i in xrange(3):
+                queue.put((source, i))
+
+        self.assertEqual(queue.in_memory, 3)
+
+        items = []
+        for i in xrange(15):
+            items.append(queue.get_nowait())
+            queue.task_done()
+            self.assertLessEqual(queue.in_memory, 3)
+
+        for source in "abcde":
+            self.assertEqual([item for item in items if item[0]==source], [(source, i) for i in xrange(3)])
+
+    def test_journal_missing(self):
+        """ a source whose items are missing in the journal must be forgotten """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        journal = diskqueue.Journal(os.path.join(directory, "queues.sqlite"), "claims")
+        queue = fairqueue.FairQueue(get_source, get_weight, journal=journal, memory_size=1)
+        self.addCleanup(queue.close)
+
+        queue.put(("a", 0))
+        queue.put(("b", 0))
+
+        # the second item was spilled to the journal
+        journal.remove(2)
+
+        self.assertEqual(queue.get_nowait(), ("a", 0))
+        with self.assertRaises(Queue.Empty):
+            queue.get_nowait()
+
+        self.assertEqual(queue.depths(), {})
+        self.assertEqual(queue.qsize(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import threading, time
+
+from sduds.lib import instrumentedlock
+from sduds.lib.instrumentedlock import InstrumentedLock
+
+class Instrumentation(unittest.TestCase):
+    def setUp(self):
+        self.lock = InstrumentedLock("test")
+
+    def tearDown(self):
+        instrumentedlock.disable()
+
+    def test_disabled(self):
+        """ while the instrumentation is disabled, nothing must be recorded """
+
+        with self.lock:
+            self.assertTrue(self.lock.locked())
+
+        self.assertFalse(self.lock.locked())
+        self.assertEqual(self.lock.top_holders(), [])
+
+    def test_holders(self):
+        """ the holding time must be added up per call site, longest first """
+
+        instrumentedlock.enable()
+
+        for i in xrange(2):
+            with self.lock:
+                time.sleep(0.01)
+
+        self.lock.acquire()
+        self.lock.release()
+
+        holders = self.lock.top_holders()
+        self.assertEqual(len(holders), 2)
+
+        (filename, line, function), count, seconds = holders[0]
+        self.assertEqual(function, "test_holders")
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(seconds, 0.02)
+
+        self.assertEqual(holders[1][1], 1)
+        self.assertEqual(len(self.lock.top_holders(1)), 1)
+
+        self.lock.reset()
+        self.assertEqual(self.lock.top_holders(), [])
+
+    def test_switch_while_held(self):
+        """ a lock acquired before enabling the instrumentation must not be measured """
+
+        self.lock.acquire()
+        instrumentedlock.enable()
+        self.lock.release()
+
+        self.assertEqual(self.lock.top_holders(), [])
+
+    def test_exclusion(self):
+        """ the lock must still exclude other threads """
+
+        instrumentedlock.enable()
+
+        self.assertTrue(self.lock.acquire(False))
+        self.assertFalse(self.lock.acquire(False))
+
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(self.lock.acquire(False)))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(acquired, [False])
+
+        self.lock.release()
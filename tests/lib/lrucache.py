@@ -0,0 +1,73 @@
+import unittest
+
+from sduds.lib import lrucache
+
+class LRUCache(unittest.TestCase):
+    def test_get_set(self):
+        """ get() must return stored values and the default for absent keys """
+
+        cache = lrucache.LRUCache(10)
+        cache.set("key", "value")
+
+        self.assertEqual(cache.get("key"), "value")
+        self.assertEqual(cache.get("other"), None)
+        self.assertEqual(cache.get("other", "default"), "default")
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+    def test_eviction(self):
+        """ the least recently used entry must be evicted if the cache is full """
+
+        cache = lrucache.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # use a, so that b is the least recently used entry
+        cache.get("a")
+
+        cache.set("c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_expiry(self):
+        """ expired entries must be treated as absent """
+
+        reference_timestamp = 1000000000
+
+        cache = lrucache.LRUCache(10)
+        cache.set("key", "value", reference_timestamp+10)
+
+        self.assertEqual(cache.get("key", reference_timestamp=reference_timestamp+9), "value")
+        self.assertEqual(cache.get("key", reference_timestamp=reference_timestamp+10), None)
+
+    def test_delete_clear(self):
+        """ deleted entries must be gone """
+
+        cache = lrucache.LRUCache(10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        cache.delete("a")
+        cache.delete("nonexistant")
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), 2)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_keys(self):
+        """ the keys must be returned least recently used first """
+
+        cache = lrucache.LRUCache(10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+
+        self.assertEqual(cache.keys(), ["b", "a"])
+
+if __name__ == '__main__':
+    unittest.main()
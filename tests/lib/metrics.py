@@ -0,0 +1,75 @@
+import unittest
+
+from sduds.lib import metrics
+
+class Registry(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry("test_")
+
+    def test_counter(self):
+        """ counters must be rendered with help, type and one sample per label value """
+
+        counter = self.registry.counter("events_total", "Number of events.", ["kind"])
+        counter.inc("a")
+        counter.inc("a")
+        counter.add(3, "b")
+
+        self.assertEqual(counter.get("a"), 2)
+        self.assertEqual(self.registry.render(),
+            '# HELP test_events_total Number of events.\n'
+            '# TYPE test_events_total counter\n'
+            'test_events_total{kind="a"} 2\n'
+            'test_events_total{kind="b"} 3\n')
+
+    def test_same_metric(self):
+        """ creating a metric twice must return the same instance, or fail for a different type """
+
+        counter = self.registry.counter("events_total", "Number of events.")
+        self.assertIs(self.registry.counter("events_total", "Number of events."), counter)
+
+        with self.assertRaises(ValueError):
+            self.registry.gauge("events_total", "Number of events.")
+
+    def test_labels(self):
+        """ label values must be escaped, and the number of labels must match """
+
+        gauge = self.registry.gauge("depth", "Depth.", ["queue"])
+        gauge.set(1.5, 'a "quoted"\nname')
+
+        self.assertIn('test_depth{queue="a \\"quoted\\"\\nname"} 1.5\n', self.registry.render())
+
+        with self.assertRaises(ValueError):
+            gauge.set(1)
+
+    def test_histogram(self):
+        """ histogram buckets must be cumulative and include +Inf, sum and count """
+
+        histogram = self.registry.histogram("duration_seconds", "Duration.", buckets=[1, 10])
+        histogram.observe(0.5)
+        histogram.observe(5)
+        histogram.observe(50)
+
+        lines = self.registry.render().splitlines()[2:]
+        self.assertEqual(lines, [
+            'test_duration_seconds_bucket{le="1"} 1',
+            'test_duration_seconds_bucket{le="10"} 2',
+            'test_duration_seconds_bucket{le="+Inf"} 3',
+            'test_duration_seconds_sum 55.5',
+            'test_duration_seconds_count 3'])
+
+    def test_collector(self):
+        """ collectors must be called before rendering """
+
+        gauge = self.registry.gauge("size", "Size.")
+
+        def collector():
+            gauge.set(42)
+
+        self.registry.add_collector(collector)
+        self.assertIn("test_size 42\n", self.registry.render())
+
+        self.registry.remove_collector(collector)
+        self.assertEqual(self.registry.collectors, [])
+
+if __name__ == '__main__':
+    unittest.main()
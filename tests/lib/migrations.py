@@ -0,0 +1,93 @@
+import unittest
+
+import sqlalchemy
+
+from sduds.lib import migrations
+
+metadata = sqlalchemy.MetaData()
+
+example_table = sqlalchemy.Table("examples", metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("timestamp", sqlalchemy.Integer, index=True)
+)
+
+class Upgrade(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite://")
+        self.applied = []
+
+        def add_timestamp_index(connection):
+            self.applied.append("add_timestamp_index")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_examples_timestamp ON examples (timestamp)")
+
+        def add_row(connection):
+            self.applied.append("add_row")
+            connection.execute(example_table.insert().values(timestamp=1))
+
+        self.migrations = [add_timestamp_index, add_row]
+
+    def get_version(self):
+        connection = self.engine.connect()
+        version = migrations.get_version(connection)
+        connection.close()
+
+        return version
+
+    def test_new_database(self):
+        """ a new database must get the current schema and version without applying migrations """
+
+        applied = migrations.upgrade(self.engine, [metadata], self.migrations)
+
+        self.assertEqual(applied, 0)
+        self.assertEqual(self.applied, [])
+        self.assertEqual(self.get_version(), 2)
+        self.assertTrue(self.engine.has_table("examples"))
+
+    def test_unversioned_database(self):
+        """ all migrations must be applied to a database created before the versioning """
+
+        self.engine.execute("CREATE TABLE examples (id INTEGER NOT NULL, timestamp INTEGER, PRIMARY KEY (id))")
+
+        applied = migrations.upgrade(self.engine, [metadata], self.migrations)
+
+        self.assertEqual(applied, 2)
+        self.assertEqual(self.applied, ["add_timestamp_index", "add_row"])
+        self.assertEqual(self.get_version(), 2)
+
+        indexes = [name for name, in self.engine.execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        self.assertIn("ix_examples_timestamp", indexes)
+
+    def test_pending_migrations(self):
+        """ only the migrations which were not applied must be applied, in order """
+
+        migrations.upgrade(self.engine, [metadata], self.migrations[:1])
+        self.assertEqual(self.get_version(), 1)
+
+        applied = migrations.upgrade(self.engine, [metadata], self.migrations)
+        self.assertEqual(applied, 1)
+        self.assertEqual(self.applied, ["add_row"])
+
+        # nothing left to do
+        applied = migrations.upgrade(self.engine, [metadata], self.migrations)
+        self.assertEqual(applied, 0)
+        self.assertEqual(self.get_version(), 2)
+
+    def test_tables_after_migrations(self):
+        """ missing tables must be created only after the pending migrations were applied """
+
+        # a versioned database where the table is missing
+        connection = self.engine.connect()
+        migrations.set_version(connection, 0)
+        connection.close()
+
+        existing = []
+        def check_table(connection):
+            existing.append(connection.dialect.has_table(connection, "examples"))
+
+        migrations.upgrade(self.engine, [metadata], [check_table])
+
+        self.assertEqual(existing, [False])
+        self.assertTrue(self.engine.has_table("examples"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,52 @@
 import unittest
 
 from sduds.lib import scheduler
-import calendar, time
+import calendar, time, threading, logging
+
+#: Patterns (minute, hour, day of month, month, day of week) compared with the stepping implementation.
+patterns = [
+    ("*", "*", "*", "*", "*"),
+    ("0", "3", "*", "*", "*"),
+    ("0-30/5", "4,5", "3", "*", "*"),
+    ("15", "20", "24", "12", "*"),
+    ("0", "0", "29", "2", "*"),
+    ("0", "0", "13", "*", "5"),
+    ("30", "*/6", "*", "*", "1-5"),
+    ("59", "23", "31", "*", "*"),
+    ("0", "12", "1-7", "*", "0"),
+    ("45", "1", "29", "2", "1"),
+]
+
+def stepping_next_clearance(pattern, last_clearance):
+    """ The former implementation of :meth:`CronPattern.next_clearance`, which steps forward
+        minute by minute, hour by hour or day by day. """
+
+    year,month,dom,hour,minute,second,dow,doy,isdst = time.gmtime(last_clearance)
+
+    stop_year = year + scheduler.MAX_YEARS
+
+    minute += 1
+    year, month, dom, hour, minute, dow = scheduler.normalize(year, month, dom, hour, minute)
+
+    while True:
+        if year>stop_year:
+            raise scheduler.NoMatchingTimestamp
+
+        if month not in pattern.month:
+            month += 1
+            dom, hour, minute = 1, 0, 0
+        elif dom not in pattern.dom or dow not in pattern.dow:
+            dom += 1
+            hour, minute = 0, 0
+        elif hour not in pattern.hour:
+            hour += 1
+            minute = 0
+        elif minute not in pattern.minute:
+            minute += 1
+        else:
+            return calendar.timegm((year,month,dom,hour,minute,0))
+
+        year, month, dom, hour, minute, dow = scheduler.normalize(year, month, dom, hour, minute)
 
 class IntervalPattern(unittest.TestCase):
     def test_clearance(self):
@@ -57,6 +102,23 @@ class CronPattern(unittest.TestCase):
         with self.assertRaises(scheduler.NoMatchingTimestamp):
             next_execution = pattern.next_clearance(last_execution)
 
+    def test_clearance_stepping(self):
+        """ CronPattern.next_clearance must return the same timestamps as the stepping implementation """
+
+        # the end of a leap year, of a month with 30 days and some minute in between
+        starts = [calendar.timegm((2011,12,31, 23,59,30)), calendar.timegm((2012,4,30, 23,59,0)), 1000000000]
+
+        for fields in patterns:
+            pattern = scheduler.CronPattern(*fields)
+
+            for last_execution in starts:
+                for i in xrange(5):
+                    next_execution = pattern.next_clearance(last_execution)
+                    self.assertEqual(next_execution, stepping_next_clearance(pattern, last_execution), fields)
+                    self.assertGreater(next_execution, last_execution)
+
+                    last_execution = next_execution
+
 class Job(unittest.TestCase):
     def test_overdue(self):
         """ Job.overdue must return true if next_clearance <= reference_timestamp """
@@ -94,5 +156,222 @@ class Job(unittest.TestCase):
         overdue = job.overdue(reference_timestamp)
         self.assertFalse(overdue)
 
+class Scheduler(unittest.TestCase):
+    class EveryPattern:
+        def __init__(self, interval):
+            self.interval = interval
+
+        def next_clearance(self, last_execution):
+            return last_execution + self.interval
+
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler(2)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.terminate()
+
+    def test_execution(self):
+        """ Scheduler must execute a new job at once and then following its pattern """
+
+        executions = []
+        def callback():
+            executions.append(time.time())
+            return time.time()
+
+        job = scheduler.Job(self.EveryPattern(0.05), callback)
+        job.start(self.scheduler)
+        time.sleep(0.3)
+        job.terminate()
+
+        self.assertGreaterEqual(len(executions), 3)
+        self.assertIsNotNone(job.last_execution)
+
+    def test_last_execution(self):
+        """ Scheduler must register the time stamps returned by the callback as last executions """
+
+        def callback(): return 42
+        pattern = self.EveryPattern(3600)
+
+        job = scheduler.Job(pattern, callback, (), time.time()-3600)
+        job.start(self.scheduler)
+        time.sleep(0.2)
+
+        self.assertEqual(job.last_execution, 42)
+
+    def test_many_jobs(self):
+        """ Scheduler must execute many jobs with a bounded number of threads """
+
+        threads = threading.active_count()
+
+        lock = threading.Lock()
+        executions = []
+        def callback(i):
+            with lock: executions.append(i)
+            return time.time()
+
+        jobs = [scheduler.Job(self.EveryPattern(3600), callback, (i,)) for i in xrange(100)]
+        for job in jobs: job.start(self.scheduler)
+        time.sleep(0.3)
+
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(sorted(executions), range(100))
+
+    def test_not_concurrent(self):
+        """ Scheduler must not execute a job while its callback is still running """
+
+        lock = threading.Lock()
+        running = [0]
+        overlaps = []
+        def callback():
+            with lock:
+                running[0] += 1
+                overlaps.append(running[0])
+            time.sleep(0.05)
+            with lock: running[0] -= 1
+            return 0
+
+        # always due
+        job = scheduler.Job(self.EveryPattern(0), callback)
+        job.start(self.scheduler)
+        time.sleep(0.3)
+        job.terminate()
+
+        self.assertEqual(max(overlaps), 1)
+
+    def test_priority(self):
+        """ Scheduler must dispatch due jobs with a lower priority first """
+
+        executions = []
+        def callback(name):
+            executions.append(name)
+            return time.time()
+
+        single = scheduler.Scheduler(1)
+        pattern = self.EveryPattern(3600)
+
+        scheduler.Job(pattern, callback, ("late",), 0).start(single)
+        scheduler.Job(pattern, callback, ("early",), 1, priority=-1).start(single)
+
+        single.start()
+        time.sleep(0.2)
+        single.terminate()
+
+        self.assertEqual(executions, ["early", "late"])
+
+    def test_priority_waiting(self):
+        """ Scheduler must dispatch a job with a lower priority before waiting jobs which became due earlier """
+
+        executions = []
+        def callback(name):
+            executions.append(name)
+            if name=="block": time.sleep(0.2)
+            return time.time()
+
+        single = scheduler.Scheduler(1)
+        pattern = self.EveryPattern(3600)
+
+        scheduler.Job(pattern, callback, ("block",), 1, priority=-2).start(single)
+        scheduler.Job(pattern, callback, ("late",), 1).start(single)
+
+        single.start()
+        time.sleep(0.1)
+
+        # becomes due while "late" waits for the worker
+        scheduler.Job(pattern, callback, ("early",), 1, priority=-1).start(single)
+        time.sleep(0.3)
+        single.terminate()
+
+        self.assertEqual(executions, ["block", "early", "late"])
+
+    def test_failing_callback(self):
+        """ Scheduler must keep executing a job whose callback raised an exception """
+
+        executions = []
+        def callback():
+            executions.append(time.time())
+            raise Exception("failure")
+
+        logger = logging.getLogger(scheduler.__name__)
+        logger.disabled = True
+
+        try:
+            job = scheduler.Job(self.EveryPattern(0), callback)
+            job.start(self.scheduler)
+            time.sleep(0.2)
+            job.terminate()
+        finally:
+            logger.disabled = False
+
+        self.assertGreaterEqual(len(executions), 2)
+
+    def test_terminate(self):
+        """ Job.terminate must wait for the running callback and stop the job """
+
+        executions = []
+        def callback():
+            time.sleep(0.1)
+            executions.append(time.time())
+            return time.time()
+
+        job = scheduler.Job(self.EveryPattern(0), callback)
+        job.start(self.scheduler)
+        time.sleep(0.05)
+        job.terminate()
+
+        number = len(executions)
+        self.assertEqual(number, 1)
+
+        time.sleep(0.2)
+        self.assertEqual(len(executions), number)
+
+    def test_remove_dispatched(self):
+        """ Scheduler must not execute a removed job which was due, but waited for a worker """
+
+        blocker = threading.Event()
+        executions = []
+
+        single = scheduler.Scheduler(1)
+        self.addCleanup(single.terminate)
+
+        blocking = scheduler.Job(self.EveryPattern(3600), lambda: blocker.wait(1) or time.time())
+        waiting = scheduler.Job(self.EveryPattern(3600), lambda: executions.append(1) or time.time())
+
+        blocking.start(single)
+        single.start()
+        time.sleep(0.05)
+        waiting.start(single)
+        time.sleep(0.05)
+
+        # the worker is busy, so removing the dispatched job must not block
+        start = time.time()
+        waiting.terminate()
+        self.assertLess(time.time()-start, 0.05)
+
+        blocker.set()
+        time.sleep(0.1)
+
+        self.assertEqual(executions, [])
+
+    def test_terminate_dispatched(self):
+        """ Scheduler.terminate must not execute the jobs which wait for a worker """
+
+        blocker = threading.Event()
+        executions = []
+
+        single = scheduler.Scheduler(1)
+
+        scheduler.Job(self.EveryPattern(3600), lambda: blocker.wait(0.2) or time.time()).start(single)
+        single.start()
+        time.sleep(0.05)
+
+        for i in xrange(5):
+            scheduler.Job(self.EveryPattern(3600), lambda: executions.append(1) or time.time()).start(single)
+        time.sleep(0.05)
+
+        single.terminate()
+
+        self.assertEqual(executions, [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -51,5 +51,27 @@ class Signature(unittest.TestCase):
         valid = signature.signature_valid(public_key_base64, self.signature, invalid_data)
         self.assertFalse(valid)
 
+    def test_cached(self):
+        signature.verification_cache.clear()
+
+        # the second check of each signature must be answered from the cache
+        invalid_data = "000000000000000000000"
+        for i in xrange(2):
+            self.assertTrue(signature.signature_valid(public_key_base64, self.signature, self.data))
+            self.assertFalse(signature.signature_valid(public_key_base64, self.signature, invalid_data))
+
+        self.assertEqual(len(signature.verification_cache), 2)
+        self.assertTrue(signature.verification_cache.hits>=2)
+
+    def test_disabled(self):
+        """ without the verification cache, signatures must be checked and nothing must be cached """
+
+        cache = signature.verification_cache
+        self.addCleanup(setattr, signature, "verification_cache", cache)
+        signature.disable_verification_cache()
+
+        self.assertTrue(signature.signature_valid(public_key_base64, self.signature, self.data))
+        self.assertIsNone(signature.cached_verification(public_key_base64, self.signature, self.data))
+
 if __name__ == '__main__':
     unittest.main()
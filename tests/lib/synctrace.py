@@ -0,0 +1,91 @@
+import unittest
+
+import StringIO
+import os, tempfile, shutil, json
+
+from sduds.lib import synctrace
+
+class Session(unittest.TestCase):
+    def test_phases(self):
+        """ each phase must record its duration, messages and bytes """
+
+        f = synctrace.CountingFile(StringIO.StringIO("abc"))
+        observed = []
+
+        session = synctrace.Session("partner", "client", f, [lambda phase: observed.append(phase.name)])
+
+        with session.phase("receive") as phase:
+            f.read(2)
+            phase.received += 1
+
+        with session.phase("send") as phase:
+            f.write("12345")
+            phase.sent += 2
+
+        self.assertEqual(observed, ["receive", "send"])
+
+        send = session.phases["send"]
+        self.assertEqual((send["sent"], send["received"], send["bytes_sent"], send["bytes_received"]), (2, 0, 5, 0))
+        self.assertGreaterEqual(send["duration"], 0)
+
+        receive = session.phases["receive"]
+        self.assertEqual((receive["sent"], receive["received"], receive["bytes_sent"], receive["bytes_received"]), (0, 1, 0, 2))
+
+        record = session.record()
+        self.assertEqual(record["partner"], "partner")
+        self.assertEqual(record["role"], "client")
+
+class TraceLog(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "synchronizations.jsonl")
+
+    def make_session(self, partner_name, slow_phase):
+        session = synctrace.Session(partner_name, "server")
+        session.missing_hashes = 3
+        session.drops = 1
+
+        for name in ("reconciliation", "send_states"):
+            with session.phase(name):
+                pass
+
+        session.phases[slow_phase]["duration"] += 10
+
+        return session
+
+    def test_write(self):
+        """ sessions must be written as JSON lines and summed up per partner """
+
+        trace_log = synctrace.TraceLog(self.path)
+        self.addCleanup(trace_log.close)
+
+        trace_log.write(self.make_session("a", "reconciliation"))
+        trace_log.write(self.make_session("a", "reconciliation"))
+        trace_log.write(self.make_session("b", "send_states"))
+
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual([record["partner"] for record in records], ["a", "a", "b"])
+
+        summary = trace_log.summary()
+        self.assertEqual(summary, synctrace.summarize(self.path))
+
+        self.assertEqual(summary["a"]["sessions"], 2)
+        self.assertEqual(summary["a"]["missing_hashes"], 6)
+        self.assertEqual(summary["a"]["drops"], 2)
+        self.assertEqual(summary["a"]["dominant_phase"], "reconciliation")
+        self.assertEqual(summary["b"]["dominant_phase"], "send_states")
+
+    def test_rotation(self):
+        """ the log file must be rotated, and the summary must include the rotated files """
+
+        trace_log = synctrace.TraceLog(self.path, max_bytes=500, backup_count=10)
+        self.addCleanup(trace_log.close)
+
+        for i in xrange(10):
+            trace_log.write(self.make_session("a", "reconciliation"))
+
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertEqual(synctrace.summarize(self.path)["a"]["sessions"], 10)
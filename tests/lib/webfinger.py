@@ -0,0 +1,170 @@
+import unittest
+
+import threading, BaseHTTPServer
+import email.utils
+
+from sduds.lib import webfinger
+from sduds.lib.connectionpool import ConnectionPool, Response
+from sduds.lib.lrucache import LRUCache
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args): pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+
+        if self.path=="/.well-known/host-meta":
+            host = "%s:%d" % self.server.socket.getsockname()
+
+            self.send_response(200, "OK")
+            self.send_header("Content-type", "application/xml")
+            self.send_header("Cache-Control", self.server.cache_control)
+            self.end_headers()
+
+            self.wfile.write("<?xml version='1.0' encoding='UTF-8'?>")
+            self.wfile.write("<XRD xmlns='http://docs.oasis-open.org/ns/xri/xrd-1.0'>")
+            self.wfile.write("<Link rel='lrdd' template='http://%s/describe?uri={uri}' />" % host)
+            self.wfile.write("</XRD>")
+        else:
+            self.send_response(200, "OK")
+            self.send_header("Content-type", "application/xml")
+            self.end_headers()
+
+            self.wfile.write("<?xml version='1.0' encoding='UTF-8'?>")
+            self.wfile.write("<XRD xmlns='http://docs.oasis-open.org/ns/xri/xrd-1.0'>")
+            self.wfile.write("<Link rel='http://hoegners.de/sduds/spec' href='http://example.org/document' />")
+            self.wfile.write("</XRD>")
+
+class Finger(unittest.TestCase):
+    def setUp(self):
+        # start a web server
+        address = ("localhost", 0)
+        httpd = BaseHTTPServer.HTTPServer(address, RequestHandler)
+        httpd.requests = []
+        httpd.cache_control = "max-age=3600"
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+
+        self.addCleanup(thread.join)
+        self.addCleanup(httpd.socket.close)
+        self.addCleanup(httpd.shutdown)
+
+        self.domain = "%s:%d" % httpd.socket.getsockname()
+        self.httpd = httpd
+
+        self.pool = ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+        # the test server does not speak https
+        self.schemes = ("http",)
+
+    def test_finger(self):
+        """ finger() must return the links of the XRD document """
+
+        wf = webfinger.finger("johndoe@"+self.domain, self.pool, schemes=self.schemes)
+        link = wf.find_link("http://hoegners.de/sduds/spec")
+        self.assertEqual(link, "http://example.org/document")
+
+        with self.assertRaises(webfinger.WebfingerError):
+            wf.find_link("nonexistant")
+
+    def test_cache(self):
+        """ the host-meta document must only be retrieved once if a cache is used """
+
+        cache = LRUCache(10)
+
+        for i in xrange(3):
+            webfinger.finger("johndoe%d@%s" % (i, self.domain), self.pool, cache=cache, schemes=self.schemes)
+
+        host_meta_requests = self.httpd.requests.count("/.well-known/host-meta")
+        self.assertEqual(host_meta_requests, 1)
+        self.assertEqual(len(self.httpd.requests), 4)
+
+    def test_cache_no_store(self):
+        """ the LRDD template must not be cached if the host-meta response forbids it """
+
+        self.httpd.cache_control = "no-store"
+        cache = LRUCache(10)
+
+        for i in xrange(2):
+            webfinger.finger("johndoe@"+self.domain, self.pool, cache=cache, schemes=self.schemes)
+
+        host_meta_requests = self.httpd.requests.count("/.well-known/host-meta")
+        self.assertEqual(host_meta_requests, 2)
+
+class SchemePool:
+    """ Answers host-meta requests with the given schemes and fails for the others. """
+
+    def __init__(self, schemes):
+        self.schemes = schemes
+        self.requests = []
+
+    def request(self, url, headers=None, timeout=None):
+        self.requests.append(url)
+
+        scheme = url.split(":", 1)[0]
+        if not scheme in self.schemes:
+            raise IOError("Connection refused")
+
+        body = "<XRD xmlns='http://docs.oasis-open.org/ns/xri/xrd-1.0'>" \
+               "<Link rel='lrdd' template='%s://example.org/describe?uri={uri}' /></XRD>" % scheme
+        return Response(url, 200, "OK", {}, body)
+
+class HostMetaScheme(unittest.TestCase):
+    def test_https(self):
+        """ the host-meta document must be retrieved with https if possible """
+
+        pool = SchemePool(["https", "http"])
+        cache = LRUCache(10)
+
+        template = webfinger.get_lrdd_template("example.org", pool, cache=cache)
+
+        self.assertEqual(template, "https://example.org/describe?uri={uri}")
+        self.assertEqual(pool.requests, ["https://example.org/.well-known/host-meta"])
+        self.assertEqual(cache.get("example.org"), ("https", template))
+
+    def test_http_fallback(self):
+        """ plain http must only be used if the https request fails """
+
+        pool = SchemePool(["http"])
+        cache = LRUCache(10)
+
+        template = webfinger.get_lrdd_template("example.org", pool, cache=cache)
+
+        self.assertEqual(template, "http://example.org/describe?uri={uri}")
+        self.assertEqual(pool.requests, ["https://example.org/.well-known/host-meta", "http://example.org/.well-known/host-meta"])
+        self.assertEqual(cache.get("example.org"), ("http", template))
+
+    def test_failure(self):
+        """ if no scheme works, the error of the last request must be raised """
+
+        pool = SchemePool([])
+
+        with self.assertRaises(IOError):
+            webfinger.get_lrdd_template("example.org", pool)
+
+        self.assertEqual(len(pool.requests), 2)
+
+class CacheLifetime(unittest.TestCase):
+    def test_max_age(self):
+        """ max-age must take precedence over Expires """
+
+        headers = {"cache-control": "public, max-age=60", "expires": "Thu, 01 Jan 1970 00:00:00 GMT"}
+        self.assertEqual(webfinger.cache_lifetime(headers), 60)
+
+    def test_expires(self):
+        """ the lifetime must be calculated from Expires and Date """
+
+        headers = {
+            "date": email.utils.formatdate(1000000000, usegmt=True),
+            "expires": email.utils.formatdate(1000000120, usegmt=True)
+        }
+        self.assertEqual(webfinger.cache_lifetime(headers), 120)
+
+    def test_default(self):
+        """ the default lifetime must be used if there are no caching headers """
+
+        self.assertEqual(webfinger.cache_lifetime({}, 42), 42)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,12 @@
 import unittest
 
+import sqlalchemy
 import threading, BaseHTTPServer
 import os, tempfile, shutil
 import time, math
 
 from sduds import partners
+from sduds.lib import migrations
 from sduds.constants import *
 
 # example attributes
@@ -88,7 +90,7 @@ class PartnerDatabase(unittest.TestCase):
         self.database_path = os.path.join(directory, "partners.sqlite")
         reference_timestamp = 1000000000
         self.database = partners.PartnerDatabase(self.database_path, reference_timestamp)
-        self.addCleanup(lambda: self.database.close)
+        self.addCleanup(lambda: self.database.close())
 
     def test_save_get(self):
         """ saves partner in database and reads it again """
@@ -128,6 +130,36 @@ class PartnerDatabase(unittest.TestCase):
         partner = self.database.get_partner("nonexistant")
         self.assertEqual(partner, None)
 
+    def test_get_partner_copy(self):
+        """ changing a partner returned by get_partner must not change the stored partner """
+
+        partner = partners.Partner(name, accept_password, base_url, control_probability,
+                                   connection_schedule, provide_username, provide_password)
+        self.database.save_partner(partner)
+
+        partner = self.database.get_partner(name)
+        partner.base_url = "http://www.example.com/"
+
+        self.assertEqual(self.database.get_partner(name).base_url, base_url)
+
+        # unless it is saved
+        self.database.save_partner(partner)
+        self.assertEqual(self.database.get_partner(name).base_url, "http://www.example.com/")
+
+    def test_reload_partners(self):
+        """ reload_partners must load partners saved by another PartnerDatabase """
+
+        other_database = partners.PartnerDatabase(self.database_path)
+        partner = partners.Partner(name, accept_password, base_url, control_probability,
+                                   connection_schedule, provide_username, provide_password)
+        other_database.save_partner(partner)
+        other_database.close()
+
+        self.assertEqual(self.database.get_partner(name), None)
+
+        self.database.reload_partners()
+        self.assertEqual(self.database.get_partner(name).base_url, base_url)
+
     def test_delete_partner(self):
         """ partner must be gone after delete """
 
@@ -360,6 +392,82 @@ class PartnerDatabase(unittest.TestCase):
         partner = self.database.get_partner(name)
         self.assertEqual(partner.kicked, False)
 
+    def test_upgrade_schema(self):
+        """ a database created before the schema versioning must be upgraded with its control samples kept """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        database_path = os.path.join(directory, "partners.sqlite")
+
+        # the former schema, where a failed webfinger address was unique among all partners
+        engine = sqlalchemy.create_engine("sqlite:///"+database_path)
+        partners.metadata.create_all(engine)
+        engine.execute("""CREATE TABLE failed_samples (id INTEGER NOT NULL, partner_id INTEGER, interval INTEGER,
+                          webfinger_address TEXT, PRIMARY KEY (id), UNIQUE (webfinger_address),
+                          FOREIGN KEY(partner_id) REFERENCES partners (id))""")
+        engine.execute("""CREATE TABLE successful_samples (id INTEGER NOT NULL, partner_id INTEGER, interval INTEGER,
+                          samples INTEGER, PRIMARY KEY (id), FOREIGN KEY(partner_id) REFERENCES partners (id))""")
+
+        reference_timestamp = 1000000000
+        interval = int(reference_timestamp/SAMPLE_SUMMARY_INTERVAL)
+        engine.execute("INSERT INTO failed_samples (partner_id, interval, webfinger_address) VALUES (1, ?, ?)", interval, "johndoe@example.org")
+        engine.dispose()
+
+        database = partners.PartnerDatabase(database_path, reference_timestamp)
+        self.addCleanup(database.close)
+
+        for partner_name in ("partner1", "partner2"):
+            partner = partners.Partner(partner_name, accept_password, base_url, control_probability)
+            database.save_partner(partner)
+
+        # the stored sample was kept, and the same address may fail for another partner
+        database.register_control_sample("partner2", reference_timestamp, "johndoe@example.org")
+        self.assertEqual(database.samples_cache.count_failed_samples(1, interval), 1)
+        self.assertEqual(database.samples_cache.count_failed_samples(2, interval), 1)
+        database.samples_cache.flush()
+
+        indexes = [name for name, in database.Session().execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        self.assertIn("ix_successful_samples_partner_id_interval", indexes)
+        self.assertIn("ix_failed_samples_partner_id_interval", indexes)
+
+    def test_upgrade_interrupted(self):
+        """ the copy of the failed samples must be kept if the migration was interrupted after dropping the table """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        database_path = os.path.join(directory, "partners.sqlite")
+
+        # the state after the copy was made and the original table was dropped
+        engine = sqlalchemy.create_engine("sqlite:///"+database_path)
+        partners.metadata.create_all(engine)
+        engine.execute("""CREATE TABLE failed_samples_new (id INTEGER NOT NULL, partner_id INTEGER, interval INTEGER,
+                          webfinger_address TEXT, PRIMARY KEY (id), UNIQUE (partner_id, webfinger_address),
+                          FOREIGN KEY(partner_id) REFERENCES partners (id))""")
+        engine.execute("""CREATE TABLE successful_samples (id INTEGER NOT NULL, partner_id INTEGER, interval INTEGER,
+                          samples INTEGER, PRIMARY KEY (id), FOREIGN KEY(partner_id) REFERENCES partners (id))""")
+
+        reference_timestamp = 1000000000
+        interval = int(reference_timestamp/SAMPLE_SUMMARY_INTERVAL)
+        engine.execute("INSERT INTO failed_samples_new (partner_id, interval, webfinger_address) VALUES (1, ?, ?)", interval, "johndoe@example.org")
+
+        connection = engine.connect()
+        migrations.set_version(connection, 1)
+        connection.close()
+        engine.dispose()
+
+        database = partners.PartnerDatabase(database_path, reference_timestamp)
+        self.addCleanup(database.close)
+
+        self.assertEqual(database.samples_cache.count_failed_samples(1, interval), 1)
+
+        session = database.Session()
+        tables = [name for name, in session.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        indexes = [name for name, in session.execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        session.close()
+
+        self.assertNotIn("failed_samples_new", tables)
+        self.assertIn("ix_failed_samples_partner_id_interval", indexes)
+
     def test_unkick_invalid(self):
         """ unkick_partner must return False if partner name is invalid """
 
@@ -370,21 +478,90 @@ import sqlalchemy
 
 class ControlSampleCache(unittest.TestCase):
     def setUp(self):
-        # create in-memory database
-        engine = sqlalchemy.create_engine("sqlite://")
+        # create database in a file, the samples are flushed by another thread
+        self.tempdir = tempfile.mkdtemp()
+        engine = sqlalchemy.create_engine("sqlite:///"+os.path.join(self.tempdir, "samples.sqlite"))
 
         # create tables for control samples
         partners.DatabaseObject.metadata.create_all(engine)
 
         # create session
-        Session = sqlalchemy.orm.sessionmaker(bind=engine)
+        self.Session = sqlalchemy.orm.sessionmaker(bind=engine)
 
         self.first_interval = 0 + CONTROL_SAMPLE_WINDOW - 1
-        self.cache = partners.ControlSampleCache(Session, self.first_interval)
+        self.cache = partners.ControlSampleCache(self.Session, self.first_interval)
 
         # check CONTROL_SAMPLE_WINDOW
         assert CONTROL_SAMPLE_WINDOW>=2, "testing fails when window is too small"
 
+    def tearDown(self):
+        if self.cache.window_end is not None:
+            self.cache.close()
+
+        shutil.rmtree(self.tempdir)
+
+    def test_reload(self):
+        """ samples must be counted by a new cache after the cache was closed """
+
+        partner_id = 0
+
+        self.cache.add_successful_sample(partner_id, self.first_interval)
+        self.cache.add_failed_sample(partner_id, self.first_interval, "johndoe@example.org")
+        self.cache.add_successful_sample(partner_id, self.first_interval+1)
+        self.cache.add_failed_sample(partner_id, self.first_interval+1, "johndoe@example.org")
+        self.cache.add_failed_sample(partner_id, self.first_interval+1, "janedoe@example.org")
+        self.cache.close()
+
+        interval = self.first_interval + CONTROL_SAMPLE_WINDOW
+        self.cache = partners.ControlSampleCache(self.Session, interval)
+
+        # the samples of the first interval are expired
+        self.assertEqual(self.cache.count_successful_samples(partner_id, interval), 1)
+        self.assertEqual(self.cache.count_failed_samples(partner_id, interval), 2)
+
+    def test_flush(self):
+        """ flush must write the samples to the database """
+
+        partner_id = 0
+
+        for i in xrange(3):
+            self.cache.add_successful_sample(partner_id, self.first_interval)
+            self.cache.flush()
+
+        self.cache.add_failed_sample(partner_id, self.first_interval, "johndoe@example.org")
+        self.cache.flush()
+        self.cache.add_failed_sample(partner_id, self.first_interval+1, "johndoe@example.org")
+        self.cache.flush()
+
+        session = self.Session()
+        summaries = session.query(partners.SuccessfulSamplesSummary).all()
+        failed_samples = session.query(partners.FailedSample).all()
+        session.close()
+
+        self.assertEqual([(summary.interval, summary.samples) for summary in summaries], [(self.first_interval, 3)])
+        self.assertEqual([failed.interval for failed in failed_samples], [self.first_interval+1])
+
+    def test_flush_in_background(self):
+        """ failed samples must be flushed as soon as too many are pending """
+
+        self.cache.close()
+        self.cache = partners.ControlSampleCache(self.Session, self.first_interval, max_cache_size_failed=5)
+
+        for i in xrange(6):
+            self.cache.add_failed_sample(0, self.first_interval, "johndoe%d@example.org" % i)
+
+        # the pending samples are taken out of the cache before they are written,
+        # so wait for the rows themselves
+        for i in xrange(50):
+            session = self.Session()
+            stored = session.query(partners.FailedSample).count()
+            session.close()
+
+            if stored==6: break
+            time.sleep(0.1)
+
+        self.assertEqual(stored, 6)
+
     def test_successful(self):
         """ successful control sample must be counted as long as it is valid """
 
@@ -0,0 +1,106 @@
+import unittest
+
+import StringIO, time
+import os, tempfile, shutil, gzip
+
+from sduds.statedatabase import dump
+
+from tests.states import private_key_block
+
+class Dump(unittest.TestCase):
+    def setUp(self):
+        self.timestamp = int(time.time())
+        self.states = list(dump.generate_states(20, private_key_block, self.timestamp, seed=1))
+
+    def assertStatesEqual(self, first, second):
+        self.assertEqual([(state.address, state.retrieval_timestamp, state.hash) for state in first],
+                         [(state.address, state.retrieval_timestamp, state.hash) for state in second])
+
+    def test_generate(self):
+        """ generated states must be valid, have distinct addresses and depend only on the seed """
+
+        for state in self.states:
+            self.assertTrue(state.profile.check(state.address, self.timestamp))
+            self.assertLessEqual(state.profile.submission_timestamp, state.retrieval_timestamp)
+
+        self.assertEqual(len(set(state.address for state in self.states)), 20)
+
+        again = dump.generate_states(20, private_key_block, self.timestamp, seed=1)
+        self.assertStatesEqual(again, self.states)
+
+    def test_ndjson(self):
+        """ states written as NDJSON must be read back unchanged """
+
+        f = StringIO.StringIO()
+        self.assertEqual(dump.write_ndjson(self.states, f), 20)
+
+        f.seek(0)
+        self.assertStatesEqual(dump.read_ndjson(f), self.states)
+
+    def test_csv(self):
+        """ states written as CSV must be read back unchanged """
+
+        f = StringIO.StringIO()
+        self.assertEqual(dump.write_csv(self.states, f), 20)
+
+        f.seek(0)
+        self.assertStatesEqual(dump.read_csv(f), self.states)
+
+    def test_malformed(self):
+        """ records with missing or invalid fields must raise ValueError """
+
+        f = StringIO.StringIO('{"webfinger_address": "johndoe@example.org"}\n')
+
+        with self.assertRaises(ValueError):
+            list(dump.read_ndjson(f))
+
+class Snapshot(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "states.snapshot")
+
+        self.states = list(dump.generate_states(20, private_key_block, seed=1))
+        self.ghosts = [("a"*16, 1000), ("b"*16, 2000)]
+
+    def test_round_trip(self):
+        """ states and ghosts of a snapshot must be read back unchanged """
+
+        self.assertEqual(dump.write_snapshot(self.path, self.states, self.ghosts), (20, 2))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+        header = dump.verify_snapshot(self.path)
+        self.assertEqual((header["states"], header["ghosts"]), (20, 2))
+
+        self.assertEqual([state.hash for state in dump.read_snapshot_states(self.path)],
+                         [state.hash for state in self.states])
+        self.assertEqual(list(dump.read_snapshot_ghosts(self.path)), self.ghosts)
+
+    def test_corrupt(self):
+        """ modified and truncated snapshots must be rejected """
+
+        dump.write_snapshot(self.path, self.states, self.ghosts)
+
+        with gzip.open(self.path) as f:
+            lines = f.readlines()
+
+        # a modified state
+        with gzip.open(self.path, "wb") as f:
+            f.writelines(lines[:3] + [lines[3].replace('"diaspora', '"friendica')] + lines[4:])
+
+        with self.assertRaises(ValueError):
+            dump.verify_snapshot(self.path)
+
+        # a missing trailer
+        with gzip.open(self.path, "wb") as f:
+            f.writelines(lines[:-1])
+
+        with self.assertRaises(ValueError):
+            dump.verify_snapshot(self.path)
+
+        # not a snapshot at all
+        with open(self.path, "wb") as f:
+            f.write("garbage")
+
+        with self.assertRaises(ValueError):
+            dump.verify_snapshot(self.path)
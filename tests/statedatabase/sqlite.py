@@ -0,0 +1,214 @@
+import unittest
+
+import time
+import os, tempfile, shutil
+
+from sduds.constants import PROFILE_LIFETIME, MIN_RESUBMISSION_INTERVAL, MAX_NAME_LENGTH
+from sduds.states import State, StateRecord, Profile, Ghost
+from sduds.statedatabase import dump
+from sduds.statedatabase.sqlite import StateDatabase, normalize_search_terms, search_matches
+
+from tests.states import private_key_block
+
+class NormalizeSearchTerms(unittest.TestCase):
+    def test_order_and_duplicates(self):
+        """ the order and duplicates of the search terms must not matter """
+
+        self.assertEqual(normalize_search_terms([u"doe", u"john", u"doe"]), (u"doe", u"john"))
+        self.assertEqual(normalize_search_terms(["diaspora", "email"]), normalize_search_terms(["email", "diaspora"]))
+
+    def test_case(self):
+        """ only ASCII letters must be folded to lower case, like SQLite's LIKE does """
+
+        self.assertEqual(normalize_search_terms([u"John"]), (u"john",))
+        self.assertEqual(normalize_search_terms([u"\xc4rger"]), (u"\xc4rger",))
+
+class SearchMatches(unittest.TestCase):
+    def setUp(self):
+        profile = Profile(u"John Doe", u"Berlin", "DE", "diaspora,email", "", 0)
+        self.state = StateRecord("johndoe@example.org", 0, profile)
+
+    def matches(self, words=(), services=()):
+        return search_matches(self.state, normalize_search_terms(words), normalize_search_terms(services))
+
+    def test_words(self):
+        """ all words must occur in one of the fields, ignoring the case of ASCII letters """
+
+        self.assertTrue(self.matches([u"JOHN", u"berl"]))
+        self.assertTrue(self.matches([u"example.org", u"de"]))
+        self.assertFalse(self.matches([u"john", u"hamburg"]))
+
+    def test_services(self):
+        """ all services must be used, not only a part of their names """
+
+        self.assertTrue(self.matches(services=["email", "diaspora"]))
+        self.assertFalse(self.matches(services=["mail"]))
+
+    def test_wildcards(self):
+        """ terms with the wildcards of LIKE must be assumed to match """
+
+        self.assertTrue(self.matches([u"j%n"], ["dia_pora"]))
+
+    def test_without_profile(self):
+        """ states without profile are never found """
+
+        self.assertFalse(search_matches(StateRecord("johndoe@example.org", None, None), (), ()))
+
+class StateDatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.statedb = StateDatabase(os.path.join(directory, "PTree"), os.path.join(directory, "states.sqlite"))
+        self.addCleanup(lambda: self.statedb.close())
+
+        self.timestamp = int(time.time())
+        self.states = list(dump.generate_states(10, private_key_block, self.timestamp, seed=1))
+
+        self.statedb.bulk_load(self.states[:5])
+
+class Save(StateDatabaseTestCase):
+    def test_replace(self):
+        """ a state must be replaced by a newer one for the same address, leaving a ghost """
+
+        state = self.states[0]
+        newer = list(dump.generate_states(1, private_key_block, self.timestamp + MIN_RESUBMISSION_INTERVAL, seed=1))[0]
+        self.assertEqual(newer.address, state.address)
+
+        self.assertTrue(self.statedb.save(newer))
+        self.assertEqual(self.statedb.count(), (5, 1))
+
+        self.assertEqual([ghost.hash for ghost in self.statedb.get_ghosts([state.hash])], [state.hash])
+        self.assertEqual(self.statedb.get_valid_state(newer.hash).address, state.address)
+
+class BulkLoad(StateDatabaseTestCase):
+    def modified(self, state, **fields):
+        """ Returns a copy of a state with some fields of its profile replaced. """
+
+        profile = state.profile
+        values = dict(full_name=profile.full_name, hometown=profile.hometown, country_code=profile.country_code,
+                      services=profile.services, captcha_signature=profile.captcha_signature,
+                      submission_timestamp=profile.submission_timestamp)
+        values.update(fields)
+
+        return StateRecord(state.address, state.retrieval_timestamp, Profile(**values))
+
+    def test_malformed(self):
+        """ expired states and states with too long fields must be skipped """
+
+        old = list(dump.generate_states(1, private_key_block, self.timestamp - 2*PROFILE_LIFETIME, seed=2))
+        long_name = self.modified(self.states[5], full_name=u"x"*(MAX_NAME_LENGTH+1))
+
+        self.assertEqual(self.statedb.bulk_load(old + [long_name, self.states[6]]), (1, 2))
+        self.assertEqual(self.statedb.count(), (6, 0))
+
+    def test_check(self):
+        """ the signatures must only be verified if check is set """
+
+        forged = self.modified(self.states[5], captcha_signature="\0"*len(self.states[5].profile.captcha_signature))
+
+        self.assertEqual(self.statedb.bulk_load([forged], check=True), (0, 1))
+        self.assertEqual(self.statedb.bulk_load([forged]), (1, 0))
+
+class Count(StateDatabaseTestCase):
+    def assertCount(self):
+        """ count() must agree with the tables """
+
+        session = self.statedb.Session()
+        expected = session.query(State).count(), session.query(Ghost).count()
+        session.close()
+
+        self.assertEqual(self.statedb.count(), expected)
+
+    def test_count(self):
+        """ the numbers of states and ghosts must be kept up to date by the changing methods """
+
+        self.assertEqual(self.statedb.count(), (5, 0))
+
+        self.statedb.save(self.states[5])
+        self.assertEqual(self.statedb.count(), (6, 0))
+
+        self.statedb.cleanup()
+        self.assertCount()
+
+    def test_reopen(self):
+        """ the numbers must be counted when the database is opened """
+
+        self.statedb.save(self.states[5])
+        self.statedb.close()
+
+        self.statedb = StateDatabase(self.statedb.hashtrie_path, self.statedb.database_path)
+        self.assertEqual(self.statedb.count(), (6, 0))
+
+class SearchCache(StateDatabaseTestCase):
+    def search(self, address):
+        return [state.address for state in self.statedb.search([address.decode("utf8")])]
+
+    def test_hit(self):
+        """ a repeated search must be answered from the cache """
+
+        address = self.states[0].address
+
+        self.assertEqual(self.search(address), [address])
+        self.assertEqual(self.statedb.search_cache.hits, 0)
+
+        self.assertEqual(self.search(address.upper()), [address])
+        self.assertEqual(self.statedb.search_cache.hits, 1)
+
+    def test_save(self):
+        """ saving a state must invalidate the cached results """
+
+        address = self.states[7].address
+
+        self.assertEqual(self.search(address), [])
+
+        self.assertTrue(self.statedb.save(self.states[7]))
+        self.assertEqual(self.search(address), [address])
+
+    def test_discarded(self):
+        """ a discarded state must not invalidate the cached results """
+
+        address = self.states[0].address
+        self.search(address)
+
+        self.assertFalse(self.statedb.save(self.states[0]))
+
+        self.search(address)
+        self.assertEqual(self.statedb.search_cache.hits, 1)
+
+    def test_unrelated(self):
+        """ saving a state which does not match a search must keep its cached results """
+
+        address = self.states[0].address
+        self.search(address)
+
+        self.assertTrue(self.statedb.save(self.states[7]))
+
+        self.assertEqual(self.search(address), [address])
+        self.assertEqual(self.statedb.search_cache.hits, 1)
+
+    def test_replace(self):
+        """ replacing a state which was found must invalidate the cached results """
+
+        address = self.states[0].address
+        self.search(address)
+
+        newer = list(dump.generate_states(1, private_key_block, self.timestamp + MIN_RESUBMISSION_INTERVAL, seed=1))[0]
+        self.assertTrue(self.statedb.save(newer))
+
+        results = list(self.statedb.search([address.decode("utf8")]))
+        self.assertEqual(self.statedb.search_cache.hits, 0)
+        self.assertEqual([state.hash for state in results], [newer.hash])
+
+    def test_cleanup(self):
+        """ deleting expired states must invalidate the cached results """
+
+        old = list(dump.generate_states(1, private_key_block, self.timestamp - 2*PROFILE_LIFETIME, seed=2))
+        self.assertTrue(self.statedb.save(old[0]))
+
+        address = old[0].address
+
+        self.assertEqual(self.search(address), [address])
+
+        self.statedb.cleanup()
+        self.assertEqual(self.search(address), [])
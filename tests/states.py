@@ -378,6 +378,37 @@ class TimingOutDocumentRequestHandler(RequestHandler):
         # wait until stop event is set
         self.server.stopEvent.wait()
 
+class ConditionalDocumentRequestHandler(RequestHandler):
+    def json_document(self):
+        self.server.document_requests += 1
+
+        if self.headers.get("If-None-Match")=='"v1"':
+            self.server.not_modified_responses += 1
+            self.send_response(304, "Not Modified")
+            self.end_headers()
+            return
+
+        # send headers
+        self.send_response(200, "OK")
+        self.send_header("Content-type", "application/json")
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+
+        # write JSON document
+        hex_signature = binascii.hexlify(self.server.profile.captcha_signature)
+
+        document = {
+            "webfinger_address": self.server.profile_address,
+            "full_name": self.server.profile.full_name,
+            "hometown": self.server.profile.hometown,
+            "country_code": self.server.profile.country_code,
+            "services": self.server.profile.services,
+            "captcha_signature": hex_signature,
+            "submission_timestamp": self.server.profile.submission_timestamp
+        }
+
+        self.wfile.write(json.dumps(document))
+
 class RetrieveTestCase(unittest.TestCase):
     def setup_server(self, handler):
         # start a web server
@@ -431,6 +462,26 @@ class ProfileRetrieve(RetrieveTestCase):
         self.assertEqual(type(profile.submission_timestamp), int)
         self.assertEqual(profile.submission_timestamp, submission_timestamp)
 
+    def test_conditional(self):
+        """ Profile.retrieve must send a conditional request and reuse the document on 304 """
+
+        self.setup_server(ConditionalDocumentRequestHandler)
+        self.httpd.document_requests = 0
+        self.httpd.not_modified_responses = 0
+
+        # retrieve profile twice
+        profile = states.Profile.retrieve(self.address)
+        profile2 = states.Profile.retrieve(self.address)
+
+        # second request must have been answered with 304
+        self.assertEqual(self.httpd.document_requests, 2)
+        self.assertEqual(self.httpd.not_modified_responses, 1)
+
+        # check that the profile was reconstructed from the stored document
+        self.assertEqual(profile2.full_name, full_name)
+        self.assertEqual(profile2.captcha_signature, self.captcha_signature)
+        self.assertEqual(profile2.submission_timestamp, submission_timestamp)
+
     def test_invalid_host_meta(self):
         """ Profile.retrieve must raise RetrievalFailed if host meta is invalid """
 
@@ -636,6 +687,89 @@ class State(unittest.TestCase):
         state2 = states.State(address, retrieval_timestamp, profile2)
         self.assertNotEqual(state.hash, state2.hash)
 
+    def test_hash_cached(self):
+        """ State.hash must be recalculated if address or profile are changed in place """
+
+        profile = states.Profile(full_name, hometown, country_code, services, captcha_signature, submission_timestamp)
+        state = states.State(address, submission_timestamp, profile)
+        original_hash = state.hash
+
+        # same value on subsequent accesses
+        self.assertEqual(state.hash, original_hash)
+
+        # changing a profile field must invalidate the cached value
+        state.profile.full_name = u"Other name"
+        self.assertNotEqual(state.hash, original_hash)
+
+        state.profile.full_name = full_name
+        self.assertEqual(state.hash, original_hash)
+
+        # replacing the profile or the address must invalidate it as well
+        state.profile = states.Profile(full_name, hometown, country_code, services, captcha_signature, submission_timestamp+1)
+        self.assertNotEqual(state.hash, original_hash)
+
+        state.profile = profile
+        state.address = "other_address@example.org"
+        self.assertNotEqual(state.hash, original_hash)
+
+class StateRecord(unittest.TestCase):
+    def setUp(self):
+        self.profile = states.Profile(full_name, hometown, country_code, services, captcha_signature, submission_timestamp)
+        self.record = states.StateRecord(address, submission_timestamp, self.profile)
+        self.state = states.State(address, submission_timestamp, self.profile)
+
+    def test_equal_to_state(self):
+        """ a StateRecord must be equal to a State with the same data and have the same hash """
+
+        self.assertEqual(self.record.hash, self.state.hash)
+        self.assertTrue(self.record==self.state)
+        self.assertTrue(self.state==self.record)
+
+        profile2 = states.Profile(u"Other name", hometown, country_code, services, captcha_signature, submission_timestamp)
+        record2 = states.StateRecord(address, submission_timestamp, profile2)
+        self.assertNotEqual(record2.hash, self.state.hash)
+        self.assertFalse(record2==self.state)
+
+        # states without profile
+        self.assertTrue(states.StateRecord(address, submission_timestamp, None)==states.State(address, submission_timestamp, None))
+        self.assertFalse(states.StateRecord(address, submission_timestamp, None)==self.state)
+
+    def test_to_state(self):
+        """ to_state() must return a State with the same attributes and hash """
+
+        state = self.record.to_state()
+
+        self.assertIsInstance(state, states.State)
+        self.assertEqual(state.address, self.record.address)
+        self.assertEqual(state.retrieval_timestamp, self.record.retrieval_timestamp)
+        self.assertEqual(state.profile.captcha_signature, captcha_signature)
+        self.assertEqual(state.hash, self.record.hash)
+        self.assertTrue(state==self.record)
+
+        # the hash must still be recalculated after a change
+        state.profile = states.Profile(full_name, hometown, country_code, services, captcha_signature, submission_timestamp+1)
+        self.assertNotEqual(state.hash, self.record.hash)
+
+    def test_hash_cached(self):
+        """ StateRecord.hash must be recalculated if address or profile are changed """
+
+        original_hash = self.record.hash
+
+        self.record.profile.hometown = u"Other hometown"
+        self.assertNotEqual(self.record.hash, original_hash)
+
+        self.record.profile.hometown = hometown
+        self.record.address = "other_address@example.org"
+        self.assertNotEqual(self.record.hash, original_hash)
+
+    def test_slots(self):
+        """ StateRecord must not accept attributes which are not in __slots__ """
+
+        self.assertFalse(hasattr(self.record, "__dict__"))
+
+        with self.assertRaises(AttributeError):
+            self.record.other_attribute = 1
+
 class StateRetrieve(RetrieveTestCase):
     def test_successful(self):
         """ attributes of the state returned by State.retrieve must be correct """
@@ -0,0 +1,121 @@
+import unittest
+
+import StringIO, time
+
+from sduds import synchronization
+from sduds.constants import *
+from sduds.states import Ghost
+from sduds.statedatabase import dump
+
+from tests.states import private_key_block
+
+class StateDatabase:
+    """ Provides the methods of the state database used to send deletion requests and
+        in the catch-up mode. """
+
+    def __init__(self, states, ghosts=()):
+        self.states = sorted((state.hash, state) for state in states)
+        self.ghosts = dict((ghost.hash, ghost) for ghost in ghosts)
+
+    def get_ghosts(self, binhashes):
+        return (self.ghosts[binhash] for binhash in binhashes if binhash in self.ghosts)
+
+    def iter_valid_states(self):
+        return iter(self.states)
+
+    def iter_hashes(self, ghosts=False):
+        if ghosts:
+            return iter(sorted(self.ghosts))
+        else:
+            return iter(binhash for binhash, state in self.states)
+
+class DeletionRequests(unittest.TestCase):
+    def setUp(self):
+        self.states = list(dump.generate_states(8, private_key_block, seed=1))
+
+    def test_send(self):
+        """ ghosts among the missing hashes must be sent as deletion requests and must not be requested """
+
+        ghosts = [Ghost(state.hash, state.retrieval_timestamp) for state in self.states[:3]]
+        ghosts.append(Ghost(self.states[3].hash, None))
+        statedb = StateDatabase([], ghosts)
+
+        sending = synchronization.Synchronization(set(state.hash for state in self.states))
+
+        f = StringIO.StringIO()
+        self.assertEqual(sending.send_deletion_requests(f, statedb), 3)
+        self.assertEqual(sending.request_hashes, set(state.hash for state in self.states[4:]))
+
+        f.seek(0)
+        requests = []
+        while True:
+            deletion_request = synchronization.DeletionRequest.read(f)
+            if not deletion_request: break
+            requests.append((deletion_request.binhash, deletion_request.retrieval_timestamp))
+
+        expected = [(state.hash, state.retrieval_timestamp) for state in self.states[:3]]
+        self.assertEqual(sorted(requests), sorted(expected))
+
+class CatchUp(unittest.TestCase):
+    def setUp(self):
+        self.states = list(dump.generate_states(30, private_key_block, seed=1))
+
+    def test_decision(self):
+        """ the catch-up mode must only be chosen for large differences, on both sides alike """
+
+        self.assertFalse(synchronization.catch_up(1000, 1100))
+        self.assertFalse(synchronization.catch_up(10*CATCH_UP_MIN_DIFFERENCE, 9*CATCH_UP_MIN_DIFFERENCE))
+        self.assertTrue(synchronization.catch_up(0, CATCH_UP_MIN_DIFFERENCE))
+        self.assertTrue(synchronization.catch_up(CATCH_UP_MIN_DIFFERENCE, 0))
+        self.assertFalse(synchronization.catch_up(0, CATCH_UP_MIN_DIFFERENCE-1))
+
+    def test_transfer(self):
+        """ only the states whose hashes are neither states nor ghosts of the receiver must be yielded """
+
+        sender = StateDatabase(self.states)
+
+        known = self.states[:10]
+        ghosts = [Ghost(state.hash, state.retrieval_timestamp) for state in self.states[10:15]]
+        receiver = StateDatabase(known, ghosts)
+
+        f = StringIO.StringIO()
+        self.assertEqual(synchronization.Synchronization().send_all_states(f, sender), 30)
+
+        f.seek(0)
+        receiving = synchronization.Synchronization()
+        received = list(receiving.receive_all_states(f, receiver))
+
+        self.assertEqual(receiving.received, 30)
+        self.assertEqual(sorted(state.hash for state in received), sorted(state.hash for state in self.states[15:]))
+
+    def test_not_requested(self):
+        """ states received in catch-up mode must not be requested again after the reconciliation """
+
+        sender = StateDatabase(self.states[:20])
+        receiver = StateDatabase(self.states[:5])
+
+        f = StringIO.StringIO()
+        synchronization.Synchronization().send_all_states(f, sender)
+
+        f.seek(0)
+        receiving = synchronization.Synchronization()
+        list(receiving.receive_all_states(f, receiver))
+
+        # the reconciliation finds the states of the stream, which are not stored
+        # yet, and those the sender saved after streaming
+        receiving.missing_hashes = set(state.hash for state in self.states[5:25])
+        receiving.send_deletion_requests(StringIO.StringIO(), receiver)
+
+        self.assertEqual(receiving.request_hashes, set(state.hash for state in self.states[20:25]))
+
+    def test_unordered(self):
+        """ states which are not ordered by hash must be rejected """
+
+        f = StringIO.StringIO()
+        for state in sorted(self.states, key=lambda state: state.hash, reverse=True)[:2]:
+            synchronization.BulkStateMessage(state.hash, state).write(f)
+        synchronization.terminator.write(f)
+
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            list(synchronization.Synchronization().receive_all_states(f, StateDatabase([])))